@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+"""Benchmark how /weekly and the email crons read from the datastore.
+
+The datastore stub answers instantly, which hides the cost of making
+RPCs one after another.  So we wrap it in a stub that gives every
+RPC a fixed latency, as a real datastore call would have, and time:
+
+* the old way: the week's snippet query, and then the user query;
+* digest._build() and snippets._get_email_to_current_snippet_map(),
+  which start the snippet query and read the user directory (and so
+  query all users) while it runs.
+
+We flush memcache before each run, so the user directory always has
+to be read from the datastore.
+
+Run this via 'make bench'.
+"""
+
+import datetime
+import os
+import sys
+import threading
+import time
+
+# Update sys.path so it can find these.  We just need to add
+# 'google_appengine', but we add all of $PATH to be easy.  This
+# assumes the google_appengine directory is on the path.
+sys.path.extend(os.environ['PATH'].split(':'))
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+from google.appengine.api import apiproxy_rpc
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+import digest
+import models
+import snippets
+
+
+_RPC_LATENCY = 0.02      # in seconds
+_NUM_USERS = 200
+_NUM_RUNS = 10
+_TODAY = datetime.datetime(2012, 2, 23)
+_WEEK = datetime.date(2012, 2, 20)
+
+
+class _LatencyRPC(apiproxy_rpc.RPC):
+    """An RPC that takes _RPC_LATENCY seconds, in the background."""
+
+    def _MakeCallImpl(self):
+        super(_LatencyRPC, self)._MakeCallImpl()
+        self._latency = threading.Thread(target=time.sleep,
+                                         args=(_RPC_LATENCY,))
+        self._latency.start()
+
+    def _WaitImpl(self):
+        self._latency.join()
+        return super(_LatencyRPC, self)._WaitImpl()
+
+
+class _LatencyStub(object):
+    """Wraps an API stub so that every call to it has _RPC_LATENCY."""
+
+    def __init__(self, stub):
+        self._stub = stub
+
+    def __getattr__(self, name):
+        return getattr(self._stub, name)
+
+    def CreateRPC(self):
+        return _LatencyRPC(stub=self._stub)
+
+    def MakeSyncCall(self, *args):
+        time.sleep(_RPC_LATENCY)
+        return self._stub.MakeSyncCall(*args)
+
+
+def _sequential_queries():
+    """How /weekly and the email crons used to read the datastore."""
+    snippets_q = models.Snippet.all()
+    snippets_q.filter('week = ', _WEEK)
+    snippets_q.fetch(1000)
+    models.User.all().fetch(1000)
+
+
+def _build_digest():
+    digest._build(_WEEK)
+
+
+def _get_email_map():
+    snippets._get_email_to_current_snippet_map(_TODAY)
+
+
+def _populate():
+    users = [models.User(key_name='user%d@example.com' % i,
+                         email='user%d@example.com' % i,
+                         category='team %d' % (i % 10))
+             for i in xrange(_NUM_USERS)]
+    snippet_list = [models.Snippet(key_name=models.Snippet.make_key_name(
+                                       user.email, _WEEK),
+                                   email=user.email, week=_WEEK,
+                                   text='did some things\n' * 20)
+                    for user in users[::2]]
+    db.put(users + snippet_list)
+
+
+def _time(fn):
+    """Return the fastest of _NUM_RUNS runs of fn, in seconds."""
+    times = []
+    for _ in xrange(_NUM_RUNS):
+        memcache.flush_all()
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    tb = testbed.Testbed()
+    tb.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    tb.init_datastore_v3_stub(consistency_policy=policy)
+    tb.init_memcache_stub()
+    _populate()
+
+    apiproxy_stub_map.apiproxy.ReplaceStub(
+        'datastore_v3',
+        _LatencyStub(apiproxy_stub_map.apiproxy.GetStub('datastore_v3')))
+
+    print ('%d users, %d ms per datastore RPC, best of %d runs'
+           % (_NUM_USERS, _RPC_LATENCY * 1000, _NUM_RUNS))
+    for (name, fn) in (('sequential snippet + user queries',
+                        _sequential_queries),
+                       ('digest._build', _build_digest),
+                       ('_get_email_to_current_snippet_map', _get_email_map)):
+        print '%-40s %7.1f ms' % (name, _time(fn) * 1000)
+
+    tb.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+"""A precomputed summary of each week's snippets, backing /weekly.
+
+To show a week, /weekly needs every user and every snippet author,
+grouped by category, along with who is hidden and which snippets are
+private.  Working that out takes a query over all the week's snippets
+and a look at every user, so we store the result in a WeeklyDigest
+entity, one per week, and keep it up to date:
+
+* When a snippet is saved, util.update_snippet() queues a task,
+  transactionally, that calls update_for_snippet().  Doing it in a
+  task keeps the digest, which every snippet save for a week
+  touches, out of the snippet's transaction.  If the week doesn't
+  have a digest yet, update_for_snippet() stores a placeholder one
+  (see _PENDING_FORMAT_VERSION) instead, so a digest being built at
+  the same time doesn't leave the snippet out.
+* Each digest records the generation of the user directory (see
+  directory.py) it was built from.  When users change, the next
+  read of the digest refreshes its user information from the
+  directory; that doesn't need a snippet query.
+
+The digest doesn't hold snippet text; /weekly fetches that with a
+batch get.  So that /weekly can cache what it renders, we also keep
+a 'snippets generation' for each week, in memcache, which is
+incremented whenever one of that week's snippets is saved; see
+snippets_generation().  Each entry in a digest is a dict with these fields:
+   email: the email of the user or snippet author
+   display_name: the user's display name ('' if there's no user record)
+   is_user: False if the snippet author has no user record
+   is_hidden: True if the user is hidden
+   has_snippet: True if there's a snippet for this week
+   private: True if the snippet for this week is private
+"""
+
+import bisect
+import json
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+import directory
+import models
+
+
+# Increment this whenever changing what goes into a digest, so that
+# old digests are rebuilt when they're next read.
+_FORMAT_VERSION = 1
+
+# The format_version of a placeholder digest, which lists just the
+# snippets saved since it was written.  Like an out-of-date digest,
+# it's rebuilt when it's next read, but the rebuild makes sure to
+# include the snippets it lists.
+_PENDING_FORMAT_VERSION = 0
+
+
+_SNIPPETS_GENERATION_KEY = 'weekly_digest:snippets_generation:%s'
+
+
+def _key_name(week):
+    return week.isoformat()
+
+
+def _category(directory_entry):
+    """Return the category to list a user (or a non-user, if None) under."""
+    if directory_entry is None:
+        return models.NULL_CATEGORY
+    return directory_entry.category
+
+
+def _entry(email, directory_entry, has_snippet, private):
+    """Return the digest entry for the given user and/or snippet.
+
+    directory_entry is None for snippet authors that don't have a
+    user record.
+    """
+    return {
+        'email': email,
+        'display_name': (directory_entry.display_name
+                         if directory_entry else ''),
+        'is_user': directory_entry is not None,
+        'is_hidden': bool(directory_entry and directory_entry.is_hidden),
+        'has_snippet': has_snippet,
+        'private': private,
+    }
+
+
+def _make_digest(week, snapshot, snippet_privacy):
+    """Return a new WeeklyDigest for week.
+
+    snapshot is a directory.Snapshot, and snippet_privacy is a list
+    of (email, private) pairs, one for each snippet this week.
+    """
+    email_to_user = dict((u.email, u) for u in snapshot.entries)
+
+    entries_by_category = {}
+    for (email, private) in snippet_privacy:
+        user = email_to_user.get(email)
+        entries_by_category.setdefault(_category(user), []).append(
+            _entry(email, user, True, private))
+    emails_with_snippets = set(email for (email, _) in snippet_privacy)
+    for user in snapshot.entries:
+        if user.email not in emails_with_snippets:
+            entries_by_category.setdefault(_category(user), []).append(
+                _entry(user.email, user, False, False))
+
+    categories = []
+    for (category, entries) in sorted(entries_by_category.iteritems()):
+        entries.sort(key=lambda entry: entry['email'])
+        categories.append([category, entries])
+
+    return models.WeeklyDigest(key_name=_key_name(week),
+                               categories_json=json.dumps(categories),
+                               format_version=_FORMAT_VERSION,
+                               user_directory_token=str(snapshot.generation))
+
+
+def _build(week, extra_emails=()):
+    """Return a new WeeklyDigest for the given week, computed from scratch.
+
+    The query for the week's snippets is eventually consistent, so we
+    don't trust it alone: we also get, by key, the snippet of every
+    user in the directory, and of everyone in extra_emails.
+    """
+    snippets_q = models.Snippet.all(keys_only=True)
+    snippets_q.filter('week = ', week)
+    # run() starts the query in the background; we read the user
+    # directory (which may mean querying all users) while it runs.
+    snippet_keys = snippets_q.run(limit=1000, batch_size=1000)
+    snapshot = directory.get()
+    emails = [u.email for u in snapshot.entries] + list(extra_emails)
+    keys = set(snippet_keys)
+    keys.update(db.Key.from_path('Snippet',
+                                 models.Snippet.make_key_name(email, week))
+                for email in emails)
+    email_to_private = dict((s.email, bool(s.private))
+                            for s in db.get(list(keys)) if s)
+    return _make_digest(week, snapshot, sorted(email_to_private.iteritems()))
+
+
+def _pending_emails(week_digest):
+    """Return the emails with snippets, if week_digest is a placeholder."""
+    if (week_digest is None or
+            week_digest.format_version != _PENDING_FORMAT_VERSION):
+        return []
+    return [entry['email']
+            for (_, entries) in categories(week_digest)
+            for entry in entries
+            if entry['has_snippet']]
+
+
+def _refresh(week, week_digest, snapshot):
+    """Return a copy of week_digest with up-to-date user information."""
+    snippet_privacy = [(entry['email'], entry['private'])
+                       for (_, entries) in categories(week_digest)
+                       for entry in entries
+                       if entry['has_snippet']]
+    return _make_digest(week, snapshot, snippet_privacy)
+
+
+def _save(week, new_digest, old_digest):
+    """Replace old_digest (which may be None) with new_digest, and return it.
+
+    If the stored digest changes while we were computing the new
+    one, we leave it alone rather than overwriting the change; it
+    will be brought up to date on a later read.
+    """
+    old_revision = old_digest.revision if old_digest else 0
+    if old_digest and old_digest.categories_json == new_digest.categories_json:
+        new_digest.revision = old_revision
+    else:
+        new_digest.revision = old_revision + 1
+
+    def txn():
+        current = models.WeeklyDigest.get_by_key_name(_key_name(week))
+        if (current.revision if current else 0) == old_revision:
+            new_digest.put()
+
+    db.run_in_transaction(txn)
+    return new_digest
+
+
+def _get_async(week):
+    """Start fetching the stored digest for week; return the RPC."""
+    return db.get_async(db.Key.from_path('WeeklyDigest', _key_name(week)))
+
+
+def rebuild(week):
+    """Recompute and store the digest for week, and return it."""
+    old_digest = _get_async(week).get_result()
+    new_digest = _build(week, _pending_emails(old_digest))
+    return _save(week, new_digest, old_digest)
+
+
+def get(week):
+    """Return an up-to-date WeeklyDigest for week, building it if need be.
+
+    This is called on every view of /weekly, so we only write when we
+    have to, and never let a write failing stop us serving the digest.
+    """
+    # We fetch the digest and the user directory in parallel.
+    rpc = _get_async(week)
+    snapshot = directory.get()
+    week_digest = rpc.get_result()
+    if (week_digest is None or
+            week_digest.format_version != _FORMAT_VERSION):
+        new_digest = _build(week, _pending_emails(week_digest))
+    elif (snapshot.generation is not None and
+            week_digest.user_directory_token == str(snapshot.generation)):
+        return week_digest
+    else:
+        new_digest = _refresh(week, week_digest, snapshot)
+        if new_digest.categories_json == week_digest.categories_json:
+            # No user we list has changed.  We don't store the new
+            # token: that would mean a write on every view by every
+            # viewer until one of them got it in, and the refresh is
+            # cheap to do again.
+            new_digest.revision = week_digest.revision
+            return new_digest
+
+    if snapshot.generation is None:
+        # memcache is down, so whatever we stored would be seen as out
+        # of date by every later view; don't write on each of them.
+        return new_digest
+    try:
+        return _save(week, new_digest, week_digest)
+    except db.TransactionFailedError:
+        # Lots of viewers are saving at once; one of them will get it in.
+        return new_digest
+
+
+def categories(week_digest):
+    """Return the digest's list of (category, [entry, ...]) pairs."""
+    return [(category, entries)
+            for (category, entries) in json.loads(week_digest.categories_json)]
+
+
+def _updated_for_snippet(week_digest, snippet, user):
+    """Return week_digest updated to account for the snippet, or None.
+
+    week_digest may be None, or out of date, in which case we return
+    a placeholder digest (see _PENDING_FORMAT_VERSION).  We return
+    None if the digest doesn't need updating.
+    """
+    if week_digest is None:
+        week_digest = models.WeeklyDigest(
+            key_name=_key_name(snippet.week),
+            format_version=_PENDING_FORMAT_VERSION)
+    elif week_digest.format_version not in (_FORMAT_VERSION,
+                                            _PENDING_FORMAT_VERSION):
+        # We can't read the old format; start a placeholder.  Bumping
+        # the revision keeps a rebuild in progress from being saved.
+        week_digest = models.WeeklyDigest(
+            key_name=_key_name(snippet.week),
+            format_version=_PENDING_FORMAT_VERSION,
+            revision=week_digest.revision)
+
+    category_list = json.loads(week_digest.categories_json)
+    for (_, entries) in category_list:
+        for entry in entries:
+            if entry['email'] == snippet.email:
+                if (entry['has_snippet'] and
+                        entry['private'] == bool(snippet.private)):
+                    return None     # nothing has changed
+                entry['has_snippet'] = True
+                entry['private'] = bool(snippet.private)
+                break
+        else:
+            continue
+        break
+    else:
+        # This is the first we've heard of this author.
+        user = directory.make_entry(user) if user else None
+        category = _category(user)
+        i = bisect.bisect_left([c for (c, _) in category_list], category)
+        if i == len(category_list) or category_list[i][0] != category:
+            category_list.insert(i, [category, []])
+        entries = category_list[i][1]
+        j = bisect.bisect_left([e['email'] for e in entries], snippet.email)
+        entries.insert(j, _entry(snippet.email, user, True,
+                                 bool(snippet.private)))
+
+    week_digest.categories_json = json.dumps(category_list)
+    week_digest.revision += 1
+    return week_digest
+
+
+def update_for_snippet(email, week):
+    """Update week's digest to account for email's snippet for the week.
+
+    util.update_snippet() queues a task to call this whenever it adds
+    a snippet or changes whether it's private.  We read the snippet
+    as it is now, so it doesn't matter if these run out of order.
+    """
+    snippet = models.Snippet.get_by_key_name(
+        models.Snippet.make_key_name(email, week))
+    if snippet is None:
+        return
+    user = models.User.get_by_key_name(models.User.make_key_name(email))
+
+    def txn():
+        week_digest = _updated_for_snippet(
+            models.WeeklyDigest.get_by_key_name(_key_name(week)),
+            snippet, user)
+        if week_digest:
+            week_digest.put()
+
+    db.run_in_transaction(txn)
+
+
+def snippets_generation(week):
+    """Return the current generation of week's snippets, or None.
+
+    Like directory.generation(), this lives in memcache, and is None
+    if memcache is unavailable.
+    """
+    key = _SNIPPETS_GENERATION_KEY % _key_name(week)
+    retval = memcache.get(key)
+    if retval is None:
+        # Start a new generation, higher than any we handed out before
+        # the old one was evicted.
+        memcache.add(key, int(time.time() * 1000000))
+        retval = memcache.get(key)
+    return retval
+
+
+def bump_snippets(week):
+    """Note that one of week's snippets has been saved.
+
+    Call this *after* writing the snippet to the datastore.
+    """
+    memcache.incr(_SNIPPETS_GENERATION_KEY % _key_name(week))
@@ -0,0 +1,151 @@
+"""A cached snapshot of every user, for pages that need the whole roster.
+
+/weekly (via digest.py), /admin/manage_users and the email crons all
+need to know about every user.  Rather than each doing a query over
+all users, they call get(), which returns a compact, read-only list
+of DirectoryEntry tuples.
+
+The snapshot is cached in instance memory and in memcache, keyed by
+a generation number that is incremented, via bump(), whenever a
+user is written.  The generation number itself lives in memcache.
+If it's evicted we start a new (higher) one, which just means the
+snapshot gets rebuilt.
+
+The query over all users is eventually consistent, so right after a
+bump() it may not reflect the write that caused it.  So bump() also
+notes, in memcache, which user was written, and get() reads the
+users written recently by key, rather than trusting the query for
+them.
+"""
+
+import collections
+import re
+import time
+
+from google.appengine.api import memcache
+
+from google.appengine.ext import db
+
+import models
+
+
+DirectoryEntry = collections.namedtuple('DirectoryEntry', [
+    'email',
+    'display_name',
+    'category',            # title-cased; see _title_case()
+    'is_hidden',
+    'wants_email',
+    'created',
+])
+
+# generation is None if memcache is unavailable; entries is a list of
+# DirectoryEntry, sorted by email.
+Snapshot = collections.namedtuple('Snapshot', ['generation', 'entries'])
+
+_GENERATION_KEY = 'user_directory:generation'
+_SNAPSHOT_KEY = 'user_directory:snapshot:%s'
+# The email of the user whose write started the given generation.
+_WRITTEN_KEY = 'user_directory:written:%s'
+
+# How long, and for how many generations, we keep track of which
+# users were written.  The datastore's indexes usually catch up with
+# a write within a few seconds.
+_RECENT_WRITE_SECONDS = 60
+_RECENT_WRITE_GENERATIONS = 100
+
+# The newest snapshot this instance has seen.
+_instance_snapshot = Snapshot(None, None)
+
+
+def _title_case(s):
+    """Like string.title(), but does not uppercase 'and'."""
+    # Smarter would be to use 'pip install titlecase'.
+    SMALL = 'a|an|and|as|at|but|by|en|for|if|in|of|on|or|the|to|v\.?|via|vs\.?'
+    # We purposefully don't match small words at the beginning of a string.
+    SMALL_RE = re.compile(r' (%s)\b' % SMALL, re.I)
+    return SMALL_RE.sub(lambda m: ' ' + m.group(1).lower(), s.title().strip())
+
+
+def make_entry(user):
+    """Return the DirectoryEntry for the given models.User."""
+    return DirectoryEntry(
+        email=user.email,
+        display_name=user.display_name or '',
+        # People aren't very good about capitalizing their
+        # categories consistently, so we enforce title-case,
+        # with exceptions for 'and'.
+        category=_title_case(user.category or models.NULL_CATEGORY),
+        is_hidden=bool(user.is_hidden),
+        wants_email=bool(user.wants_email),
+        created=user.created)
+
+
+def generation():
+    """Return the current generation of the directory, or None."""
+    retval = memcache.get(_GENERATION_KEY)
+    if retval is None:
+        # Start a new generation.  We number it by the current time
+        # so it's higher than any we handed out before the old one
+        # was evicted.
+        memcache.add(_GENERATION_KEY, int(time.time() * 1000000))
+        retval = memcache.get(_GENERATION_KEY)
+    return retval
+
+
+def bump(email=None):
+    """Note that a user has been added, deleted or changed.
+
+    Call this *after* writing the user to the datastore.  email is
+    the email of that user, if there is just one.
+    """
+    # If the generation has been evicted, there's nothing to do:
+    # the next generation() call will start a new one.
+    new_generation = memcache.incr(_GENERATION_KEY)
+    if new_generation is not None and email is not None:
+        memcache.set(_WRITTEN_KEY % new_generation, email,
+                     time=_RECENT_WRITE_SECONDS)
+
+
+def _read_users(current_generation):
+    """Return all the users, including any written recently."""
+    # run() starts the query in the background.
+    user_keys = models.User.all(keys_only=True).run(limit=1000,
+                                                     batch_size=1000)
+    recent_emails = []
+    if current_generation is not None:
+        recent_emails = memcache.get_multi(
+            [_WRITTEN_KEY % g for g in xrange(
+                current_generation - _RECENT_WRITE_GENERATIONS + 1,
+                current_generation + 1)]).values()
+    keys = set(user_keys)
+    keys.update(db.Key.from_path('User', models.User.make_key_name(email))
+                for email in recent_emails)
+    # A get by key is strongly consistent, so this has the latest
+    # version of each user (and None for users since deleted).
+    return [user for user in db.get(list(keys)) if user]
+
+
+def get():
+    """Return a Snapshot of all users."""
+    global _instance_snapshot
+    current_generation = generation()
+    if (current_generation is not None and
+            _instance_snapshot.generation == current_generation):
+        return _instance_snapshot
+
+    entries = None
+    if current_generation is not None:
+        entries = memcache.get(_SNAPSHOT_KEY % current_generation)
+    if entries is None:
+        # Note we got the generation before reading the users, so if
+        # a user changes while we're building this, the generation
+        # will have moved on and the snapshot won't be used for long.
+        entries = sorted(make_entry(u)
+                         for u in _read_users(current_generation))
+        if current_generation is not None:
+            memcache.set(_SNAPSHOT_KEY % current_generation, entries)
+
+    snapshot = Snapshot(current_generation, entries)
+    if current_generation is not None:
+        _instance_snapshot = snapshot
+    return snapshot
@@ -0,0 +1,196 @@
+"""Latency histograms, for seeing how long things take in production.
+
+record() adds a timing to a named histogram, and histogram() and
+stats() read one back.  measure() times a block of code, counting
+the RPCs it makes and whether it raised, and records all of that.
+
+We add up the counts in instance memory, and flush them to memcache
+every _FLUSH_INTERVAL seconds, so that recording a timing doesn't
+cost an RPC of its own on every request.  In memcache the counts are
+kept per _WINDOW_SECONDS window, and we read back the last
+_NUM_WINDOWS of them, so the histograms show the last hour or so
+rather than all time.  The counts are shared by all instances (once
+flushed), and are lost (harmlessly) if memcache is flushed.
+"""
+
+import collections
+import contextlib
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+
+# The upper bounds of the histogram buckets, in milliseconds.  Slack
+# gives up on a slash command that takes longer than 3 seconds.
+BUCKETS_MS = (100, 250, 500, 1000, 2000, 3000, 5000, 10000)
+
+# The services whose RPCs measure() counts.
+RPC_SERVICES = ('datastore_v3', 'memcache', 'urlfetch')
+
+_WINDOW_SECONDS = 600
+_NUM_WINDOWS = 6
+_FLUSH_INTERVAL = 10
+
+# Tests can replace this to control the time.
+_TIME_FN = time.time
+
+# latency:<window>:<name>:<bucket upper bound, 'errors' or 'rpc.service'>
+_KEY = 'latency:%d:%s:%s'
+
+# Counts we haven't flushed to memcache yet, keyed by memcache key.
+_pending = collections.Counter()
+_pending_lock = threading.Lock()
+_last_flush = [0]
+
+
+def _bucket(ms):
+    for upper_bound in BUCKETS_MS:
+        if ms <= upper_bound:
+            return upper_bound
+    return None
+
+
+def _current_window():
+    return int(_TIME_FN() // _WINDOW_SECONDS)
+
+
+def flush():
+    """Add this instance's pending counts to the counts in memcache."""
+    with _pending_lock:
+        deltas = dict(_pending)
+        _pending.clear()
+        _last_flush[0] = _TIME_FN()
+    if deltas:
+        # If memcache is down, we lose these counts; that's ok.
+        memcache.offset_multi(deltas, initial_value=0)
+
+
+def record(name, seconds, rpcs=None, error=False):
+    """Add a timing of the given number of seconds to the named histogram.
+
+    rpcs, if given, maps a service name to how many RPCs were made to
+    it; error says whether the thing we timed failed.
+    """
+    window = _current_window()
+    with _pending_lock:
+        _pending[_KEY % (window, name, _bucket(seconds * 1000))] += 1
+        if error:
+            _pending[_KEY % (window, name, 'errors')] += 1
+        for (service, count) in (rpcs or {}).iteritems():
+            _pending[_KEY % (window, name, 'rpc.' + service)] += count
+        needs_flush = _TIME_FN() - _last_flush[0] >= _FLUSH_INTERVAL
+    if needs_flush:
+        flush()
+
+
+def _get_counts(name, fields):
+    """Return a map from field to its count over the recent windows."""
+    flush()        # so that we see what this instance has recorded
+    window = _current_window()
+    keys = [(field, _KEY % (w, name, field))
+            for field in fields
+            for w in xrange(window - _NUM_WINDOWS + 1, window + 1)]
+    values = memcache.get_multi([key for (_, key) in keys])
+    counts = collections.Counter()
+    for (field, key) in keys:
+        counts[field] += int(values.get(key, 0))
+    return counts
+
+
+def histogram(name):
+    """Return the named histogram as a list of (upper bound, count) pairs.
+
+    The upper bound is in milliseconds, or None for the last bucket,
+    which holds everything slower than the highest of BUCKETS_MS.
+    """
+    upper_bounds = BUCKETS_MS + (None,)
+    counts = _get_counts(name, upper_bounds)
+    return [(b, counts[b]) for b in upper_bounds]
+
+
+def percentile(hist, fraction):
+    """Return the bucket of histogram() output holding the given percentile.
+
+    That is, the upper bound (in ms) that the given fraction of the
+    timings are at or under: None if that's more than any of
+    BUCKETS_MS, or 0 if there are no timings at all.
+    """
+    total = sum(count for (_, count) in hist)
+    if not total:
+        return 0
+    seen = 0
+    for (upper_bound, count) in hist:
+        seen += count
+        if seen >= total * fraction:
+            return upper_bound
+    return None
+
+
+def stats(name):
+    """Return a dict of everything we know about the named timings.
+
+    This has 'histogram', as from histogram(); 'count', the number of
+    timings; 'errors', how many of them failed; and 'rpcs', a map
+    from each of RPC_SERVICES to the number of RPCs made to it.
+    """
+    upper_bounds = BUCKETS_MS + (None,)
+    rpc_fields = ['rpc.' + service for service in RPC_SERVICES]
+    counts = _get_counts(name, upper_bounds + ('errors',) + tuple(rpc_fields))
+    hist = [(b, counts[b]) for b in upper_bounds]
+    return {
+        'histogram': hist,
+        'count': sum(count for (_, count) in hist),
+        'errors': counts['errors'],
+        'rpcs': dict((service, counts['rpc.' + service])
+                     for service in RPC_SERVICES),
+    }
+
+
+# The RPC counts for the measure() block running in each thread.
+_rpc_counts = threading.local()
+
+
+def _count_rpc(service, call, request, response):
+    counts = getattr(_rpc_counts, 'counts', None)
+    if counts is not None:
+        counts[service] += 1
+
+
+class _Measurement(object):
+    """What measure() yields: set .error to record a failure."""
+    def __init__(self):
+        self.error = False
+
+
+@contextlib.contextmanager
+def measure(name):
+    """Record how long the with-block takes, and the RPCs it makes.
+
+    This yields a _Measurement; a block that sets its .error, or that
+    raises, is recorded as an error.  RPCs made in other threads
+    aren't counted.
+    """
+    # Appending is a noop if the hook is already there.  We do it
+    # here rather than once, since tests replace the apiproxy.
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'latency_rpc_counter', _count_rpc)
+    outer_counts = getattr(_rpc_counts, 'counts', None)
+    _rpc_counts.counts = collections.Counter()
+    measurement = _Measurement()
+    start = time.time()
+    try:
+        yield measurement
+    except:
+        measurement.error = True
+        raise
+    finally:
+        elapsed = time.time() - start
+        counts = _rpc_counts.counts
+        _rpc_counts.counts = outer_counts
+        if outer_counts is not None:    # the outer block made these too
+            outer_counts.update(counts)
+        record(name, elapsed,
+               rpcs=dict((s, counts[s]) for s in RPC_SERVICES),
+               error=measurement.error)
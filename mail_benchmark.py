@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""Benchmark how fast we can get the cron emails out.
+
+First, we time the per-recipient cost of preparing the bodies of
+the 'view' email for _NUM_USERS recipients, half of whom have
+snippets:
+
+* the old way: getting the Jinja2 environment and rendering the
+  template once per recipient;
+* snippets._render_snippets_mail(), which renders each distinct
+  body once and looks the rest up in its cache.
+
+Then we run the reminder cron for _NUM_USERS users without
+snippets, and send the emails it queues through a few mailer.py
+transports, talking to an SMTP server on localhost that throws away
+everything it gets.  We report messages/sec for each.  Since the
+server is local, this measures our per-message overhead and the
+number of round-trips, not the network.
+
+Run this via 'make bench'.
+"""
+
+import base64
+import logging
+import os
+import SocketServer
+import sys
+import threading
+import time
+
+# Update sys.path so it can find these.  We just need to add
+# 'google_appengine', but we add all of $PATH to be easy.  This
+# assumes the google_appengine directory is on the path.
+sys.path.extend(os.environ['PATH'].split(':'))
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+from webapp2_extras import jinja2
+import webtest   # may need to do 'pip install webtest'
+
+import mailer
+import models
+import snippets
+
+
+# The user directory holds at most 1000 users, so that's as many as
+# the crons will email.
+_NUM_USERS = 1000
+_NUM_RUNS = 10
+_HOSTNAME = 'https://example.com'
+
+
+def _recipients():
+    return [('user%d@example.com' % i, {'has_snippets': i % 2 == 0,
+                                         'hostname': _HOSTNAME})
+            for i in xrange(_NUM_USERS)]
+
+
+def _render_per_recipient(recipients):
+    for (_, template_values) in recipients:
+        jinja2.get_jinja2().render_template('view_email.txt',
+                                            **template_values)
+
+
+def _render_per_variant(recipients):
+    body_cache = {}
+    for (_, template_values) in recipients:
+        snippets._render_snippets_mail(body_cache, 'view_email.txt',
+                                       template_values)
+
+
+def _time(fn, recipients):
+    """Return the fastest of _NUM_RUNS runs of fn, in seconds."""
+    times = []
+    for _ in xrange(_NUM_RUNS):
+        start = time.time()
+        fn(recipients)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def _benchmark_rendering():
+    # get_jinja2() caches its environment in the current app.
+    snippets.application.set_globals(app=snippets.application)
+    recipients = _recipients()
+    _render_per_recipient(recipients[:1])     # compile the template
+
+    print '%d recipients, best of %d runs' % (_NUM_USERS, _NUM_RUNS)
+    for (name, fn) in (('render per recipient', _render_per_recipient),
+                       ('_render_snippets_mail', _render_per_variant)):
+        print '%-40s %7.1f us/recipient' % (
+            name, _time(fn, recipients) * 1000000 / _NUM_USERS)
+
+
+class _SmtpSinkHandler(SocketServer.StreamRequestHandler):
+    """Speak just enough SMTP to accept, and discard, any message."""
+
+    def handle(self):
+        self.wfile.write('220 localhost SMTP sink\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == 'EHLO':
+                self.wfile.write('250-localhost\r\n250 PIPELINING\r\n')
+            elif command == 'DATA':
+                self.wfile.write('354 End data with <CR><LF>.<CR><LF>\r\n')
+                while self.rfile.readline() not in ('.\r\n', ''):
+                    pass
+                self.wfile.write('250 OK\r\n')
+            elif command == 'QUIT':
+                self.wfile.write('221 Bye\r\n')
+                return
+            else:        # HELO, MAIL, RCPT, RSET, NOOP
+                self.wfile.write('250 OK\r\n')
+
+
+def _start_smtp_sink():
+    """Start an SMTP sink on localhost, and return its port."""
+    server = SocketServer.ThreadingTCPServer(('localhost', 0),
+                                             _SmtpSinkHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server.server_address[1]
+
+
+def _run_reminder_cron(tb, request_fetcher):
+    """Run the reminder cron; return the bodies of the mail tasks it queues."""
+    taskqueue_stub = tb.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    request_fetcher.get('/admin/send_reminder_email')
+    # Big runs continue in a task on the default queue.
+    while taskqueue_stub.GetTasks('default'):
+        for task in taskqueue_stub.GetTasks('default'):
+            taskqueue_stub.DeleteTask('default', task['name'])
+            request_fetcher.get(task['url'])
+    return [base64.b64decode(task['body'])
+            for task in taskqueue_stub.GetTasks('mail')]
+
+
+def _benchmark_sending():
+    tb = testbed.Testbed()
+    tb.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    tb.init_datastore_v3_stub(consistency_policy=policy)
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.abspath(__file__)))
+    request_fetcher = webtest.TestApp(snippets.application)
+
+    models.AppSettings(key_name='global_settings',
+                       domains=['example.com'],
+                       hostname=_HOSTNAME,
+                       email_from='Snippets <snippets@example.com>').put()
+    db.put([models.User(key_name='user%d@example.com' % i,
+                        email='user%d@example.com' % i)
+            for i in xrange(_NUM_USERS)])
+
+    start = time.time()
+    task_bodies = _run_reminder_cron(tb, request_fetcher)
+    print
+    print 'reminder cron queued %d tasks in %.1f ms' % (
+        len(task_bodies), (time.time() - start) * 1000)
+
+    port = _start_smtp_sink()
+    transports = (
+        ('capture (no sending)', mailer.CaptureTransport()),
+        ('SMTP, connection per message',
+         mailer.SmtpTransport('localhost', port, reuse_connection=False,
+                              pipeline=False)),
+        ('SMTP, reused connection',
+         mailer.SmtpTransport('localhost', port, pipeline=False)),
+        ('SMTP, reused connection, pipelined',
+         mailer.SmtpTransport('localhost', port)),
+    )
+    old_transport = mailer.get_transport()
+    try:
+        for (name, transport) in transports:
+            mailer.set_transport(transport)
+            start = time.time()
+            for body in task_bodies:
+                request_fetcher.post('/admin/send_mail_batch', body)
+            elapsed = time.time() - start
+            if hasattr(transport, 'close'):
+                transport.close()
+            print '%-40s %7.0f messages/sec' % (name, _NUM_USERS / elapsed)
+    finally:
+        mailer.set_transport(old_transport)
+        tb.deactivate()
+
+
+def main():
+    logging.getLogger().setLevel(logging.WARNING)
+    _benchmark_rendering()
+    _benchmark_sending()
+
+
+if __name__ == '__main__':
+    main()
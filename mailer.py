@@ -0,0 +1,148 @@
+"""Ways of sending email.
+
+SendMailBatch sends the cron emails through whatever transport
+get_transport() returns.  In production that's the App Engine mail
+API; to measure or tune how fast we can send mail, you can plug in
+an SMTP server instead (see mail_benchmark.py), and CaptureTransport
+just remembers what it was asked to send.
+
+A transport has a single method, send(messages), which sends each
+Message in the list.
+"""
+
+import collections
+import email.mime.text
+import email.utils
+import logging
+import smtplib
+import threading
+
+from google.appengine.api import mail
+
+
+Message = collections.namedtuple('Message',
+                                 ['sender', 'to', 'subject', 'body'])
+
+
+class AppEngineTransport(object):
+    """Send mail via the App Engine mail API."""
+
+    def send(self, messages):
+        for message in messages:
+            mail.send_mail(sender=message.sender, to=message.to,
+                           subject=message.subject, body=message.body)
+
+
+class CaptureTransport(object):
+    """Don't send mail, but append it to self.sent."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, messages):
+        self.sent.extend(messages)
+
+
+class SmtpTransport(object):
+    """Send mail via an SMTP server.
+
+    If reuse_connection is true, we keep our connection to the server
+    open between calls to send(), rather than connecting for every
+    message.  If pipeline is true, and the server supports it (RFC
+    2920), we send the commands for each message in one go, rather
+    than waiting for the reply to each before sending the next.
+    """
+
+    def __init__(self, host, port=25, reuse_connection=True, pipeline=True):
+        self.host = host
+        self.port = port
+        self.reuse_connection = reuse_connection
+        self.pipeline = pipeline
+        self._connection = None
+        # We're threadsafe, so requests may share this transport.
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        connection = smtplib.SMTP(self.host, self.port)
+        connection.ehlo_or_helo_if_needed()
+        return connection
+
+    def _close_connection(self):
+        if self._connection is not None:
+            try:
+                self._connection.quit()
+            except smtplib.SMTPException:
+                pass
+            self._connection = None
+
+    def close(self):
+        """Close our connection to the server, if we have one open."""
+        with self._lock:
+            self._close_connection()
+
+    def _send_pipelined(self, connection, from_addr, to_addr, msg):
+        connection.send('MAIL FROM:%s\r\nRCPT TO:%s\r\nDATA\r\n'
+                        % (smtplib.quoteaddr(from_addr),
+                           smtplib.quoteaddr(to_addr)))
+        # We have to read every reply, even after an error, to keep
+        # in step with the server.
+        replies = [connection.getreply() for _ in xrange(3)]
+        if replies[2][0] != 354:
+            connection.rset()
+            (code, resp) = [r for r in replies if r[0] not in (250, 251)][0]
+            raise smtplib.SMTPResponseException(code, resp)
+        data = smtplib.quotedata(msg)
+        if not data.endswith('\r\n'):
+            data += '\r\n'
+        connection.send(data + '.\r\n')
+        (code, resp) = connection.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+
+    def _send_one(self, connection, message):
+        from_addr = email.utils.parseaddr(message.sender)[1]
+        mime_message = email.mime.text.MIMEText(
+            unicode(message.body).encode('utf-8'), 'plain', 'utf-8')
+        mime_message['From'] = message.sender
+        mime_message['To'] = message.to
+        mime_message['Subject'] = message.subject
+        if self.pipeline and connection.has_extn('pipelining'):
+            self._send_pipelined(connection, from_addr, message.to,
+                                 mime_message.as_string())
+        else:
+            connection.sendmail(from_addr, [message.to],
+                                mime_message.as_string())
+
+    def send(self, messages):
+        with self._lock:
+            for message in messages:
+                if self._connection is None:
+                    self._connection = self._connect()
+                try:
+                    try:
+                        self._send_one(self._connection, message)
+                    except smtplib.SMTPServerDisconnected:
+                        # The server may have timed out our idle
+                        # connection; try once more with a new one.
+                        logging.info('Reconnecting to %s:%s'
+                                     % (self.host, self.port))
+                        self._connection = self._connect()
+                        self._send_one(self._connection, message)
+                finally:
+                    if not self.reuse_connection:
+                        self._close_connection()
+
+
+_transport = AppEngineTransport()
+
+
+def get_transport():
+    """Return the transport to send mail with."""
+    return _transport
+
+
+def set_transport(transport):
+    """Send all mail through transport from now on, and return the old one."""
+    global _transport
+    (old_transport, _transport) = (_transport, transport)
+    return old_transport
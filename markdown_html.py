@@ -0,0 +1,261 @@
+"""Render snippet markdown to HTML, on the server.
+
+This handles the markdown that people actually write in snippets --
+paragraphs, lists (nested or not), headings, block quotes, code,
+emphasis, links and images -- the way the marked library we used to
+run in the browser does, with its 'sanitize' option on: any HTML in
+the snippet is escaped, not passed through.  Link and image urls
+have to be http, https or mailto (or relative).
+
+We render a snippet when it's saved, and store the HTML with it; see
+models.Snippet.set_text().  Bump VERSION whenever a change here would
+render some snippet differently, and then run the 'snippet_html'
+migration to re-render existing snippets.
+"""
+
+import re
+
+
+VERSION = 1
+
+
+def _escape(text):
+    return (text.replace('&', '&amp;').replace('<', '&lt;')
+            .replace('>', '&gt;').replace('"', '&quot;'))
+
+
+# --- Inline markup: emphasis, code, links and so forth.
+
+_CODE_SPAN_RE = re.compile(r'(`+)(.+?)\1', re.DOTALL)
+_IMAGE_RE = re.compile(r'!\[([^\]]*)\]\(\s*(\S+?)(?:\s+"[^"]*")?\s*\)')
+_LINK_RE = re.compile(r'\[([^\]]+)\]\(\s*(\S+?)(?:\s+"[^"]*")?\s*\)')
+_URL_RE = re.compile(r'\bhttps?://[^\s<>"]*[^\s<>"\'.,:;!?)\]]')
+_STRONG_RE = re.compile(r'\*\*(?=\S)(.+?)(?<=\S)\*\*|'
+                        r'\b__(?=\S)(.+?)(?<=\S)__\b', re.DOTALL)
+_EM_RE = re.compile(r'\*(?=\S)(.+?)(?<=\S)\*|'
+                    r'\b_(?=\S)(.+?)(?<=\S)_\b', re.DOTALL)
+_STRIKE_RE = re.compile(r'~~(?=\S)(.+?)(?<=\S)~~', re.DOTALL)
+_SAFE_URL_RE = re.compile(r'^(https?:|mailto:|[^:]*$)', re.IGNORECASE)
+# Where we've set aside some already-rendered html; see _inline().
+_PLACEHOLDER_RE = re.compile('\x00(\\d+)\x00')
+
+
+def _safe_url(url):
+    """Return the url, escaped, or None if it's javascript: or the like."""
+    if not _SAFE_URL_RE.match(url):
+        return None
+    return _escape(url)
+
+
+def _inline(text, set_aside=None):
+    """Render the inline markup in a paragraph or the like to html.
+
+    set_aside is for rendering link text: it's the caller's list of
+    set-aside html, which the placeholders in text refer to.  (Link
+    text can't hold links, so we don't auto-link urls in it.)
+    """
+    # We render code spans, links and urls first, and set the
+    # resulting html aside, so that the escaping and emphasis we do
+    # next doesn't touch it (or the underscores in urls, say).
+    in_link = set_aside is not None
+    if set_aside is None:
+        set_aside = []
+
+    def set_aside_html(html):
+        set_aside.append(html)
+        return '\x00%d\x00' % (len(set_aside) - 1)
+
+    def code_span(m):
+        return set_aside_html('<code>%s</code>'
+                              % _escape(m.group(2).strip()))
+
+    def image(m):
+        url = _safe_url(m.group(2))
+        if url is None:
+            return m.group(0)
+        return set_aside_html('<img src="%s" alt="%s">'
+                              % (url, _escape(m.group(1))))
+
+    def link(m):
+        url = _safe_url(m.group(2))
+        if url is None:
+            return m.group(0)
+        return set_aside_html('<a href="%s">%s</a>'
+                              % (url, _inline(m.group(1), set_aside)))
+
+    def bare_url(m):
+        url = _escape(m.group(0))
+        return set_aside_html('<a href="%s">%s</a>' % (url, url))
+
+    text = _CODE_SPAN_RE.sub(code_span, text)
+    text = _IMAGE_RE.sub(image, text)
+    text = _LINK_RE.sub(link, text)
+    if not in_link:
+        text = _URL_RE.sub(bare_url, text)
+
+    text = _escape(text)
+    text = _STRONG_RE.sub(
+        lambda m: '<strong>%s</strong>' % (m.group(1) or m.group(2)), text)
+    text = _EM_RE.sub(
+        lambda m: '<em>%s</em>' % (m.group(1) or m.group(2)), text)
+    text = _STRIKE_RE.sub(lambda m: '<del>%s</del>' % m.group(1), text)
+
+    # Set-aside html may itself hold placeholders (links in links).
+    while _PLACEHOLDER_RE.search(text):
+        text = _PLACEHOLDER_RE.sub(lambda m: set_aside[int(m.group(1))],
+                                   text)
+    return text
+
+
+# --- Block markup: paragraphs, lists, headings and so forth.
+
+_FENCE_RE = re.compile(r'^ {0,3}(```|~~~)')
+_HEADING_RE = re.compile(r'^ {0,3}(#{1,6})\s+(.*?)(?:\s+#+)?\s*$')
+_HR_RE = re.compile(r'^ {0,3}([-*_])(\s*\1){2,}\s*$')
+_BLOCKQUOTE_RE = re.compile(r'^ {0,3}> ?')
+_LIST_ITEM_RE = re.compile(r'^( {0,3})([-*+]|\d+[.)])(\s+|$)')
+_INDENTED_CODE_RE = re.compile(r'^( {4}|\t)')
+
+
+def _starts_block(line):
+    """Return true if line starts something other than a paragraph."""
+    return bool(_FENCE_RE.match(line) or _HEADING_RE.match(line) or
+                _HR_RE.match(line) or _BLOCKQUOTE_RE.match(line) or
+                _LIST_ITEM_RE.match(line))
+
+
+def _dedent(line, n):
+    """Remove up to n leading spaces from line."""
+    line = line.replace('\t', '    ')
+    stripped = line.lstrip(' ')
+    return line[min(n, len(line) - len(stripped)):]
+
+
+def _list(lines, i):
+    """Render the list starting at lines[i]; return (html, next i)."""
+    first = _LIST_ITEM_RE.match(lines[i])
+    ordered = first.group(2)[0].isdigit()
+    items = []           # the lines of each item, dedented
+    loose = False
+    indent = 0           # how far the current item's content is indented
+    while i < len(lines):
+        m = _LIST_ITEM_RE.match(lines[i])
+        if (m and m.group(2)[0].isdigit() == ordered and
+                (not items or len(m.group(1)) < indent)):
+            # The item's content, and any more lines of it, are
+            # indented this much.  Anything indented more is nested.
+            indent = len(m.group(1)) + len(m.group(2)) + 1
+            items.append([lines[i][len(m.group(0)):]])
+            i += 1
+        elif not lines[i].strip():
+            # A blank line ends the list, unless an item (or more of
+            # this one) follows.
+            j = i
+            while j < len(lines) and not lines[j].strip():
+                j += 1
+            if j == len(lines):
+                break
+            m = _LIST_ITEM_RE.match(lines[j])
+            if m and m.group(2)[0].isdigit() == ordered:
+                loose = True
+                i = j
+            elif lines[j].startswith(' ' * indent) or lines[j][0] == '\t':
+                items[-1].extend([''] * (j - i))
+                loose = True
+                i = j
+            else:
+                break
+        elif (lines[i].startswith(' ') or lines[i].startswith('\t') or
+              not _starts_block(lines[i])):
+            # More of this item: either indented, or a lazy paragraph
+            # continuation line.
+            items[-1].append(_dedent(lines[i], indent))
+            i += 1
+        else:
+            break
+
+    html = []
+    for item_lines in items:
+        item_html = _blocks(item_lines)
+        if not loose and item_html.startswith('<p>'):
+            # A 'tight' list doesn't put its items in paragraphs.
+            item_html = re.sub(r'^<p>(.*?)</p>', r'\1', item_html,
+                               flags=re.DOTALL)
+        html.append('<li>%s</li>' % item_html)
+    tag = 'ol' if ordered else 'ul'
+    start = ''
+    if ordered:
+        number = int(first.group(2)[:-1])
+        if number != 1:
+            start = ' start="%d"' % number
+    return ('<%s%s>\n%s\n</%s>' % (tag, start, '\n'.join(html), tag), i)
+
+
+def _blocks(lines):
+    """Render a list of lines, which may hold several blocks, to html."""
+    html = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if not line.strip():
+            i += 1
+
+        elif _FENCE_RE.match(line):
+            fence = _FENCE_RE.match(line).group(1)
+            code = []
+            i += 1
+            while i < len(lines) and not lines[i].lstrip().startswith(fence):
+                code.append(lines[i])
+                i += 1
+            i += 1      # skip the closing fence
+            html.append('<pre><code>%s</code></pre>'
+                        % _escape('\n'.join(code)))
+
+        elif _INDENTED_CODE_RE.match(line):
+            code = []
+            while i < len(lines) and (_INDENTED_CODE_RE.match(lines[i]) or
+                                      not lines[i].strip()):
+                code.append(_dedent(lines[i], 4))
+                i += 1
+            html.append('<pre><code>%s</code></pre>'
+                        % _escape('\n'.join(code).rstrip('\n')))
+
+        elif _HEADING_RE.match(line):
+            m = _HEADING_RE.match(line)
+            level = len(m.group(1))
+            html.append('<h%d>%s</h%d>' % (level, _inline(m.group(2)), level))
+            i += 1
+
+        elif _HR_RE.match(line):
+            html.append('<hr>')
+            i += 1
+
+        elif _BLOCKQUOTE_RE.match(line):
+            quoted = []
+            while (i < len(lines) and lines[i].strip() and
+                   (_BLOCKQUOTE_RE.match(lines[i]) or
+                    not _starts_block(lines[i]))):
+                quoted.append(_BLOCKQUOTE_RE.sub('', lines[i], count=1))
+                i += 1
+            html.append('<blockquote>\n%s\n</blockquote>' % _blocks(quoted))
+
+        elif _LIST_ITEM_RE.match(line):
+            (list_html, i) = _list(lines, i)
+            html.append(list_html)
+
+        else:
+            paragraph = [line.strip()]
+            i += 1
+            while (i < len(lines) and lines[i].strip() and
+                   not _starts_block(lines[i])):
+                paragraph.append(lines[i].strip())
+                i += 1
+            html.append('<p>%s</p>' % _inline('\n'.join(paragraph)))
+
+    return '\n'.join(html)
+
+
+def render(text):
+    """Return the html for the given markdown text."""
+    text = (text or '').replace('\r\n', '\n').replace('\x00', '')
+    return _blocks(text.split('\n'))
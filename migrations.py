@@ -0,0 +1,147 @@
+"""One-off migrations that bring existing datastore rows up to date.
+
+Each migration is a function that takes a datastore cursor (or None,
+to start from the beginning), processes one batch of entities, and
+returns a pair (number of entities processed, cursor to continue
+from).  The returned cursor is None when there's nothing left to do.
+
+Migrations are run via /admin/migrate?name=<name>, which processes
+one batch and queues up a task to do the next one.  Every migration
+must be safe to run more than once, and safe to run while the site
+is live.
+"""
+
+from google.appengine.ext import db
+
+import digest
+import models
+import util
+
+
+_BATCH_SIZE = 100
+# How many times to recount a user's snippets that keep changing.
+_BACKFILL_ATTEMPTS = 3
+
+
+def _run_batch(query, cursor, fn):
+    """Call fn on each entity in the next batch of query; return the result.
+
+    The result is a (num_processed, next_cursor) pair, as described in
+    the module docstring.
+    """
+    if cursor:
+        query.with_cursor(cursor)
+    batch = query.fetch(_BATCH_SIZE)
+    for entity in batch:
+        fn(entity)
+    if len(batch) < _BATCH_SIZE:
+        return (len(batch), None)
+    return (len(batch), query.cursor())
+
+
+def rekey_snippets(cursor):
+    """Move snippets with auto-assigned ids to their email+week keys."""
+    def rekey(snippet):
+        if snippet.key().name() is None:
+            util.rekey_snippet(snippet)
+
+    return _run_batch(models.Snippet.all(), cursor, rekey)
+
+
+def rekey_users(cursor):
+    """Move users with auto-assigned ids to their email keys."""
+    def rekey(user):
+        if user.key().name() != models.User.make_key_name(user.email):
+            util.rekey_user(user)
+
+    return _run_batch(models.User.all(), cursor, rekey)
+
+
+def backfill_user_snippet_stats(cursor):
+    """Set last_snippet_week and num_snippet_weeks on every user.
+
+    Run this after snippet_keys and user_keys are done.
+    """
+    def backfill_once(user_key):
+        """Return False if a snippet was saved while we were counting."""
+        # We can't query snippets inside the user's transaction, so we
+        # count them outside it.  util.update_snippet() changes the
+        # stats whenever it adds a snippet, so if they've changed by
+        # the time we write, our count may be stale.
+        user = models.User.get(user_key)
+        if user is None:
+            return True
+        stats_before = (user.num_snippet_weeks, user.last_snippet_week)
+        num_snippet_weeks = models.Snippet.all(keys_only=True).filter(
+            'email =', user.email).count(limit=None)
+        last_snippet = util.most_recent_snippet_for_user(user.email)
+        last_snippet_week = last_snippet.week if last_snippet else None
+
+        def txn():
+            u = models.User.get(user_key)
+            if u is None:     # deleted out from under us
+                return True
+            if (u.num_snippet_weeks, u.last_snippet_week) != stats_before:
+                return False
+            if (u.num_snippet_weeks != num_snippet_weeks or
+                    u.last_snippet_week != last_snippet_week):
+                u.num_snippet_weeks = num_snippet_weeks
+                u.last_snippet_week = last_snippet_week
+                u.put()
+            return True
+
+        return db.run_in_transaction(txn)
+
+    def backfill(user):
+        for _ in xrange(_BACKFILL_ATTEMPTS):
+            if backfill_once(user.key()):
+                return
+        # The task will be retried, and try again.
+        raise db.TransactionFailedError(
+            'Snippets kept changing while counting them for %s' % user.email)
+
+    return _run_batch(models.User.all(), cursor, backfill)
+
+
+def rebuild_weekly_digests(cursor):
+    """Rebuild the WeeklyDigest for every week that has snippets.
+
+    Digests are otherwise only built when someone looks at a week,
+    so this is useful for filling in historical weeks, or after
+    making a change to what goes in a digest.
+    """
+    query = db.Query(models.Snippet, projection=('week',), distinct=True)
+    query.order('week')
+    return _run_batch(query, cursor, lambda s: digest.rebuild(s.week))
+
+
+def render_snippets_html(cursor):
+    """Render the html for every snippet that needs it.
+
+    That's snippets from before we rendered markdown on the server,
+    and every snippet after a change to markdown_html.VERSION.
+    """
+    def render(snippet):
+        if snippet.rendered_html() is not None:
+            return
+
+        def txn():
+            s = models.Snippet.get(snippet.key())
+            # Someone may have saved the snippet since we read it.
+            if s is not None and s.render_html():
+                s.put()
+
+        db.run_in_transaction(txn)
+        digest.bump_snippets(snippet.week)   # so /weekly shows the html
+
+    return _run_batch(models.Snippet.all(), cursor, render)
+
+
+# Map from migration name (as passed to /admin/migrate) to function.
+MIGRATIONS = {
+    'snippet_keys': rekey_snippets,
+    'user_keys': rekey_users,
+    'user_snippet_stats': backfill_user_snippet_stats,
+    'weekly_digests': rebuild_weekly_digests,
+    'snippet_html': render_snippets_html,
+}
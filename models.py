@@ -1,9 +1,16 @@
 import datetime
 import hashlib
+import json
 import os
+import re
 
-from google.appengine.ext import db
+from google.appengine.api import memcache
 from google.appengine.api import users
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import db
+import webapp2
+
+import markdown_html
 
 
 NULL_CATEGORY = '(unknown)'
@@ -34,6 +41,19 @@ class User(db.Model):
     # TODO(csilvers): make a ListProperty instead.
     wants_to_view = db.TextProperty(default='all')     # comma-separated list
     display_name = db.TextProperty(default='')         #  display name of the user
+    # These are denormalized from the user's snippets, and are kept
+    # up to date by util.update_snippet().
+    last_snippet_week = db.DateProperty()          # newest week with a snippet
+    num_snippet_weeks = db.IntegerProperty(default=0)  # weeks with a snippet
+
+    @staticmethod
+    def make_key_name(email):
+        """Return the key name for the user with the given email.
+
+        Users are keyed by their (lowercased) email address, so looking
+        up a user is a single get rather than a query.
+        """
+        return email.lower()
 
 
 class Snippet(db.Model):
@@ -46,6 +66,18 @@ class Snippet(db.Model):
     text = db.TextProperty()
     private = db.BooleanProperty(default=False)       # snippet is private?
     is_markdown = db.BooleanProperty(default=False)   # text is markdown?
+    # If the text is a markdown list and nothing else, this is a JSON
+    # list of the items, so we needn't parse the text to get at them;
+    # if it's anything else, this is 'null'.  It's None for snippets
+    # written before we kept this.  Use set_text() and set_items() to
+    # keep it in sync with the text.
+    items_json = db.TextProperty()
+    # The text rendered from markdown to html (see markdown_html.py),
+    # and a hash of the text and renderer version it was rendered
+    # from, so we know when it's out of date.  set_text() and
+    # set_items() keep these up to date too.
+    html = db.TextProperty()
+    html_hash = db.StringProperty(indexed=False)
 
     @property
     def email_md5_hash(self):
@@ -53,6 +85,160 @@ class Snippet(db.Model):
         m.update(self.email)
         return m.hexdigest()
 
+    @staticmethod
+    def make_key_name(email, week):
+        """Return the key name for email's snippet for the given week.
+
+        Snippets are keyed by 'email|week' (email lowercased, week as
+        an ISO date), so the snippet for a given user and week can be
+        fetched with a single get rather than a query.
+        """
+        return '%s|%s' % (email.lower(), week.isoformat())
+
+    @staticmethod
+    def email_from_key_name(key_name):
+        """Return the (lowercased) email part of a snippet's key name."""
+        return key_name.rsplit('|', 1)[0]
+
+    def set_text(self, text):
+        """Set the snippet's text, and the items if it's a markdown list."""
+        self.text = text
+        self.items_json = json.dumps(_parse_markdown_list(text))
+        self.render_html()
+
+    def set_items(self, items):
+        """Set the snippet's text to a markdown list of the given items."""
+        self.text = '\n'.join('- %s' % item for item in items)
+        self.items_json = json.dumps(items)
+        self.render_html()
+
+    def _html_hash(self):
+        text = self.text or ''
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        return hashlib.sha1(
+            '%s:%s' % (markdown_html.VERSION, text)).hexdigest()
+
+    def render_html(self):
+        """Render the text to html, unless we already have.
+
+        Returns true if we rendered it (so the snippet needs a put()).
+        """
+        html_hash = self._html_hash()
+        if self.html_hash == html_hash:
+            return False
+        self.html = markdown_html.render(self.text)
+        self.html_hash = html_hash
+        return True
+
+    def rendered_html(self):
+        """Return the text rendered to html, or None if we haven't yet."""
+        if self.html_hash != self._html_hash():
+            return None
+        return self.html
+
+    def get_items(self):
+        """Return the items in the snippet, or None if it's not a list.
+
+        For this, the text must be a markdown list and nothing else,
+        with one item per line.
+        """
+        if self.items_json is None:       # an old snippet
+            return _parse_markdown_list(self.text)
+        return json.loads(self.items_json)
+
+
+def _parse_markdown_list(text):
+    """Return the items of a markdown list, or None if text isn't one.
+
+    We don't support "indented" list style, only one item per line.
+    Empty text is an empty list.
+    """
+    text = text and text.strip()
+    if not text:
+        return []
+    items = re.findall(r'^[-*+] +(.*)$', text, re.MULTILINE)
+    # If there were any lines that didn't yield an item, there was
+    # something there other than a list.
+    if len(items) < len(text.splitlines()):
+        return None
+    return items
+
+
+class Migration(db.Model):
+    """Records that a one-off data migration has finished.
+
+    The key name is the name of the migration (see migrations.py).
+    Code that has to cope with not-yet-migrated rows can check for
+    this entity to know when it can stop doing so.
+    """
+    finished = db.DateTimeProperty(auto_now_add=True)
+
+    # Lookups call is_finished() on every miss, so we cache it.  A
+    # migration never becomes unfinished, so once it's finished we
+    # remember that for good: in instance memory and in memcache.
+    # We don't cache 'not finished', which is what changes.
+    _MEMCACHE_KEY = 'Migration:finished:%s'
+    _known_finished = set()
+
+    @staticmethod
+    def is_finished(name):
+        if name in Migration._known_finished:
+            return True
+        finished = (memcache.get(Migration._MEMCACHE_KEY % name) or
+                    Migration.get_by_key_name(name) is not None)
+        if finished:
+            memcache.set(Migration._MEMCACHE_KEY % name, True)
+            Migration._known_finished.add(name)
+        return finished
+
+
+class WeeklyDigest(db.Model):
+    """Everything /weekly needs to know about a week, but the snippet text.
+
+    The key name is the week (a monday) as an ISO date.  This is
+    maintained by digest.py; see there for details.
+    """
+    # JSON: [[category, [entry, ...]], ...], sorted by category and
+    # then by email.  digest.py describes what's in an entry.
+    categories_json = db.TextProperty(default='[]')
+    format_version = db.IntegerProperty(default=0)
+    # The generation of the user directory (directory.py) this was built from
+    user_directory_token = db.StringProperty(default='')
+    revision = db.IntegerProperty(default=0)   # incremented on every change
+
+
+class MailRun(db.Model):
+    """Records how far an email cron has got in queueing its emails.
+
+    There is one of these per cron per week, so a cron that is
+    retried or re-run for a week picks up where it left off rather
+    than emailing people twice.  See snippets._send_mail_run().
+    """
+    created = db.DateTimeProperty(auto_now_add=True)
+    last_modified = db.DateTimeProperty(auto_now=True)
+    # We queue emails in order of recipient address; this is the last
+    # address we've queued an email for.
+    cursor = db.StringProperty(default='')
+    num_queued = db.IntegerProperty(default=0)
+    finished = db.DateTimeProperty()      # None until all emails are queued
+
+    @staticmethod
+    def make_key_name(cron_url, week):
+        """Return the key name for the given cron's run for the given week."""
+        return '%s|%s' % (cron_url, week.isoformat())
+
+
+class SlackUser(db.Model):
+    """The email address of a Slack user, as Slack last told us.
+
+    The key name is the Slack user id.  These are kept up to date by
+    slacklib.SyncSlackUsers, so that slash commands rarely need to
+    ask Slack who is calling them.
+    """
+    email = db.StringProperty(required=True)
+    last_synced = db.DateTimeProperty(auto_now=True)
+
 
 class AppSettings(db.Model):
     """Application-wide preferences."""
@@ -67,9 +253,66 @@ class AppSettings(db.Model):
     # Chat and email settings
     email_from = db.StringProperty(default='')
     slack_channel = db.StringProperty(default='')
+    # Post the week's snippets, not just a link to them, to slack_channel?
+    slack_post_digest = db.BooleanProperty(default=False)
     slack_token = db.StringProperty(default='')
     slack_slash_token = db.StringProperty(default='')
 
+    # The app settings are read by almost every request, and hardly
+    # ever change, so we cache them: in the request (so we read them
+    # at most once per request) and in memcache.  put() and delete()
+    # keep the caches up to date, except inside a transaction, where
+    # the caller must call clear_cache() once the transaction commits.
+    _MEMCACHE_KEY = 'AppSettings:global_settings'
+
+    @staticmethod
+    def _request_cache():
+        """Return a dict that lasts as long as this request, or None."""
+        try:
+            return webapp2.get_request().registry
+        except AssertionError:    # we're not in a request
+            return None
+
+    @staticmethod
+    def _get_cached():
+        request_cache = AppSettings._request_cache()
+        if request_cache is not None and 'app_settings' in request_cache:
+            return request_cache['app_settings']
+
+        encoded = memcache.get(AppSettings._MEMCACHE_KEY)
+        if encoded is not None:
+            retval = db.model_from_protobuf(entity_pb.EntityProto(encoded))
+        else:
+            retval = AppSettings.get_by_key_name('global_settings')
+            if retval:
+                # We use add() so that if someone changes the settings
+                # while we're here, we don't clobber clear_cache().
+                memcache.add(AppSettings._MEMCACHE_KEY,
+                             db.model_to_protobuf(retval).Encode())
+        if request_cache is not None and retval:
+            request_cache['app_settings'] = retval
+        return retval
+
+    @staticmethod
+    def clear_cache():
+        request_cache = AppSettings._request_cache()
+        if request_cache is not None:
+            request_cache.pop('app_settings', None)
+        # Locking the key for a few seconds keeps any request that read
+        # the old settings from the datastore from re-caching them.
+        memcache.delete(AppSettings._MEMCACHE_KEY, seconds=5)
+
+    def put(self, **kwargs):
+        retval = super(AppSettings, self).put(**kwargs)
+        if not db.is_in_transaction():
+            AppSettings.clear_cache()
+        return retval
+
+    def delete(self, **kwargs):
+        super(AppSettings, self).delete(**kwargs)
+        if not db.is_in_transaction():
+            AppSettings.clear_cache()
+
     @staticmethod
     def get(create_if_missing=False, domains=None):
         """Return the global app settings, or raise ValueError if none found.
@@ -78,8 +321,14 @@ class AppSettings(db.Model):
         are found, rather than raising a ValueError.  The app settings
         are initialized with the given value for 'domains'.  The new
         entity is *not* put to the datastore.
+
+        Outside of a transaction, this is served from cache when
+        possible; inside one, we always read from the datastore.
         """
-        retval = AppSettings.get_by_key_name('global_settings')
+        if db.is_in_transaction():
+            retval = AppSettings.get_by_key_name('global_settings')
+        else:
+            retval = AppSettings._get_cached()
         if retval:
             return retval
         elif create_if_missing:
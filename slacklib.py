@@ -17,19 +17,25 @@ token with each request.  We check this token for security reasons, so
 we get that from /admin/settings as well.
 """
 
+import collections
 import datetime
 import json
 import logging
 import re
 import os
+import random
 import textwrap
+import threading
+import time
 import urllib
-import urllib2
 import webapp2
 
-from google.appengine.ext import db
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.api import urlfetch
+from google.appengine.ext import db
 
+import latency
 import models
 import util
 
@@ -47,6 +53,116 @@ _TODAY_FN = datetime.datetime.now
 _WEB_URL = 'http://' + os.environ.get('SERVER_NAME', 'localhost')
 
 
+# Where we send Slack Web API calls; tests point this at a fake server.
+_SLACK_API_URL = 'https://slack.com/api/'
+
+# How long we wait for Slack to answer each try of a Web API call.
+_DEADLINE = 5                  # in seconds
+# We retry calls that time out, are rate-limited (429) or get a
+# server error (5xx), up to this many tries in all, with exponential
+# backoff (or as long as Slack's Retry-After header asks).  Calls
+# that do something, like posting a message, may have done it even
+# though they timed out or got a server error, so we only retry them
+# if they were rate-limited, which means Slack didn't act on them.
+_MAX_TRIES = 4
+_IDEMPOTENT_METHODS = frozenset(['users.info', 'users.list'])
+_BACKOFF_BASE = 0.5            # in seconds; doubles on each retry
+_MAX_RETRY_WAIT = 30           # in seconds; give up rather than wait longer
+
+# This allows mocking out waiting between retries, for testing.
+_SLEEP_FN = time.sleep
+
+
+class _WebApiCall(object):
+    """A Slack Web API call, which runs in the background until needed.
+
+    We use urlfetch RPCs, so several calls can be in flight at once
+    (urlfetch also takes care of reusing connections to Slack).
+    Call get_result() to wait for the call, retrying it if need be.
+    """
+
+    def __init__(self, api_method, payload):
+        self._url = _SLACK_API_URL + api_method
+        self._idempotent = api_method in _IDEMPOTENT_METHODS
+        self._body = urllib.urlencode(
+            dict((k, v.encode('utf-8') if isinstance(v, unicode) else v)
+                 for (k, v) in payload.iteritems()))
+        self._num_tries = 0
+        self._start()
+
+    def _start(self):
+        self._num_tries += 1
+        self._rpc = urlfetch.create_rpc(deadline=_DEADLINE)
+        urlfetch.make_fetch_call(
+            self._rpc, self._url, payload=self._body, method=urlfetch.POST,
+            headers={'Content-Type': 'application/x-www-form-urlencoded'})
+
+    def _retry_wait(self, retry_after):
+        """Return how many seconds to wait before trying again."""
+        wait = _BACKOFF_BASE * (2 ** (self._num_tries - 1))
+        wait *= random.uniform(0.5, 1.0)     # so retries don't bunch up
+        if retry_after:
+            try:
+                wait = max(wait, int(retry_after))
+            except ValueError:
+                pass
+        return wait
+
+    def get_result(self):
+        """Wait for the call to finish, and return Slack's reply (a dict).
+
+        Raises a ValueError if something goes wrong.
+        """
+        while True:
+            retry_after = None
+            rate_limited = False
+            try:
+                response = self._rpc.get_result()
+            except urlfetch.DownloadError, why:     # includes timeouts
+                error = why
+            else:
+                if (response.status_code == 429 or
+                        response.status_code >= 500):
+                    error = 'HTTP %s' % response.status_code
+                    retry_after = response.headers.get('Retry-After')
+                    rate_limited = response.status_code == 429
+                elif response.status_code != 200:
+                    raise ValueError(response.content)
+                else:
+                    # slack web API always returns either `"ok": true`
+                    # or `"error": "reason"`
+                    reply = json.loads(response.content)
+                    if not reply['ok']:
+                        raise ValueError('Slack error: %s' % reply['error'])
+                    return reply
+
+            if not rate_limited and not self._idempotent:
+                # We don't know if Slack acted on the call or not.
+                raise ValueError('Slack API call to %s failed, and may '
+                                 'not be safe to retry: %s'
+                                 % (self._url, error))
+            wait = self._retry_wait(retry_after)
+            if self._num_tries >= _MAX_TRIES or wait > _MAX_RETRY_WAIT:
+                raise ValueError('Slack API call to %s failed after %s '
+                                 'tries: %s' % (self._url, self._num_tries,
+                                                error))
+            logging.warning('Slack API call to %s failed (%s); retrying '
+                            'in %.1f seconds', self._url, error, wait)
+            _SLEEP_FN(wait)
+            self._start()
+
+
+def _web_api_async(api_method, payload):
+    """Start sending a payload to the Slack Web API; return a _WebApiCall.
+
+    This is like _web_api(), but returns at once.  Call get_result()
+    on the return value to get the response.
+    """
+    app_settings = models.AppSettings.get()
+    payload.setdefault('token', app_settings.slack_token)
+    return _WebApiCall(api_method, payload)
+
+
 def _web_api(api_method, payload):
     """Send a payload to the Slack Web API, automatically inserting token.
 
@@ -56,20 +172,7 @@ def _web_api(api_method, payload):
     Raises a ValueError if something goes wrong.
     Returns a dictionary with the response.
     """
-    app_settings = models.AppSettings.get()
-    payload.setdefault('token', app_settings.slack_token)
-    uri = 'https://slack.com/api/' + api_method
-    r = urllib2.urlopen(uri, urllib.urlencode(payload))
-
-    # check return code for server errors
-    if r.getcode() != 200:
-        raise ValueError(r.read())
-    # parse the JSON...
-    # slack web API always returns either `"ok": true` or `"error": "reason"`
-    reply = json.loads(r.read())
-    if not reply['ok']:
-        raise ValueError('Slack error: %s' % reply['error'])
-    return reply
+    return _web_api_async(api_method, payload).get_result()
 
 
 def _get_user_email(uid):
@@ -84,42 +187,308 @@ def _get_user_email(uid):
     return email
 
 
+_USER_EMAIL_KEY = 'slack_profile_email_'
+_USER_EMAIL_CACHE_TIME = 86400          # in seconds
+
+
+def _store_user_emails(uid_to_email):
+    """Store the given Slack users' emails in the datastore and memcache."""
+    db.put([models.SlackUser(key_name=uid, email=email)
+            for (uid, email) in uid_to_email.iteritems()])
+    failed_keys = memcache.set_multi(
+        dict((_USER_EMAIL_KEY + uid, email)
+             for (uid, email) in uid_to_email.iteritems()),
+        time=_USER_EMAIL_CACHE_TIME)
+    if failed_keys:
+        logging.error('memcache set failed for %s!', failed_keys)
+    for (uid, email) in uid_to_email.iteritems():
+        _local_email_cache.put(uid, email)
+
+
+def _stored_user_email(uid):
+    """Return the stored email for a Slack user id, or None.
+
+    We look in memcache, and then in the datastore (which
+    SyncSlackUsers fills in for every Slack user).
+    """
+    key = _USER_EMAIL_KEY + uid
+    email = memcache.get(key)
+    if email is None:
+        slack_user = models.SlackUser.get_by_key_name(uid)
+        if slack_user:
+            email = slack_user.email
+            memcache.set(key, email, time=_USER_EMAIL_CACHE_TIME)
+    return email
+
+
+# This allows mocking in a different time, for testing.
+_TIME_FN = time.time
+
+
+class _LocalEmailCache(object):
+    """An in-process LRU cache of Slack user id -> email.
+
+    This sits in front of memcache, so most lookups don't need an
+    RPC at all.  An entry is fresh for FRESH_TIME seconds.  After
+    that, we re-read it from memcache (or the datastore) before using
+    it, which costs an RPC, but only once per FRESH_TIME per user.
+    If it's in neither, we still use it: people rarely change their
+    email.  (We can't re-read it in a background thread instead: App
+    Engine waits for a request's threads before sending its response.)
+    Entries older than MAX_AGE are not used at all.
+    """
+    FRESH_TIME = 600                # in seconds
+    MAX_AGE = 86400                 # in seconds
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._entries = collections.OrderedDict()  # uid -> (email, time)
+        self._lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def get(self, uid):
+        """Return the email for the Slack user id, or None if we don't know."""
+        with self._lock:
+            entry = self._entries.pop(uid, None)
+            age = entry and _TIME_FN() - entry[1]
+            if entry is None or age > self.MAX_AGE:
+                self.stats['misses'] += 1
+                return None
+            self._entries[uid] = entry         # now the most recently used
+            if age <= self.FRESH_TIME:
+                self.stats['hits'] += 1
+                return entry[0]
+            self.stats['stale_hits'] += 1
+
+        return self._refresh(uid, entry[0])
+
+    def put(self, uid, email):
+        with self._lock:
+            self._entries.pop(uid, None)
+            self._entries[uid] = (email, _TIME_FN())
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)     # least recently used
+
+    def _refresh(self, uid, stale_email):
+        """Re-read a stale entry from memcache or the datastore."""
+        email = _stored_user_email(uid) or stale_email
+        self.put(uid, email)
+        with self._lock:
+            self.stats['refreshes'] += 1
+        return email
+
+
+_local_email_cache = _LocalEmailCache(max_size=5000)
+
+
+def email_cache_stats():
+    """Return this instance's hit/miss/refresh counts for email lookups."""
+    return dict(_local_email_cache.stats)
+
+
+def _cached_user_email(uid):
+    """Return the email for a Slack user id if we have it cached, else None.
+
+    We look in this instance's memory, and then in memcache and the
+    datastore.
+    """
+    email = _local_email_cache.get(uid)
+    if email is None:
+        email = _stored_user_email(uid)
+        if email is not None:
+            _local_email_cache.put(uid, email)
+    return email
+
+
 def _get_user_email_cached(uid, force_refresh=False):
     """Retrieve the email address for a specific user id, with a cache.
 
-    Results are stored in memcache for up to a day.
+    Results are cached in memory, in memcache for up to a day, and
+    in the datastore.
 
     If force_refresh parameter is specified, cached data will be refreshed.
 
     Raises ValueError if could not be retrieved.
     """
-    key = 'slack_profile_email_' + uid
-    cached_data = memcache.get(key)
-    if (cached_data is None) or force_refresh:
-        logging.debug("cache miss/refresh for slack email lookup %s", uid)
-        email = _get_user_email(uid)  # possible ValueError
-        if not memcache.set(key=key, value=email, time=86400):
-            logging.error('memcache set failed!')
-        return email
-    else:
-        logging.debug("cache hit for slack email lookup %s", uid)
-        return cached_data
+    if not force_refresh:
+        email = _cached_user_email(uid)
+        if email is not None:
+            logging.debug("cache hit for slack email lookup %s", uid)
+            return email
+
+    logging.debug("cache miss/refresh for slack email lookup %s", uid)
+    email = _get_user_email(uid)  # possible ValueError
+    _store_user_emails({uid: email})
+    return email
+
+
+# How many users we ask Slack for at a time when syncing.
+_SYNC_PAGE_SIZE = 200
+
+
+def sync_slack_users(cursor=None):
+    """Store the emails of one page of Slack users; see SyncSlackUsers.
+
+    cursor says which page to get; None means the first page.
+
+    Returns (the number of users stored, the cursor for the next
+    page).  The cursor is None when there are no more pages.
+
+    Raises ValueError if Slack gives us an error.
+    """
+    payload = {'limit': _SYNC_PAGE_SIZE}
+    if cursor:
+        payload['cursor'] = cursor
+    reply = _web_api('users.list', payload)
+
+    uid_to_email = {}
+    for member in reply.get('members', []):
+        email = member.get('profile', {}).get('email')
+        # Bots don't have emails.
+        if email and not member.get('deleted'):
+            uid_to_email[member['id']] = email
+    _store_user_emails(uid_to_email)
+
+    next_cursor = reply.get('response_metadata', {}).get('next_cursor')
+    return (len(uid_to_email), next_cursor or None)
+
+
+def _post_message(channel, msg, thread_ts=None):
+    """Post a message to a Slack channel, and return its timestamp.
+
+    If thread_ts is given, the message is a reply in that message's
+    thread.  Raises a ValueError if something goes wrong.
+    """
+    payload = {
+        'channel': channel,
+        'text': msg,
+        'username': 'Snippets',
+        'icon_emoji': ':pencil:',
+        'unfurl_links': False,    # no link previews, please
+    }
+    if thread_ts:
+        payload['thread_ts'] = thread_ts
+    return _web_api('chat.postMessage', payload).get('ts')
 
 
 def send_to_slack_channel(channel, msg):
     """Send a plaintext message to a Slack channel."""
     try:
-        _web_api('chat.postMessage', {
-            'channel': channel,
-            'text': msg,
-            'username': 'Snippets',
-            'icon_emoji': ':pencil:',
-            'unfurl_links': False,    # no link previews, please
-        })
+        _post_message(channel, msg)
     except ValueError, why:
         logging.error('Failed sending message to slack: %s', why)
 
 
+###################################
+### POSTING THE WEEK'S SNIPPETS ###
+###################################
+
+# Slack cuts off messages longer than 40,000 characters, and suggests
+# keeping them under 4,000.  So do we.
+_MAX_MESSAGE_LENGTH = 4000
+
+
+def _slack_escape(text):
+    """Escape the characters that Slack treats specially in a message."""
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _split_long_text(text, max_length):
+    """Split text into pieces of at most max_length, at newlines if we can."""
+    pieces = []
+    current = ''
+    for line in text.splitlines(True):
+        if current and len(current) + len(line) > max_length:
+            pieces.append(current)
+            current = ''
+        while len(line) > max_length:       # no newline to split at
+            pieces.append(line[:max_length])
+            line = line[max_length:]
+        current += line
+    if current:
+        pieces.append(current)
+    return [piece.rstrip('\n') for piece in pieces]
+
+
+def _chunk_messages(texts, max_length=_MAX_MESSAGE_LENGTH):
+    """Pack texts into as few messages as we can, each at most max_length.
+
+    Texts are separated by a blank line, and only split across
+    messages when a single text is longer than max_length.
+    """
+    messages = []
+    current = ''
+    for text in texts:
+        for piece in _split_long_text(text, max_length):
+            if current and len(current) + 2 + len(piece) <= max_length:
+                current += '\n\n' + piece
+            else:
+                if current:
+                    messages.append(current)
+                current = piece
+    if current:
+        messages.append(current)
+    return messages
+
+
+def _digest_task_name(week, category_index, message_index):
+    return 'slack-digest-%s-%d-%d' % (week.isoformat(), category_index,
+                                      message_index)
+
+
+def _queue_digest_messages(channel, week, category_index, message_index,
+                           messages, thread_ts=None):
+    """Queue a task to post messages[0], and then the rest of messages.
+
+    The tasks are named after the week and message, so if we're asked
+    to post the same message twice (say, because the cron that started
+    us was re-run), we only post it once.
+    """
+    try:
+        taskqueue.add(
+            queue_name='slack',
+            url='/admin/post_slack_digest',
+            name=_digest_task_name(week, category_index, message_index),
+            params={'channel': channel,
+                    'week': week.isoformat(),
+                    'category_index': category_index,
+                    'message_index': message_index,
+                    'messages': json.dumps(messages),
+                    'thread_ts': thread_ts or ''})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.info('Already posted the snippets digest message %s',
+                     _digest_task_name(week, category_index, message_index))
+
+
+def post_weekly_digest(channel, week, categories_and_snippets, weekly_url):
+    """Post the week's snippets to a Slack channel, a thread per category.
+
+    categories_and_snippets is as for weekly_snippets.html:
+    ((category, ((snippet, user), ...)), ...).  The caller must leave
+    out any snippets that the channel shouldn't see.  For each category
+    with a snippet, we post a message naming it, and then post the
+    snippets as replies in its thread.
+
+    We format all the messages here, and then post them from the
+    'slack' queue, which runs slowly enough to keep us under Slack's
+    limit on how fast we can post to a channel.  See PostSlackDigest.
+    """
+    for (i, (category, snippets_and_users)) in enumerate(
+            categories_and_snippets):
+        texts = ['*%s*\n%s' % (_slack_escape(user.display_name or user.email),
+                               _slack_escape(snippet.text.strip()))
+                 for (snippet, user) in snippets_and_users
+                 if snippet.text and snippet.text.strip()]
+        if not texts:
+            continue
+        header = ('*%s*: %d snippet%s for the week of %s (%s)'
+                  % (_slack_escape(category), len(texts),
+                     '' if len(texts) == 1 else 's',
+                     week.strftime('%B %d').replace(' 0', ' '), weekly_url))
+        _queue_digest_messages(channel, week, i, 0,
+                               [header] + _chunk_messages(texts))
+
+
 ###############################
 ### SLASH COMMANDS ARE FUN! ###
 ###############################
@@ -155,33 +524,71 @@ def _no_user_error(user_email):
 
 
 def _user_snippet(user_email, weeks_back=0):
-    """Return the user's most recent Snippet.
+    """Return the user's Snippet for this week.
 
     If one doesn't exist, one will be automatically filled from the template
     (but not saved).
 
     By using the optional `weeks_back` parameter, you can step backwards in
-    time. Note that if you go back before the user's *first* snippet, they will
-    not be filled (the default filling seems to only go forwardwise in time),
-    and an IndexError will be raised.
+    time. Note that if you go back before the user's *first* week (one week
+    before they registered) and they don't have a snippet for that week, an
+    IndexError will be raised.
+
+    We look up just the week asked for, so this takes the same time
+    however long the user has been writing snippets.
 
     Raises an IndexError if requested snippet week comes before user birth.
     Raises ValueError if user couldn't be found.
     """
     account = util.get_user_or_die(user_email)  # can raise ValueError
-    user_snips = util.snippets_for_user(user_email)
-    logging.debug(
-        'User %s got snippets from db: %s', user_email, len(user_snips)
-    )
+    this_week = util.newsnippet_monday(_TODAY_FN())
+    week = this_week - datetime.timedelta(weeks=weeks_back)
+    # This also moves an old-style snippet to its email+week key.
+    snippet = util.get_snippet(user_email, week)
+    if snippet is not None:
+        return snippet
+
+    # We always fill in this week, even if we don't know when the
+    # user registered.
+    first_week = min(util.first_snippet_monday(account) or this_week,
+                     this_week)
+    if week < first_week:
+        raise IndexError('No snippet %s weeks back for %s'
+                         % (weeks_back, user_email))
+    return _empty_snippet(account, user_email, week)
+
+
+def _empty_snippet(account, user_email, week):
+    """Return a new (unsaved) Snippet with the user's default settings."""
+    return util.EmptySnippet(user_email, week, account.private_snippets,
+                             account.uses_markdown).to_snippet()
+
+
+def _update_snippet_items(user_email, update_items):
+    """Atomically update the items in the user's snippet for this week.
+
+    update_items is called, inside a transaction, with the list of
+    items in the snippet, and should modify the list in place.  It
+    may be called more than once, if someone else updates the
+    snippet at the same time and we have to retry.
+
+    Raises ValueError if the user couldn't be found, SyntaxError if
+    the snippet isn't a markdown list, db.TransactionFailedError if
+    we couldn't get the update in, and whatever update_items raises.
+    """
+    account = util.get_user_or_die(user_email)  # can raise ValueError
+    week = util.newsnippet_monday(_TODAY_FN())
 
-    filled_snips = util.fill_in_missing_snippets(user_snips, account,
-                                                 user_email, _TODAY_FN())
-    logging.debug(
-        'User %s snippets *filled* to: %s', user_email, len(filled_snips)
-    )
+    def update(snippet):
+        if snippet is None:
+            snippet = _empty_snippet(account, user_email, week)
+        items = _snippet_items(snippet)          # may raise SyntaxError
+        update_items(items)
+        snippet.set_items(items)
+        snippet.is_markdown = True
+        return snippet
 
-    index = (-1) - weeks_back
-    return filled_snips[index]
+    util.update_snippet(user_email, week, update)
 
 
 def _snippet_items(snippet):
@@ -189,25 +596,17 @@ def _snippet_items(snippet):
 
     For this we expect it the snippet to contain *nothing* but a markdown list.
     We do not support "indented" list style, only one item per linebreak.
+    We keep the items alongside the text (see Snippet.items_json), so
+    this usually doesn't need to parse the text.
 
     Raises SyntaxError if snippet not in proper format (e.g. contains
         anything other than a markdown list).
     """
-    unformatted = snippet.text and snippet.text.strip()
-
-    # treat null text value as empty list
-    if not unformatted:
-        return []
-
-    # parse out all markdown list items
-    items = re.findall(r'^[-*+] +(.*)$', unformatted, re.MULTILINE)
-
-    # if there were any lines that didn't yield an item, assume there was
-    # something we didn't parse. since we never want to lose existing data
-    # for a user, this is an error condition.
-    if len(items) < len(unformatted.splitlines()):
-        raise SyntaxError('unparsed lines in user snippet: %s' % unformatted)
-
+    items = snippet.get_items()
+    # since we never want to lose existing data for a user, a snippet
+    # that isn't just a list is an error condition.
+    if items is None:
+        raise SyntaxError('unparsed lines in user snippet: %s' % snippet.text)
     return items
 
 
@@ -273,9 +672,10 @@ def _linkify_usernames(text):
     return re.sub(r'(?<!<)(@[\w_]+)', r'<\1>', text)
 
 
-def _markdown_list(items):
-    """Transform a list of items into a markdown list."""
-    return "\n".join(["- {}".format(x) for x in items])
+_BUSY_ERROR = (
+    ":hourglass: Your snippets are being changed by someone else right "
+    "now!  Please try again."
+)
 
 
 def command_add(user_email, new_item):
@@ -286,10 +686,10 @@ def command_add(user_email, new_item):
             "Usage: `/snippets add [item]`"
         )
 
-    # TODO(csilvers): move this get/update/put atomic into a txn
+    new_item = _linkify_usernames(new_item)
     try:
-        snippet = _user_snippet(user_email)      # may raise ValueError
-        items = _snippet_items(snippet)          # may raise SyntaxError
+        _update_snippet_items(user_email,
+                              lambda items: items.append(new_item))
     except ValueError:
         return _no_user_error(user_email)
     except SyntaxError:
@@ -298,15 +698,9 @@ def command_add(user_email, new_item):
             "So I can't add to them! FYI I support markdown lists only, "
             "for more information see `/snippets help` ."
         )
+    except db.TransactionFailedError:
+        return _BUSY_ERROR
 
-    new_item = _linkify_usernames(new_item)
-    items.append(new_item)
-    snippet.text = _markdown_list(items)
-    snippet.is_markdown = True
-
-    # TODO(mroth): we should abstract out DB writes to a library wrapper
-    db.put(snippet)
-    db.get(snippet.key())    # ensure db consistency for HRD
     return "Added *{}* to your weekly snippets.".format(new_item)
 
 
@@ -329,10 +723,15 @@ def command_del(user_email, args):
     except ValueError:
         return syntax_err_msg
 
-    # TODO(csilvers): move this get/update/put atomic into a txn
+    # The items as of the (last) time we tried to delete one.
+    current_items = []
+
+    def delete_item(items):
+        current_items[:] = items
+        items.pop(index)                 # may raise IndexError
+
     try:
-        snippet = _user_snippet(user_email)      # may raise ValueError
-        items = _snippet_items(snippet)          # may raise SyntaxError
+        _update_snippet_items(user_email, delete_item)
     except ValueError:
         return _no_user_error(user_email)
     except SyntaxError:
@@ -341,21 +740,15 @@ def command_del(user_email, args):
             "So I can't delete from them! FYI I support markdown lists only, "
             "for more information see `/snippets help` ."
         )
-
-    try:
-        removed_item = items[index]
-        del items[index]
     except IndexError:
         return (
             ":grey_question: You don't have anything at that index?!\n" +
-            _format_snippet_items(items)
+            _format_snippet_items(current_items)
         )
+    except db.TransactionFailedError:
+        return _BUSY_ERROR
 
-    snippet.text = _markdown_list(items)
-    snippet.is_markdown = True
-
-    db.put(snippet)
-    db.get(snippet.key())    # ensure db consistency for HRD
+    removed_item = current_items[index]
     return "Removed *{}* from your weekly snippets.".format(removed_item)
 
 
@@ -368,6 +761,88 @@ def command_dump(user_email):
     return "```{}```".format(snippet.text or 'No snippet yet for this week')
 
 
+def _command_whoami_refresh(user_name, user_id, user_email, args):
+    """Return the user's email, refreshing our cache of it from Slack."""
+    logging.info('whoami! potential cached email for %s: %s',
+                 user_name, user_email)
+    refreshed = _get_user_email_cached(user_id, force_refresh=True)
+    logging.info('whoami! refreshed email for %s: %s', user_name, refreshed)
+    return refreshed
+
+
+def _command_unknown(user_name, user_id, user_email, args):
+    return (
+        "I don't understand what you said! "
+        "Perhaps you meant one of these?\n```%s```\n"
+        % command_usage()
+    )
+
+
+# The slash commands, and the functions that run them.  Each function
+# takes the user's Slack name, Slack id and email, and the words after
+# the command, and returns the text to reply with.
+_COMMANDS = {
+    # no command is the same as 'list'
+    '': lambda name, uid, email, args: command_list(email),
+    'help': lambda name, uid, email, args: command_help(),
+    # undocumented command to echo user email back
+    'whoami': lambda name, uid, email, args: email,
+    # whoami! forces a refresh of cache, for debugging
+    'whoami!': _command_whoami_refresh,
+    'list': lambda name, uid, email, args: command_list(email),
+    'last': lambda name, uid, email, args: command_last(email),
+    'add': lambda name, uid, email, args: command_add(email, " ".join(args)),
+    'del': lambda name, uid, email, args: command_del(email, args),
+    'dump': lambda name, uid, email, args: command_dump(email),
+}
+
+
+def _command_stats_name(cmd):
+    """Return the name we record cmd's latency and RPCs under."""
+    if cmd not in _COMMANDS:
+        # We don't want a histogram for every typo.
+        cmd = '(unknown)'
+    return 'slash_command:%s' % (cmd or '(null)')
+
+
+def _run_command(user_name, user_id, text, user_email=None):
+    """Run a slash command, and return the text to reply with.
+
+    user_email is the user's email, if the caller already has it;
+    otherwise we look it up from their Slack user id.  We record how
+    long each command takes, and how many RPCs it makes, in latency.py;
+    see SlashCommandStats.
+    """
+    words = text.strip().split()
+    cmd, args = (words[0], words[1:]) if words else ('', [])
+
+    with latency.measure(_command_stats_name(cmd)) as measurement:
+        if user_email is None:
+            try:
+                user_email = _get_user_email_cached(user_id)
+            except ValueError:
+                logging.error("Failed getting %s email from Slack API",
+                              user_name)
+                measurement.error = True
+                return (
+                    "Error getting your email address from the Slack API! "
+                    "Please contact an admin and report the time of this "
+                    "error."
+                )
+
+        if cmd in _COMMANDS:
+            logging.info('%s command from user %s', cmd or 'null (list)',
+                         user_name)
+            return _COMMANDS[cmd](user_name, user_id, user_email, args)
+        else:
+            logging.info('unknown command %s from user %s', cmd, user_name)
+            return _command_unknown(user_name, user_id, user_email, args)
+
+
+# What we reply with right away when we run a command in the background.
+_DEFERRED_REPLY = ":hourglass: Working on it..."
+
+
 class SlashCommand(webapp2.RequestHandler):
     def post(self):
         """Process an incoming slash command from Slack.
@@ -383,7 +858,15 @@ class SlashCommand(webapp2.RequestHandler):
             user_name=Steve
             command=/weather
             text=94070
+            response_url=https://hooks.slack.com/commands/1234/5678
+
+        Slack gives up on us if we take more than 3 seconds to reply.
+        If we'd need to ask Slack for the user's email, which can be
+        slow, we reply right away and run the command in a task
+        (DeferredSlashCommand), which sends the real reply to the
+        response_url.  Otherwise we run the command here.
         """
+        start = time.time()
         req, res = self.request, self.response
 
         expected_token = models.AppSettings.get().slack_slash_token
@@ -404,59 +887,162 @@ class SlashCommand(webapp2.RequestHandler):
         user_name = req.get('user_name')
         user_id = req.get('user_id')
         text = req.get('text')
+        response_url = req.get('response_url')
+
+        user_email = _cached_user_email(user_id)
+        needs_slack_api = (user_email is None or
+                           text.strip().split()[:1] == ['whoami!'])
+        if needs_slack_api and response_url:
+            taskqueue.add(url='/admin/slack_command',
+                          params={'user_name': user_name,
+                                  'user_id': user_id,
+                                  'text': text,
+                                  'response_url': response_url,
+                                  'received': repr(start)},
+                          # Commands aren't idempotent, so never rerun one.
+                          retry_options=taskqueue.TaskRetryOptions(
+                              task_retry_limit=0))
+            res.write(_DEFERRED_REPLY)
+            latency.record('slash_command_ack', time.time() - start)
+            return
+
+        res.write(_run_command(user_name, user_id, text, user_email))
+        latency.record('slash_command_inline', time.time() - start)
+
+
+class DeferredSlashCommand(webapp2.RequestHandler):
+    """Run a slash command queued by SlashCommand, and send Slack the reply.
 
+    This page should be restricted to admin users via app.yaml.
+    """
+
+    def post(self):
+        req = self.request
+        reply = _run_command(req.get('user_name'), req.get('user_id'),
+                             req.get('text'))
         try:
-            user_email = _get_user_email_cached(user_id)
+            urlfetch.fetch(req.get('response_url'),
+                           payload=json.dumps({'text': reply}),
+                           method=urlfetch.POST,
+                           headers={'Content-Type': 'application/json'},
+                           deadline=_DEADLINE)
+        except urlfetch.DownloadError, why:
+            logging.error('Failed sending slash command reply to slack: %s',
+                          why)
+        latency.record('slash_command_deferred',
+                       time.time() - float(req.get('received')))
+
+
+class PostSlackDigest(webapp2.RequestHandler):
+    """Post one message of the week's snippets, and queue the next one.
+
+    The first message for a category starts a thread, and the rest go
+    in it, in order; so we post them one at a time.  See
+    post_weekly_digest().  This page should be restricted to admin
+    users via app.yaml.
+    """
+
+    def post(self):
+        req = self.request
+        channel = req.get('channel')
+        messages = json.loads(req.get('messages'))
+        thread_ts = req.get('thread_ts') or None
+        try:
+            ts = _post_message(channel, messages[0], thread_ts)
+        except ValueError, why:
+            # We don't let the task be retried: the message might
+            # have been posted even so.
+            logging.error('Failed posting snippets digest to slack, '
+                          'giving up on this category: %s', why)
+            return
+
+        if len(messages) > 1:
+            week = datetime.datetime.strptime(req.get('week'),
+                                              '%Y-%m-%d').date()
+            _queue_digest_messages(channel, week,
+                                   int(req.get('category_index')),
+                                   int(req.get('message_index')) + 1,
+                                   messages[1:], thread_ts or ts)
+
+
+class SyncSlackUsers(webapp2.RequestHandler):
+    """Store the email of every Slack user, so slash commands needn't ask.
+
+    This runs daily, from cron.yaml.  We store one page of Slack
+    users per request, and queue a task to do the next page.  This
+    page should be restricted to admin users via app.yaml.
+    """
+
+    def get(self):
+        self.response.headers['Content-Type'] = 'text/plain'
+        try:
+            slack_token = models.AppSettings.get().slack_token
         except ValueError:
-            logging.error("Failed getting %s email from Slack API", user_name)
-            res.write(
-                "Error getting your email address from the Slack API! "
-                "Please contact an admin and report the time of this error."
-            )
+            slack_token = None
+        if not slack_token:
+            self.response.write('Slack is not configured.\n')
             return
 
-        words = text.strip().split()
-        if not words:
-            logging.info('null (list) command from user %s', user_name)
-            res.write(command_list(user_email))
+        cursor = self.request.get('cursor') or None
+        (num_synced, cursor) = sync_slack_users(cursor)
+        if cursor:
+            taskqueue.add(url='/admin/sync_slack_users', method='GET',
+                          params={'cursor': cursor})
+            status = 'continuing in the background'
         else:
-            cmd, args = words[0], words[1:]
-            if cmd == 'help':
-                logging.info('help command from user %s', user_name)
-                res.write(command_help())
-            elif cmd == 'whoami':
-                # undocumented command to echo user email back
-                logging.info('whoami command from user %s', user_name)
-                res.write(user_email)
-            elif cmd == 'whoami!':
-                # whoami! forces a refresh of cache, for debugging
-                logging.info('whoami! command from user %s', user_name)
-                logging.info('whoami! potential cached email for %s: %s',
-                             user_name, user_email)
-                refreshed = _get_user_email_cached(user_id, force_refresh=True)
-                logging.info('whoami! refreshed email for %s: %s',
-                             user_name, refreshed)
-                res.write(refreshed)
-            elif cmd == 'list':
-                # this is the same as the null command, but support for UX
-                logging.info('list command from user %s', user_name)
-                res.write(command_list(user_email))
-            elif cmd == 'last':
-                logging.info('last command from user %s', user_name)
-                res.write(command_last(user_email))
-            elif cmd == 'add':
-                logging.info('add command from user %s', user_name)
-                res.write(command_add(user_email, " ".join(args)))
-            elif cmd == 'del':
-                logging.info('del command from user %s', user_name)
-                res.write(command_del(user_email, args))
-            elif cmd == 'dump':
-                logging.info('dump command from user %s', user_name)
-                res.write(command_dump(user_email))
-            else:
-                logging.info('unknown command %s from user %s', cmd, user_name)
-                res.write(
-                    "I don't understand what you said! "
-                    "Perhaps you meant one of these?\n```%s```\n"
-                    % command_usage()
-                )
+            status = 'done'
+        self.response.write('Synced %d Slack users; %s.\n'
+                            % (num_synced, status))
+
+
+class SlackEmailCacheStats(webapp2.RequestHandler):
+    """Show how well this instance's cache of Slack emails is doing.
+
+    The counts are for whichever instance serves this request.  This
+    page should be restricted to admin users via app.yaml.
+    """
+
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(email_cache_stats(), sort_keys=True))
+
+
+class SlashCommandStats(webapp2.RequestHandler):
+    """Show how long slash commands take, and the RPCs they make.
+
+    This covers roughly the last hour, across all instances; see
+    latency.py.  Slack gives up on a command after 3 seconds, so
+    watch the slow end of the slash_command_inline histogram.  This
+    page should be restricted to admin users via app.yaml.
+    """
+
+    def get(self):
+        self.response.headers['Content-Type'] = 'text/plain'
+        names = (['slash_command_inline', 'slash_command_ack',
+                  'slash_command_deferred'] +
+                 # None stands for all the commands we don't know
+                 [_command_stats_name(cmd)
+                  for cmd in sorted(_COMMANDS) + [None]])
+        self.response.write(
+            '%-30s %6s %6s %6s %6s %6s %9s %9s %9s\n'
+            % ('name', 'count', 'errors', 'p50ms', 'p90ms', 'p99ms',
+               'datastore', 'memcache', 'urlfetch'))
+        for name in names:
+            stats = latency.stats(name)
+            if not stats['count']:
+                continue
+            rpcs_per_call = [
+                '%.1f' % (float(stats['rpcs'][service]) / stats['count'])
+                for service in latency.RPC_SERVICES]
+            percentiles = [latency.percentile(stats['histogram'], f)
+                           for f in (0.5, 0.9, 0.99)]
+            self.response.write(
+                '%-30s %6d %5.1f%% %6s %6s %6s %9s %9s %9s\n'
+                % tuple([name, stats['count'],
+                         100.0 * stats['errors'] / stats['count']] +
+                        [p or 'slow' for p in percentiles] +
+                        rpcs_per_call))
+        self.response.write(
+            '\nPercentiles are histogram bucket upper bounds; "slow" is'
+            ' over %dms.\nRPC counts are per call.\n'
+            % latency.BUCKETS_MS[-1])
@@ -2,9 +2,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import base64
+import BaseHTTPServer
 import datetime
+import json
 import textwrap
+import threading
 import unittest
+import urlparse
 
 # Update sys.path so it can find these.  We just need to add
 # 'google_appengine', but we add all of $PATH to be easy.  This
@@ -14,9 +19,14 @@ import sys
 sys.path.extend(os.environ['PATH'].split(':'))
 import dev_appserver
 dev_appserver.fix_sys_path()
+from google.appengine.api import memcache
+from google.appengine.datastore import datastore_stub_util
 from google.appengine.ext import db
 from google.appengine.ext import testbed
+import webapp2
+import webtest   # may need to do 'pip install webtest'
 
+import latency
 import models
 import slacklib
 
@@ -100,8 +110,14 @@ class SlashCommandTest(unittest.TestCase):
     def setUp(self):
         self.testbed = testbed.Testbed()
         self.testbed.activate()
-        self.testbed.init_datastore_v3_stub()
+        # Snippet writes use cross-group transactions, which need HRD.
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
         self.testbed.init_memcache_stub()
+        # Snippet writes queue a task to update the week's digest.
+        self.testbed.init_taskqueue_stub(
+            root_path=os.path.dirname(os.path.abspath(__file__)))
         self._mock_data()
 
     def tearDown(self):
@@ -162,6 +178,23 @@ class SlashCommandTest(unittest.TestCase):
         response = slacklib.command_last('bob@bob.com')
         self.assertIn("You don't appear to have a snippets account", response)
 
+    def testUserSnippet_weeksBack(self):
+        db.put(models.User(key_name='kermit@khanacademy.org',
+                           email='kermit@khanacademy.org',
+                           created=datetime.datetime(2015, 7, 15),
+                           private_snippets=True))
+        s = slacklib._user_snippet('kermit@khanacademy.org', 3)
+        self.assertEqual(datetime.date(2015, 7, 6), s.week)
+        self.assertEqual(None, s.text)
+        self.assertTrue(s.private)
+        # Before a week before Kermit registered, there are no snippets.
+        with self.assertRaises(IndexError):
+            slacklib._user_snippet('kermit@khanacademy.org', 4)
+
+        s = slacklib._user_snippet('fleetwood@khanacademy.org', 1)
+        self.assertEqual(datetime.date(2015, 7, 20), s.week)
+        self.assertIn('lots of walks this week', s.text)
+
     def testBadMarkdown_listCommand(self):
         toby_recent = slacklib.command_list('toby@khanacademy.org')
         self.assertIn("not in a format I understand", toby_recent)
@@ -178,6 +211,31 @@ class SlashCommandTest(unittest.TestCase):
         self.assertEquals('- went to the park', t.text)
         self.assertEquals(True, t.is_markdown)
 
+    def testAddCommand_updatesUserStats(self):
+        slacklib.command_add('stuart@khanacademy.org', 'went to the park')
+        slacklib.command_add('stuart@khanacademy.org', 'went home')
+        t = self._most_recent_snippet('stuart@khanacademy.org')
+        u = models.User.get_by_key_name('stuart@khanacademy.org')
+        self.assertEqual(1, u.num_snippet_weeks)
+        self.assertEqual(t.week, u.last_snippet_week)
+
+    def testAddCommand_concurrent(self):
+        # Look stuart up once first, so his user record gets its new key
+        # before the threads race to read it.
+        slacklib.command_list('stuart@khanacademy.org')
+        new_items = ['item %d' % i for i in xrange(5)]
+        threads = [threading.Thread(target=slacklib.command_add,
+                                    args=('stuart@khanacademy.org', item))
+                   for item in new_items]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # No matter how the adds interleaved, none of them got lost.
+        t = self._most_recent_snippet('stuart@khanacademy.org')
+        self.assertEqual(sorted(new_items),
+                         sorted(slacklib._snippet_items(t)))
+
     def testAddCommand_existing(self):
         # on this one, the user markdown formatting gets altered/standardized
         slacklib.command_add('fleetwood@khanacademy.org', 'went to the park')
@@ -190,6 +248,10 @@ class SlashCommandTest(unittest.TestCase):
         """).strip()
         self.assertEqual(expected, t.text)
         self.assertEquals(True, t.is_markdown)
+        # ...and the items and html are stored alongside the text
+        self.assertEqual(expected.replace('- ', '').splitlines(),
+                         json.loads(t.items_json))
+        self.assertIn('<li>went to the park</li>', t.rendered_html())
 
     def testAddCommand_existingIsMalformed(self):
         # we should be told we cannot to add to a snippet that is malformed!
@@ -267,5 +329,397 @@ class SlashCommandTest(unittest.TestCase):
         self.assertIn("I had fun", t.text)
         self.assertEquals(False, t.is_markdown)
 
+
+class _FakeSlackHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer each request with the next of the server's canned responses."""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Type') == 'application/json':
+            body = json.loads(body)
+        else:
+            body = dict(urlparse.parse_qsl(body))
+        self.server.requests.append((self.path, body))
+        (status, headers, reply) = self.server.responses.pop(0)
+        self.send_response(status)
+        for (name, value) in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(json.dumps(reply))
+
+    def log_message(self, *args):
+        pass
+
+
+class SlackWebApiTest(unittest.TestCase):
+    """Test talking to the Slack Web API, using a fake Slack server."""
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_urlfetch_stub()
+        models.AppSettings(key_name='global_settings',
+                           domains=['khanacademy.org'],
+                           hostname='https://example.com',
+                           slack_token='st').put()
+
+        self.server = BaseHTTPServer.HTTPServer(('localhost', 0),
+                                                _FakeSlackHandler)
+        self.server.requests = []
+        self.server.responses = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.old_slack_api_url = slacklib._SLACK_API_URL
+        slacklib._SLACK_API_URL = ('http://localhost:%s/api/'
+                                   % self.server.server_address[1])
+        self.old_sleep_fn = slacklib._SLEEP_FN
+        self.sleeps = []
+        slacklib._SLEEP_FN = self.sleeps.append
+
+        # Start each test with an empty in-memory cache, and a clock
+        # we control.
+        self.old_time_fn = slacklib._TIME_FN
+        slacklib._local_email_cache = slacklib._LocalEmailCache(max_size=10)
+        self.now = 1000000
+        slacklib._TIME_FN = lambda: self.now
+
+    def tearDown(self):
+        slacklib._SLACK_API_URL = self.old_slack_api_url
+        slacklib._SLEEP_FN = self.old_sleep_fn
+        slacklib._TIME_FN = self.old_time_fn
+        self.server.shutdown()
+        self.server.server_close()
+        self.testbed.deactivate()
+
+    def _respond(self, status=200, headers=None, **reply):
+        self.server.responses.append((status, headers or {}, reply))
+
+    def testWebApi_sendsToken(self):
+        self._respond(ok=True, channel='C1')
+        reply = slacklib._web_api('chat.postMessage', {'text': 'hi “you”'})
+        self.assertEqual('C1', reply['channel'])
+        self.assertEqual([('/api/chat.postMessage',
+                           {'token': 'st',
+                            'text': 'hi “you”'.encode('utf-8')})],
+                         self.server.requests)
+
+    def testWebApi_slackError(self):
+        self._respond(ok=False, error='channel_not_found')
+        with self.assertRaises(ValueError):
+            slacklib._web_api('chat.postMessage', {'text': 'hi'})
+        # Slack errors aren't worth retrying.
+        self.assertEqual(1, len(self.server.requests))
+
+    def testWebApi_retriesRateLimitedCall(self):
+        self._respond(429, {'Retry-After': '3'}, ok=False, error='ratelimited')
+        self._respond(ok=True)
+        slacklib._web_api('chat.postMessage', {'text': 'hi'})
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual(1, len(self.sleeps))
+        self.assertTrue(self.sleeps[0] >= 3, self.sleeps)
+
+    def testWebApi_retriesServerErrorsWithBackoff(self):
+        for _ in xrange(slacklib._MAX_TRIES):
+            self._respond(503, ok=False, error='unavailable')
+        with self.assertRaises(ValueError):
+            slacklib._web_api('users.info', {'user': 'U1'})
+        self.assertEqual(slacklib._MAX_TRIES, len(self.server.requests))
+        self.assertEqual(sorted(self.sleeps), self.sleeps)
+
+    def testWebApi_doesNotRetryPostOnServerError(self):
+        # The message may have been posted anyway; we don't want two.
+        self._respond(500, ok=False, error='oops')
+        self._respond(ok=True)
+        with self.assertRaises(ValueError):
+            slacklib._web_api('chat.postMessage', {'text': 'hi'})
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual([], self.sleeps)
+
+    def testWebApi_givesUpIfAskedToWaitTooLong(self):
+        self._respond(429, {'Retry-After': str(slacklib._MAX_RETRY_WAIT + 1)},
+                      ok=False, error='ratelimited')
+        with self.assertRaises(ValueError):
+            slacklib._web_api('chat.postMessage', {'text': 'hi'})
+        self.assertEqual([], self.sleeps)
+
+    def testWebApi_callsInParallel(self):
+        self._respond(ok=True, user={'profile': {'email': 'a@example.com'}})
+        self._respond(ok=True, user={'profile': {'email': 'b@example.com'}})
+        calls = [slacklib._web_api_async('users.info', {'user': uid})
+                 for uid in ('U1', 'U2')]
+        emails = set(c.get_result()['user']['profile']['email']
+                     for c in calls)
+        self.assertEqual(set(['a@example.com', 'b@example.com']), emails)
+
+    def testGetUserEmail(self):
+        self._respond(ok=True, user={'profile': {'email': 'a@example.com'}})
+        self.assertEqual('a@example.com', slacklib._get_user_email('U1'))
+        self.assertEqual({'token': 'st', 'user': 'U1'},
+                         self.server.requests[0][1])
+
+    def testSendToSlackChannel(self):
+        self._respond(429, ok=False, error='ratelimited')
+        self._respond(ok=True)
+        slacklib.send_to_slack_channel('#snippets', 'hello')
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual('#snippets', self.server.requests[1][1]['channel'])
+
+
+class SlashCommandHandlerTest(SlackWebApiTest):
+    """Test answering slash commands inline, and in the background."""
+
+    def setUp(self):
+        super(SlashCommandHandlerTest, self).setUp()
+        self.testbed.init_taskqueue_stub(
+            root_path=os.path.dirname(os.path.abspath(__file__)))
+        self.taskqueue_stub = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
+        app_settings = models.AppSettings.get()
+        app_settings.slack_slash_token = 'sst'
+        app_settings.put()
+        db.put(models.User(key_name='stuart@khanacademy.org',
+                           email='stuart@khanacademy.org'))
+        slacklib._TODAY_FN = lambda: datetime.datetime(2015, 7, 29)
+        self.request_fetcher = webtest.TestApp(webapp2.WSGIApplication([
+            ('/slack', slacklib.SlashCommand),
+            ('/admin/slack_command', slacklib.DeferredSlashCommand),
+            ('/admin/sync_slack_users', slacklib.SyncSlackUsers),
+            ('/admin/slash_command_stats', slacklib.SlashCommandStats),
+        ]))
+        # Don't count timings left over from other tests.
+        latency._pending.clear()
+        self.response_url = ('http://localhost:%s/commands/1'
+                             % self.server.server_address[1])
+
+    def _slash_command(self, text):
+        return self.request_fetcher.post('/slack', {
+            'token': 'sst',
+            'user_id': 'U1',
+            'user_name': 'stuart',
+            'text': text,
+            'response_url': self.response_url,
+        }).body
+
+    def _latency_count(self, name):
+        return sum(count for (_, count) in latency.histogram(name))
+
+    def testCachedEmailRunsInline(self):
+        memcache.set('slack_profile_email_U1', 'stuart@khanacademy.org')
+        body = self._slash_command('add went to the park')
+        self.assertIn('Added *went to the park*', body)
+        self.assertEqual([], self.taskqueue_stub.GetTasks('default'))
+        self.assertEqual([], self.server.requests)
+        self.assertEqual(1, self._latency_count('slash_command_inline'))
+
+    def testCommandStats(self):
+        memcache.set('slack_profile_email_U1', 'stuart@khanacademy.org')
+        self._slash_command('add went to the park')
+        self._slash_command('frobnicate')
+        add_stats = latency.stats('slash_command:add')
+        self.assertEqual(1, add_stats['count'])
+        self.assertEqual(0, add_stats['errors'])
+        self.assertLess(0, add_stats['rpcs']['datastore_v3'])
+        self.assertEqual(0, add_stats['rpcs']['urlfetch'])
+        self.assertEqual(1, latency.stats('slash_command:(unknown)')['count'])
+
+        body = self.request_fetcher.get('/admin/slash_command_stats').body
+        self.assertIn('slash_command:add', body)
+        self.assertIn('slash_command:(unknown)', body)
+        self.assertNotIn('slash_command:dump', body)
+
+    def testCommandStats_emailLookupFails(self):
+        self._respond(ok=False, error='user_not_found')
+        reply = slacklib._run_command('stuart', 'U1', 'list')
+        self.assertIn('Error getting your email address', reply)
+        list_stats = latency.stats('slash_command:list')
+        self.assertEqual(1, list_stats['errors'])
+        self.assertEqual(1, list_stats['rpcs']['urlfetch'])
+
+    def testSyncSlackUsers(self):
+        self._respond(ok=True,
+                      members=[
+                          {'id': 'U1',
+                           'profile': {'email': 'stuart@khanacademy.org'}},
+                          {'id': 'B1', 'profile': {}},    # a bot
+                      ],
+                      response_metadata={'next_cursor': 'page2'})
+        self._respond(ok=True,
+                      members=[
+                          {'id': 'U2',
+                           'profile': {'email': 'toby@khanacademy.org'}},
+                          {'id': 'U3', 'deleted': True,
+                           'profile': {'email': 'gone@khanacademy.org'}},
+                      ],
+                      response_metadata={'next_cursor': ''})
+        self.request_fetcher.get('/admin/sync_slack_users')
+        tasks = self.taskqueue_stub.GetTasks('default')
+        self.assertEqual(1, len(tasks))
+        self.request_fetcher.get(tasks[0]['url'])
+
+        self.assertEqual('page2', self.server.requests[1][1]['cursor'])
+        self.assertEqual(
+            ['toby@khanacademy.org', 'stuart@khanacademy.org', None, None],
+            [u and u.email for u in models.SlackUser.get_by_key_name(
+                ['U2', 'U1', 'U3', 'B1'])])
+        self.assertEqual('toby@khanacademy.org',
+                         memcache.get('slack_profile_email_U2'))
+
+    def testSyncedEmailRunsInline(self):
+        models.SlackUser(key_name='U1', email='stuart@khanacademy.org').put()
+        body = self._slash_command('add went to the park')
+        self.assertIn('Added *went to the park*', body)
+        self.assertEqual([], self.server.requests)
+        self.assertEqual(1, self._latency_count('slash_command_inline'))
+
+    def testEmailCache_revalidatesStaleEntries(self):
+        models.SlackUser(key_name='U1', email='old@khanacademy.org').put()
+        self.assertEqual('old@khanacademy.org',
+                         slacklib._cached_user_email('U1'))
+        self.assertEqual('old@khanacademy.org',
+                         slacklib._cached_user_email('U1'))
+        self.assertEqual({'misses': 1, 'hits': 1},
+                         slacklib.email_cache_stats())
+
+        models.SlackUser(key_name='U1', email='new@khanacademy.org').put()
+        memcache.flush_all()
+        self.now += slacklib._LocalEmailCache.FRESH_TIME + 1
+        # A stale entry is re-read, and is then fresh again.
+        self.assertEqual('new@khanacademy.org',
+                         slacklib._cached_user_email('U1'))
+        self.assertEqual('new@khanacademy.org',
+                         slacklib._cached_user_email('U1'))
+        self.assertEqual({'misses': 1, 'hits': 2, 'stale_hits': 1,
+                          'refreshes': 1},
+                         slacklib.email_cache_stats())
+
+        # Very old entries aren't used at all.
+        self.now += slacklib._LocalEmailCache.MAX_AGE + 1
+        self.assertEqual('new@khanacademy.org',
+                         slacklib._cached_user_email('U1'))
+        self.assertEqual(2, slacklib.email_cache_stats()['misses'])
+
+        # If it's not stored anywhere, the stale entry is used as is.
+        models.SlackUser.get_by_key_name('U1').delete()
+        memcache.flush_all()
+        self.now += slacklib._LocalEmailCache.FRESH_TIME + 1
+        self.assertEqual('new@khanacademy.org',
+                         slacklib._cached_user_email('U1'))
+        self.assertEqual([], self.server.requests)
+
+    def testEmailCache_forceRefresh(self):
+        models.SlackUser(key_name='U1', email='old@khanacademy.org').put()
+        slacklib._cached_user_email('U1')
+        self._respond(ok=True,
+                      user={'profile': {'email': 'new@khanacademy.org'}})
+        self.assertEqual('new@khanacademy.org',
+                         slacklib._get_user_email_cached('U1',
+                                                         force_refresh=True))
+        self.assertEqual('new@khanacademy.org',
+                         slacklib._cached_user_email('U1'))
+        self.assertEqual('new@khanacademy.org',
+                         models.SlackUser.get_by_key_name('U1').email)
+
+    def testUncachedEmailIsDeferred(self):
+        body = self._slash_command('add went to the park')
+        self.assertEqual(slacklib._DEFERRED_REPLY, body)
+        self.assertEqual(1, self._latency_count('slash_command_ack'))
+
+        self._respond(ok=True,
+                      user={'profile': {'email': 'stuart@khanacademy.org'}})
+        self._respond(ok=True)
+        tasks = self.taskqueue_stub.GetTasks('default')
+        self.assertEqual(1, len(tasks))
+        self.request_fetcher.post(tasks[0]['url'],
+                                  base64.b64decode(tasks[0]['body']))
+
+        self.assertEqual('/api/users.info', self.server.requests[0][0])
+        self.assertEqual('/commands/1', self.server.requests[1][0])
+        self.assertIn('Added *went to the park*',
+                      self.server.requests[1][1]['text'])
+        self.assertEqual(1, self._latency_count('slash_command_deferred'))
+        # Now that we know Stuart's email, we don't need to defer.
+        self.assertIn('went to the park', self._slash_command('list'))
+
+
+class PostSlackDigestTest(SlackWebApiTest):
+    """Test posting the week's snippets to Slack, a thread per category."""
+
+    def setUp(self):
+        super(PostSlackDigestTest, self).setUp()
+        self.testbed.init_taskqueue_stub(
+            root_path=os.path.dirname(os.path.abspath(__file__)))
+        self.taskqueue_stub = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
+        self.request_fetcher = webtest.TestApp(webapp2.WSGIApplication([
+            ('/admin/post_slack_digest', slacklib.PostSlackDigest),
+        ]))
+        self.week = datetime.date(2015, 7, 27)
+
+    def _snippet_and_user(self, email, text):
+        return (models.Snippet(email=email, week=self.week, text=text),
+                models.User(email=email, display_name=email.split('@')[0]))
+
+    def _run_slack_tasks(self):
+        while self.taskqueue_stub.GetTasks('slack'):
+            for task in self.taskqueue_stub.GetTasks('slack'):
+                self.taskqueue_stub.DeleteTask('slack', task['name'])
+                self.request_fetcher.post(task['url'],
+                                          base64.b64decode(task['body']))
+
+    def testChunkMessages(self):
+        self.assertEqual(['aaaaa\n\nbbb', 'cccccccccc', 'cc\n\nx\ny'],
+                         slacklib._chunk_messages(['aaaaa', 'bbb',
+                                                   'c' * 12, 'x\ny'],
+                                                  max_length=10))
+
+    def testPostsAThreadPerCategory(self):
+        slacklib.post_weekly_digest(
+            '#snippets', self.week,
+            [('eng', [self._snippet_and_user('fleetwood@khanacademy.org',
+                                             '- went for a walk'),
+                      self._snippet_and_user('stuart@khanacademy.org', '')]),
+             ('pets', [self._snippet_and_user('toby@khanacademy.org',
+                                              'chased <cats> & dogs')]),
+             ('empty', [self._snippet_and_user('nobody@khanacademy.org',
+                                               None)])],
+            'https://example.com/weekly?week=07-27-2015')
+        self.assertEqual(2, len(self.taskqueue_stub.GetTasks('slack')))
+        for i in xrange(4):
+            self._respond(ok=True, ts='100.%d' % i)
+        self._run_slack_tasks()
+
+        # Slack gives the i-th message we post the timestamp 100.i.
+        posts = [(r.get('thread_ts'), r['text'], '100.%d' % i)
+                 for (i, (_, r)) in enumerate(self.server.requests)]
+        self.assertEqual(4, len(posts))
+        threads = dict((text.split('*')[1], ts)
+                       for (thread_ts, text, ts) in posts if not thread_ts)
+        replies = dict((text.split('*')[1], (thread_ts, text))
+                       for (thread_ts, text, _) in posts if thread_ts)
+        self.assertEqual(['eng', 'pets'], sorted(threads))
+        self.assertEqual(['fleetwood', 'toby'], sorted(replies))
+        self.assertIn('*eng*: 1 snippet for the week of July 27',
+                      [text for (_, text, ts) in posts
+                       if ts == threads['eng']][0])
+        self.assertEqual(threads['eng'], replies['fleetwood'][0])
+        self.assertEqual(threads['pets'], replies['toby'][0])
+        self.assertEqual('*toby*\nchased &lt;cats&gt; &amp; dogs',
+                         replies['toby'][1])
+
+    def testDoesNotPostTwice(self):
+        categories_and_snippets = [
+            ('eng', [self._snippet_and_user('fleetwood@khanacademy.org',
+                                            '- went for a walk')])]
+        for _ in xrange(2):
+            slacklib.post_weekly_digest('#snippets', self.week,
+                                        categories_and_snippets,
+                                        'https://example.com/weekly')
+        self.assertEqual(1, len(self.taskqueue_stub.GetTasks('slack')))
+
+
 if __name__ == '__main__':
     unittest.main()
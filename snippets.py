@@ -9,18 +9,25 @@ snippets in them.
 __author__ = 'Craig Silverstein <csilvers@khanacademy.org>'
 
 import datetime
+import hashlib
+import json
 import logging
 import os
 import re
 import time
 import urllib
 
-from google.appengine.api import mail
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.api import users
 from google.appengine.ext import db
 import webapp2
 from webapp2_extras import jinja2
 
+import digest
+import directory
+import mailer
+import migrations
 import models
 import slacklib
 import util
@@ -69,7 +76,7 @@ def _get_or_create_user(email, put_new_user=True):
             # that indicates the user is active again, so un-hide them.
             # TODO(csilvers): move this get/update/put atomic into a txn
             user.is_hidden = False
-            user.put()
+            util.put_user(user)
     elif not _logged_in_user_has_permission_for(email):
         # TODO(csilvers): turn this into a 403 somewhere
         raise IndexError('User "%s" not found; did you specify'
@@ -93,14 +100,14 @@ def _get_or_create_user(email, put_new_user=True):
                                % (' or '.join(allowed_domains), domain))
 
         # Set the user defaults based on the global app defaults.
-        user = models.User(created=_TODAY_FN(),
+        user = models.User(key_name=models.User.make_key_name(email),
+                           created=_TODAY_FN(),
                            email=email,
                            uses_markdown=app_settings.default_markdown,
                            private_snippets=app_settings.default_private,
                            wants_email=app_settings.default_email)
         if put_new_user:
-            db.put(user)
-            db.get(user.key())    # ensure db consistency for HRD
+            util.put_user(user)
     return user
 
 
@@ -146,6 +153,27 @@ def _send_to_chat(msg, url_path):
         slacklib.send_to_slack_channel(slack_channel, msg)
 
 
+def _post_digest_to_chat(week):
+    """Post the week's snippets to chat, if we're configured to.
+
+    Only snippets that aren't private are posted.
+    """
+    try:
+        app_settings = models.AppSettings.get()
+    except ValueError:
+        logging.warning('Not posting to chat: app settings not configured')
+        return
+
+    slack_channel = app_settings.slack_channel
+    if slack_channel and app_settings.slack_post_digest:
+        weekly_url = '%s/weekly?week=%s' % (app_settings.hostname,
+                                            week.strftime('%m-%d-%Y'))
+        slacklib.post_weekly_digest(
+            slack_channel, week,
+            _get_categories_and_snippets(week, lambda email: False),
+            weekly_url)
+
+
 class BaseHandler(webapp2.RequestHandler):
     """Set up as per the jinja2.py docstring."""
     @webapp2.cached_property
@@ -157,6 +185,72 @@ class BaseHandler(webapp2.RequestHandler):
         self.response.write(html)
 
 
+# How many weeks of snippets we show at a time on the user page.
+# Older snippets are loaded on demand via OlderSnippets.
+_USER_PAGE_WEEKS = 12
+
+
+def _snippets_for_user_page(user, user_email, end_week=None):
+    """Return a page's worth of snippets from a user's snippet history.
+
+    A page holds the _USER_PAGE_WEEKS weeks ending with end_week.  If
+    end_week is None, it's the first page, which ends with the current
+    week, plus any snippets the user has written for future weeks.
+    Holes are filled in, and private snippets are left out if the
+    logged-in user isn't allowed to see them.
+
+    Returns:
+      A pair (snippets, older_week): an iterator over the snippets,
+      newest first, and the end_week to use for the next-older page,
+      or None if there are no older snippets to show.
+    """
+    today = _TODAY_FN()
+    start_week = ((end_week or util.newsnippet_monday(today)) -
+                  datetime.timedelta(weeks=_USER_PAGE_WEEKS - 1))
+    snippets = util.snippets_for_user(user_email, start_week=start_week,
+                                      end_week=end_week, newest_first=True)
+
+    can_view_private = _can_view_private_snippets(_current_user_email(),
+                                                  user_email)
+    if not can_view_private:
+        snippets = [snippet for snippet in snippets if not snippet.private]
+
+    # If the user has snippets from before this page (that we can
+    # see), we fill in this page all the way back to its start.
+    # Otherwise we fill back to the week before they registered, as
+    # usual.
+    first_week = util.first_snippet_monday(user)
+    if util.has_snippets_before(user_email, start_week,
+                                include_private=can_view_private):
+        first_week = start_week
+        older_week = start_week - datetime.timedelta(weeks=1)
+    else:
+        if first_week is None or first_week < start_week:
+            first_week = start_week
+        older_week = None
+    snippets = util.iter_filled_snippets(snippets, user, user_email, today,
+                                         first_week=first_week,
+                                         last_week=end_week,
+                                         newest_first=True)
+    return (snippets, older_week)
+
+
+def _snippet_list_template_values(request, user, user_email, snippets):
+    """Return the template values needed by user_snippet_list.html."""
+    return {
+        'username': user_email,
+        'domain': user_email.split('@')[-1],
+        # Snippets for the week of <one week ago> are due today.
+        'one_week_ago': _TODAY_FN().date() - datetime.timedelta(days=7),
+        'eight_days_ago': _TODAY_FN().date() - datetime.timedelta(days=8),
+        'editable': (_logged_in_user_has_permission_for(user_email) and
+                     request.get('edit', '1') == '1'),
+        'user': user,
+        'snippets': snippets,
+        'null_category': models.NULL_CATEGORY,
+    }
+
+
 class UserPage(BaseHandler):
     """Show all the snippets for a single user."""
 
@@ -188,45 +282,206 @@ class UserPage(BaseHandler):
             self.render_response('new_user.html', template_values)
             return
 
-        snippets = util.snippets_for_user(user_email)
-
-        if not _can_view_private_snippets(_current_user_email(), user_email):
-            snippets = [snippet for snippet in snippets if not snippet.private]
-        snippets = util.fill_in_missing_snippets(snippets, user,
-                                                 user_email, _TODAY_FN())
-        snippets.reverse()                  # get to newest snippet first
+        (snippets, older_week) = _snippets_for_user_page(user, user_email)
 
-        template_values = {
+        template_values = _snippet_list_template_values(
+            self.request, user, user_email, snippets)
+        template_values.update({
             'logout_url': users.create_logout_url('/'),
             'message': self.request.get('msg'),
-            'username': user_email,
             'is_admin': users.is_current_user_admin(),
-            'domain': user_email.split('@')[-1],
             'view_week': util.existingsnippet_monday(_TODAY_FN()),
-            # Snippets for the week of <one week ago> are due today.
-            'one_week_ago': _TODAY_FN().date() - datetime.timedelta(days=7),
-            'eight_days_ago': _TODAY_FN().date() - datetime.timedelta(days=8),
-            'editable': (_logged_in_user_has_permission_for(user_email) and
-                         self.request.get('edit', '1') == '1'),
-            'user': user,
-            'snippets': snippets,
-            'null_category': models.NULL_CATEGORY,
-        }
+            'older_week': older_week,
+        })
         self.render_response('user_snippets.html', template_values)
 
 
-def _title_case(s):
-    """Like string.title(), but does not uppercase 'and'."""
-    # Smarter would be to use 'pip install titlecase'.
-    SMALL = 'a|an|and|as|at|but|by|en|for|if|in|of|on|or|the|to|v\.?|via|vs\.?'
-    # We purposefully don't match small words at the beginning of a string.
-    SMALL_RE = re.compile(r' (%s)\b' % SMALL, re.I)
-    return SMALL_RE.sub(lambda m: ' ' + m.group(1).lower(), s.title().strip())
+class OlderSnippets(BaseHandler):
+    """Return an older page of a user's snippets, as json.
+
+    This is used by the 'load older snippets' button on the user page.
+    The json has two fields: 'html', the snippets for the
+    _USER_PAGE_WEEKS weeks ending with the week given by the 'week'
+    parameter, and 'next_week', the week to ask for to get the page
+    after this one (or null if there are no older snippets).
+    """
+
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+
+        if not users.get_current_user():
+            self.response.set_status(403)
+            self.response.out.write('{"status": 403, '
+                                    '"message": "not logged in"}')
+            return
+
+        user_email = self.request.get('u', _current_user_email())
+        user = util.get_user(user_email)
+        if not user:
+            self.response.set_status(404)
+            self.response.out.write('{"status": 404, '
+                                    '"message": "user not found"}')
+            return
+
+        week_string = self.request.get('week')
+        try:
+            week = datetime.datetime.strptime(week_string, '%m-%d-%Y').date()
+        except ValueError:
+            self.response.set_status(400)
+            self.response.out.write('{"status": 400, '
+                                    '"message": "bad week"}')
+            return
+        (snippets, older_week) = _snippets_for_user_page(user, user_email,
+                                                         end_week=week)
+
+        template_values = _snippet_list_template_values(
+            self.request, user, user_email, snippets)
+        html = self.jinja2.render_template('user_snippet_list.html',
+                                           **template_values)
+        self.response.out.write(json.dumps({
+            'html': html,
+            'next_week': (older_week.strftime('%m-%d-%Y')
+                          if older_week else None),
+        }))
+
+
+def _get_categories_and_snippets(week, can_view_private, categories=None):
+    """Return the snippets to show for the given week, by category.
+
+    can_view_private(email) says whether the viewer may see the
+    private snippets of the user with the given email.  categories is
+    the week's digest.categories(), if the caller already has them (or
+    only wants some of them).
+
+    Returns a sorted list, categories in alphabetical order and each
+    snippet-author within the category in alphabetical order:
+    ((category, ((snippet, user), ...)), ...).  For people who didn't
+    give a snippet (or whose snippet we can't see), we include an
+    empty snippet -- unless they're marked 'hidden'.  (That's what
+    'hidden' means: pretend they don't exist until they have a
+    non-empty snippet again.)
+    """
+    # The digest tells us who to show, and how; see digest.py.
+    if categories is None:
+        categories = digest.categories(digest.get(week))
+
+    # Get the text of all the snippets we have permission to view.
+    emails_to_fetch = []
+    for (_, entries) in categories:
+        for entry in entries:
+            if entry['has_snippet'] and (
+                    not entry['private'] or
+                    can_view_private(entry['email'])):
+                emails_to_fetch.append(entry['email'])
+    email_to_snippet = dict(zip(emails_to_fetch,
+                                util.get_snippets(emails_to_fetch, week)))
+
+    categories_and_snippets = []
+    for (category, entries) in categories:
+        snippets_and_users = []
+        for entry in entries:
+            user = models.User(email=entry['email'],
+                               display_name=entry['display_name'])
+            snippet = email_to_snippet.get(entry['email'])
+            if snippet:
+                snippets_and_users.append((snippet, user))
+            elif entry['is_user'] and not entry['is_hidden']:
+                snippet = models.Snippet(email=entry['email'], week=week)
+                snippets_and_users.append((snippet, user))
+        if snippets_and_users:
+            categories_and_snippets.append((category, snippets_and_users))
+    return categories_and_snippets
+
+
+# The rendered categories of /weekly are cached in memcache under
+# weekly:<app version>:<week>:<viewer's domain>:<digest revision>:
+# <snippets generation>:<md5 of the category name>.  Whenever a user
+# changes in a way that affects a week, its digest revision changes,
+# and whenever one of its snippets is saved, its snippets generation
+# does (see digest.py); so the cache never needs to be cleared.
+_WEEKLY_FRAGMENT_KEY = 'weekly:%s:%s:%s:%s:%s:%s'
+# While one request renders a week, others that want it wait for it
+# (up to this many seconds), rather than rendering it too.
+_WEEKLY_RENDER_WAIT = 2
+_WEEKLY_RENDER_POLL_INTERVAL = 0.1
+_SLEEP_FN = time.sleep
+
+
+def _email_domain(email):
+    """Return the part of email from the @ on, or '' if it hasn't one.
+
+    People with the same domain can see each other's private snippets;
+    see _can_view_private_snippets().
+    """
+    at = email.rfind('@')
+    return email[at:] if at != -1 else ''
 
 
 class SummaryPage(BaseHandler):
     """Show all the snippets for a single week."""
 
+    def _category_fragments(self, week, my_email):
+        """Return the html for each category of the week, from cache if we can.
+
+        Everyone in the same domain sees the same thing, so the cache
+        is by domain.
+        """
+        week_digest = digest.get(week)
+        # We get the generation before the snippets, so if a snippet
+        # is saved after we read it, we cache under a stale key.
+        snippets_generation = digest.snippets_generation(week)
+        categories = digest.categories(week_digest)
+        fragments = [None] * len(categories)
+        keys = None
+        if snippets_generation is not None:     # else memcache is down
+            prefix = (os.environ.get('CURRENT_VERSION_ID', ''),
+                      week.isoformat(), _email_domain(my_email),
+                      week_digest.revision, snippets_generation)
+            keys = [_WEEKLY_FRAGMENT_KEY % (prefix + (
+                        hashlib.md5(category.encode('utf-8')).hexdigest(),))
+                    for (category, _) in categories]
+
+        def fetch_cached(indices):
+            cached = memcache.get_multi([keys[i] for i in indices])
+            for i in indices:
+                fragments[i] = cached.get(keys[i])
+            return [i for i in indices if fragments[i] is None]
+
+        missing = range(len(categories))
+        if keys:
+            missing = fetch_cached(missing)
+            # If someone else is already rendering this, wait for them.
+            lock_key = 'lock:' + (_WEEKLY_FRAGMENT_KEY % (prefix + ('',)))
+            if missing and not memcache.add(lock_key, 1,
+                                            time=_WEEKLY_RENDER_WAIT):
+                waited = 0
+                while missing and waited < _WEEKLY_RENDER_WAIT:
+                    _SLEEP_FN(_WEEKLY_RENDER_POLL_INTERVAL)
+                    waited += _WEEKLY_RENDER_POLL_INTERVAL
+                    missing = fetch_cached(missing)
+
+        if missing:
+            categories_and_snippets = _get_categories_and_snippets(
+                week,
+                lambda email: _can_view_private_snippets(my_email, email),
+                [categories[i] for i in missing])
+            # Categories with no one to show don't come back; we cache
+            # them as empty.
+            rendered = dict((category, self.jinja2.render_template(
+                                'weekly_category.html', category=category,
+                                snippets_and_users=snippets_and_users))
+                            for (category, snippets_and_users)
+                            in categories_and_snippets)
+            for i in missing:
+                fragments[i] = rendered.get(categories[i][0], '')
+            if keys:
+                memcache.set_multi(dict(
+                    (keys[i], fragments[i]) for i in missing
+                    if len(fragments[i].encode('utf-8')) <
+                    memcache.MAX_VALUE_SIZE - 1024))   # room for overhead
+
+        return [fragment for fragment in fragments if fragment]
+
     def get(self):
         if not users.get_current_user():
             return _login_page(self.request, self)
@@ -237,70 +492,9 @@ class SummaryPage(BaseHandler):
         else:
             week = util.existingsnippet_monday(_TODAY_FN())
 
-        snippets_q = models.Snippet.all()
-        snippets_q.filter('week = ', week)
-        snippets = snippets_q.fetch(1000)   # good for many users...
         # TODO(csilvers): filter based on wants_to_view
-
-        # Get all the user records so we can categorize snippets.
-        user_q = models.User.all()
-        results = user_q.fetch(1000)
-        email_to_category = {}
-        email_to_user = {}
-        for result in results:
-            # People aren't very good about capitalizing their
-            # categories consistently, so we enforce title-case,
-            # with exceptions for 'and'.
-            email_to_category[result.email] = _title_case(result.category)
-            email_to_user[result.email] = result
-
-        # Collect the snippets and users by category.  As we see each email,
-        # delete it from email_to_category.  At the end of this,
-        # email_to_category will hold people who did not give
-        # snippets this week.
-        snippets_and_users_by_category = {}
-        for snippet in snippets:
-            # Ignore this snippet if we don't have permission to view it.
-            if (snippet.private and
-                    not _can_view_private_snippets(_current_user_email(),
-                                                   snippet.email)):
-                continue
-            category = email_to_category.get(
-                snippet.email, models.NULL_CATEGORY
-            )
-            if snippet.email in email_to_user:
-                snippets_and_users_by_category.setdefault(category, []).append(
-                    (snippet, email_to_user[snippet.email])
-                )
-            else:
-                snippets_and_users_by_category.setdefault(category, []).append(
-                    (snippet, models.User(email=snippet.email))
-                )
-
-            if snippet.email in email_to_category:
-                del email_to_category[snippet.email]
-
-        # Add in empty snippets for the people who didn't have any --
-        # unless a user is marked 'hidden'.  (That's what 'hidden'
-        # means: pretend they don't exist until they have a non-empty
-        # snippet again.)
-        for (email, category) in email_to_category.iteritems():
-            if not email_to_user[email].is_hidden:
-                snippet = models.Snippet(email=email, week=week)
-                snippets_and_users_by_category.setdefault(category, []).append(
-                    (snippet, email_to_user[snippet.email])
-                )
-
-        # Now get a sorted list, categories in alphabetical order and
-        # each snippet-author within the category in alphabetical
-        # order.
-        # The data structure is ((category, ((snippet, user), ...)), ...)
-        categories_and_snippets = []
-        for (category,
-             snippets_and_users) in snippets_and_users_by_category.iteritems():
-            snippets_and_users.sort(key=lambda (snippet, user): snippet.email)
-            categories_and_snippets.append((category, snippets_and_users))
-        categories_and_snippets.sort()
+        category_fragments = self._category_fragments(
+            week, _current_user_email())
 
         template_values = {
             'logout_url': users.create_logout_url('/'),
@@ -311,7 +505,7 @@ class SummaryPage(BaseHandler):
             'prev_week': week - datetime.timedelta(7),
             'view_week': week,
             'next_week': week + datetime.timedelta(7),
-            'categories_and_snippets': categories_and_snippets,
+            'category_fragments': category_fragments,
         }
         self.render_response('weekly_snippets.html', template_values)
 
@@ -327,33 +521,33 @@ class UpdateSnippet(BaseHandler):
         private = self.request.get('private') == 'True'
         is_markdown = self.request.get('is_markdown') == 'True'
 
-        # TODO(csilvers): make this get-update-put atomic.
-        # (maybe make the snippet id be email + week).
-        q = models.Snippet.all()
-        q.filter('email = ', email)
-        q.filter('week = ', week)
-        snippet = q.get()
-
         # When adding a snippet, make sure we create a user record for
         # that email as well, if it doesn't already exist.
         user = _get_or_create_user(email)
 
-        # Store user's display_name in snippet so that if a user is later
-        # deleted, we could still show his / her display_name.
-        if snippet:
-            snippet.text = text   # just update the snippet text
-            snippet.display_name = user.display_name
-            snippet.private = private
-            snippet.is_markdown = is_markdown
-        else:
-            # add the snippet to the db
-            snippet = models.Snippet(created=_TODAY_FN(),
-                                     display_name=user.display_name,
-                                     email=email, week=week,
-                                     text=text, private=private,
-                                     is_markdown=is_markdown)
-        db.put(snippet)
-        db.get(snippet.key())  # ensure db consistency for HRD
+        def update(snippet):
+            # Store user's display_name in snippet so that if a user is
+            # later deleted, we could still show his / her display_name.
+            if snippet:
+                snippet.display_name = user.display_name
+                snippet.private = private
+                snippet.is_markdown = is_markdown
+            else:
+                # add the snippet to the db
+                snippet = models.Snippet(
+                    key_name=models.Snippet.make_key_name(email, week),
+                    created=_TODAY_FN(),
+                    display_name=user.display_name,
+                    email=email, week=week,
+                    private=private,
+                    is_markdown=is_markdown)
+            snippet.set_text(text)
+            return snippet
+
+        # Since snippets are keyed by email+week, all our reads of
+        # this snippet are gets, which are strongly consistent, so
+        # there's no need to read it back here.
+        util.update_snippet(email, week, update)
 
         self.response.set_status(200)
 
@@ -419,11 +613,7 @@ class Settings(BaseHandler):
                                ' settings for %s' % user_email)
         # We won't put() the new user until the settings are saved.
         user = _get_or_create_user(user_email, put_new_user=False)
-        try:
-            user.key()
-            is_new_user = False
-        except db.NotSavedError:
-            is_new_user = True
+        is_new_user = not user.is_saved()
 
         template_values = {
             'logout_url': users.create_logout_url('/'),
@@ -460,12 +650,11 @@ class UpdateSettings(BaseHandler):
         # rather than 'save'.
         if self.request.get('hide'):
             user.is_hidden = True
-            user.put()
-            time.sleep(0.1)   # some time for eventual consistency
+            util.put_user(user)
             self.redirect('/weekly?msg=You+are+now+hidden.+Have+a+nice+day!')
             return
         elif self.request.get('delete'):
-            db.delete(user)
+            util.delete_user(user)
             self.redirect('/weekly?msg=Your+account+has+been+deleted.+'
                           '(Note+your+existing+snippets+have+NOT+been+'
                           'deleted.)+Have+a+nice+day!')
@@ -497,8 +686,7 @@ class UpdateSettings(BaseHandler):
         user.private_snippets = private_snippets
         user.wants_email = wants_email
         user.wants_to_view = wants_to_view
-        db.put(user)
-        db.get(user.key())  # ensure db consistency for HRD
+        util.put_user(user)
 
         redirect_to = self.request.get('redirect_to')
         if redirect_to == 'snippet_entry':   # true for new_user.html
@@ -548,6 +736,7 @@ class UpdateAppSettings(BaseHandler):
         default_email = self.request.get('reminder_email') == 'yes'
         email_from = self.request.get('email_from')
         slack_channel = self.request.get('slack_channel')
+        slack_post_digest = self.request.get('slack_post_digest') == 'yes'
         slack_token = self.request.get('slack_token')
         slack_slash_token = self.request.get('slack_slash_token')
 
@@ -565,11 +754,14 @@ class UpdateAppSettings(BaseHandler):
             app_settings.default_email = default_email
             app_settings.email_from = email_from
             app_settings.slack_channel = slack_channel
+            app_settings.slack_post_digest = slack_post_digest
             app_settings.slack_token = slack_token
             app_settings.slack_slash_token = slack_slash_token
             app_settings.put()
 
         update_settings()
+        # put() can't clear the cache from inside the transaction.
+        models.AppSettings.clear_cache()
 
         redirect_to = self.request.get('redirect_to')
         if redirect_to == 'user_setting':   # true for new_user.html
@@ -593,8 +785,7 @@ class ManageUsers(BaseHandler):
                 # TODO(csilvers): move this get/update/put atomic into a txn
                 user = util.get_user_or_die(email_of_user_to_hide)
                 user.is_hidden = True
-                user.put()
-                time.sleep(0.1)   # encourage eventual consistency
+                util.put_user(user)
                 self.redirect('/admin/manage_users?sort_by=%s&msg=%s+hidden'
                               % (sort_by, email_of_user_to_hide))
                 return
@@ -603,31 +794,30 @@ class ManageUsers(BaseHandler):
                 # TODO(csilvers): move this get/update/put atomic into a txn
                 user = util.get_user_or_die(email_of_user_to_unhide)
                 user.is_hidden = False
-                user.put()
-                time.sleep(0.1)   # encourage eventual consistency
+                util.put_user(user)
                 self.redirect('/admin/manage_users?sort_by=%s&msg=%s+unhidden'
                               % (sort_by, email_of_user_to_unhide))
                 return
             if name.startswith('delete '):
                 email_of_user_to_delete = name[len('delete '):]
                 user = util.get_user_or_die(email_of_user_to_delete)
-                db.delete(user)
-                time.sleep(0.1)   # encourage eventual consistency
+                util.delete_user(user)
                 self.redirect('/admin/manage_users?sort_by=%s&msg=%s+deleted'
                               % (sort_by, email_of_user_to_delete))
                 return
 
-        user_q = models.User.all()
-        results = user_q.fetch(1000)
+        # The directory doesn't have the snippet stats, which change
+        # too often, so we get those from the users themselves.
+        entries = directory.get().entries
+        user_models = util.get_users([user.email for user in entries])
 
         # Tuple: (email, is-hidden, creation-time, days since last snippet)
         user_data = []
-        for user in results:
-            # Get the last snippet for that user.
-            last_snippet = util.most_recent_snippet_for_user(user.email)
-            if last_snippet:
+        for (user, user_model) in zip(entries, user_models):
+            last_snippet_week = user_model and user_model.last_snippet_week
+            if last_snippet_week:
                 seconds_since_snippet = (
-                    (_TODAY_FN().date() - last_snippet.week).total_seconds())
+                    (_TODAY_FN().date() - last_snippet_week).total_seconds())
                 weeks_since_snippet = int(
                     seconds_since_snippet /
                     datetime.timedelta(days=7).total_seconds())
@@ -686,47 +876,200 @@ def _get_email_to_current_snippet_map(today):
       a map from email (user.email for each user) to True or False,
       depending on if they've written snippets for this week or not.
     """
-    user_q = models.User.all()
-    users = user_q.fetch(1000)
+    week = util.existingsnippet_monday(today)
+    # We only need to know who has a snippet, not what's in it, so
+    # we just get the keys, which tell us the email.
+    snippets_q = models.Snippet.all(keys_only=True)
+    snippets_q.filter('week = ', week)
+    # run() starts the query in the background; we read the user
+    # directory (which may mean querying all users) while it runs.
+    snippet_keys = snippets_q.run(limit=1000, batch_size=1000)
+
     retval = {}
-    for user in users:
+    for user in directory.get().entries:
         if not user.wants_email:         # ignore this user
             continue
         retval[user.email] = False       # assume the worst, for now
 
-    week = util.existingsnippet_monday(today)
-    snippets_q = models.Snippet.all()
-    snippets_q.filter('week = ', week)
-    snippets = snippets_q.fetch(1000)
-    for snippet in snippets:
-        if snippet.email in retval:      # don't introduce new keys here
-            retval[snippet.email] = True
+    emails_with_snippets = util.emails_for_snippet_keys(snippet_keys)
+    for email in retval:
+        if email.lower() in emails_with_snippets:
+            retval[email] = True
 
     return retval
 
 
-def _maybe_send_snippets_mail(to, subject, template_path, template_values):
+def _render_snippets_mail(body_cache, template_path, template_values):
+    """Return the body of the email for the given template and values.
+
+    body_cache is a dict, shared by every email in a cron run, from
+    (template_path, template_values) to the rendered body.  Most
+    recipients get exactly the same email, so this means we render
+    each distinct body just once per run.
+    """
+    cache_key = (template_path, tuple(sorted(template_values.iteritems())))
+    if cache_key not in body_cache:
+        # get_jinja2() returns the environment cached in the app
+        # registry, so the templates are only compiled once.
+        body_cache[cache_key] = jinja2.get_jinja2().render_template(
+            template_path, **template_values)
+    return body_cache[cache_key]
+
+
+# Appengine has a quota of 32 emails per minute:
+#    https://developers.google.com/appengine/docs/quotas#Mail
+# Rather than sleeping between emails, we send them from tasks on
+# the 'mail' queue, this many emails per task.  queue.yaml limits
+# the rate of that queue so we stay under the quota.  A task that
+# fails is retried, and resends every email in it -- including any
+# that were sent before it failed -- so we send just one per task.
+_MAIL_BATCH_SIZE = 1
+
+
+def _make_mail_tasks(recipients, subject, template_path, app_settings,
+                     body_cache):
+    """Return tasks that send an email to each of the given recipients.
+
+    recipients is a list of (email, template_values) pairs.  We
+    render the emails here, and SendMailBatch sends them at the rate
+    the 'mail' queue allows.  body_cache is as for
+    _render_snippets_mail().
+    """
+    tasks = []
+    for i in xrange(0, len(recipients), _MAIL_BATCH_SIZE):
+        # Each task holds the distinct bodies for its batch, and
+        # the recipients refer to them by index.
+        bodies = []
+        batch = []
+        for (email, template_values) in recipients[i:i + _MAIL_BATCH_SIZE]:
+            template_values = dict(template_values)
+            template_values.setdefault('hostname', app_settings.hostname)
+            body = _render_snippets_mail(body_cache, template_path,
+                                         template_values)
+            if body not in bodies:
+                bodies.append(body)
+            batch.append((email, bodies.index(body)))
+        tasks.append(taskqueue.Task(url='/admin/send_mail_batch',
+                                    params={'sender': app_settings.email_from,
+                                            'subject': subject,
+                                            'bodies': json.dumps(bodies),
+                                            'recipients': json.dumps(batch)}))
+    return tasks
+
+
+# We queue a cron's emails this many recipients at a time, each
+# chunk in a transaction that also records our progress in the
+# cron's MailRun.  App Engine allows at most 5 tasks to be added
+# in a transaction.
+_MAIL_RUN_CHUNK_SIZE = 5 * _MAIL_BATCH_SIZE
+
+# After this many chunks, we continue the run in a new request, so
+# no one request runs for too long however many users we have.
+_MAIL_RUN_CHUNKS_PER_REQUEST = 100
+
+
+def _send_mail_run(cron_url, week, recipients, subject, template_path):
+    """Queue the emails for a cron, picking up where any earlier try stopped.
+
+    Progress is recorded in the models.MailRun for this cron and
+    week, so a cron that is retried or re-run (or that dies halfway
+    through) never queues an email to anyone twice.  If there are
+    too many recipients to do in one go, we queue a task to request
+    cron_url again, which will continue from where we stopped.
+
+    Arguments:
+      cron_url: the url of the cron, which identifies the run.
+      week: the week the emails are for.
+      recipients: a list of (email, template_values) pairs.
+      subject, template_path: what to send.
+
+    Returns:
+      True if this call queued the last of the emails (or if email
+      is turned off), so the caller should do whatever comes after
+      sending the emails.  False if there's more to do, or if the
+      run was already finished.
+    """
     try:
         app_settings = models.AppSettings.get()
     except ValueError:
         logging.error('Not sending email: app settings are not configured.')
-        return
+        return False
     if not app_settings.email_from:
-        return
+        return True
+
+    key_name = models.MailRun.make_key_name(cron_url, week)
+    mail_run = models.MailRun.get_or_insert(key_name)
+    if mail_run.finished:
+        logging.info('Not sending email: %s already ran for %s'
+                     % (cron_url, week))
+        return False
+
+    recipients = sorted((r for r in recipients if r[0] > mail_run.cursor),
+                        key=lambda r: r[0])
+    chunks = [recipients[i:i + _MAIL_RUN_CHUNK_SIZE]
+              for i in xrange(0, len(recipients), _MAIL_RUN_CHUNK_SIZE)]
+    body_cache = {}
+    for chunk in chunks[:_MAIL_RUN_CHUNKS_PER_REQUEST]:
+        expected_cursor = mail_run.cursor
+
+        def txn():
+            mail_run = models.MailRun.get_by_key_name(key_name)
+            if mail_run.cursor != expected_cursor:
+                return None      # another request is doing this run
+            # We make new tasks each try, since a task can only be
+            # added once; the body cache makes this cheap.
+            tasks = _make_mail_tasks(chunk, subject, template_path,
+                                     app_settings, body_cache)
+            taskqueue.Queue('mail').add(tasks, transactional=True)
+            mail_run.cursor = chunk[-1][0]
+            mail_run.num_queued += len(chunk)
+            mail_run.put()
+            return mail_run
+
+        mail_run = db.run_in_transaction(txn)
+        if mail_run is None:
+            logging.warning('Stopping: someone else is running %s for %s'
+                            % (cron_url, week))
+            return False
+
+    if len(chunks) > _MAIL_RUN_CHUNKS_PER_REQUEST:
+        taskqueue.add(url=cron_url, method='GET')
+        logging.info('%s: queued %d emails so far; continuing in a task'
+                     % (cron_url, mail_run.num_queued))
+        return False
+
+    def finish_txn():
+        mail_run = models.MailRun.get_by_key_name(key_name)
+        if mail_run.finished:
+            return False
+        mail_run.finished = datetime.datetime.now()
+        mail_run.put()
+        return True
+
+    if not db.run_in_transaction(finish_txn):
+        return False
+    logging.info('%s: queued %d emails in all'
+                 % (cron_url, mail_run.num_queued))
+    return True
+
+
+class SendMailBatch(BaseHandler):
+    """Send one batch of the emails queued by _send_mail_run().
 
-    template_values.setdefault('hostname', app_settings.hostname)
+    This page should be restricted to admin users via app.yaml.
+    """
 
-    jinja2_instance = jinja2.get_jinja2()
-    mail.send_mail(sender=app_settings.email_from,
-                   to=to,
-                   subject=subject,
-                   body=jinja2_instance.render_template(template_path,
-                                                        **template_values))
-    # Appengine has a quota of 32 emails per minute:
-    #    https://developers.google.com/appengine/docs/quotas#Mail
-    # We pause 2 seconds between each email to make sure we
-    # don't go over that.
-    time.sleep(2)
+    def post(self):
+        sender = self.request.get('sender')
+        subject = self.request.get('subject')
+        bodies = json.loads(self.request.get('bodies'))
+        recipients = json.loads(self.request.get('recipients'))
+        mailer.get_transport().send(
+            [mailer.Message(sender=sender, to=email, subject=subject,
+                            body=bodies[body_index])
+             for (email, body_index) in recipients])
+        logging.debug('sent "%s" email to %s'
+                      % (subject, ', '.join(e for (e, _) in recipients)))
 
 
 class SendFridayReminderChat(BaseHandler):
@@ -740,45 +1083,86 @@ class SendFridayReminderChat(BaseHandler):
 class SendReminderEmail(BaseHandler):
     """Send an email to everyone who doesn't have a snippet for this week."""
 
-    def _send_mail(self, email):
-        template_values = {}
-        _maybe_send_snippets_mail(email, 'Weekly snippets due today at 5pm',
-                                  'reminder_email.txt', template_values)
-
     def get(self):
-        email_to_has_snippet = _get_email_to_current_snippet_map(_TODAY_FN())
-        for (user_email, has_snippet) in email_to_has_snippet.iteritems():
+        today = _TODAY_FN()
+        email_to_has_snippet = _get_email_to_current_snippet_map(today)
+        recipients = []
+        for (user_email, has_snippet) in sorted(
+                email_to_has_snippet.iteritems()):
             if not has_snippet:
-                self._send_mail(user_email)
-                logging.debug('sent reminder email to %s' % user_email)
+                recipients.append((user_email, {}))
             else:
                 logging.debug('did not send reminder email to %s: '
                               'has a snippet already' % user_email)
-
-        msg = 'Reminder: Weekly snippets due today at 5pm.'
-        _send_to_chat(msg, "/")
+        week = util.existingsnippet_monday(today)
+        if _send_mail_run(self.request.path, week, recipients,
+                          'Weekly snippets due today at 5pm',
+                          'reminder_email.txt'):
+            msg = 'Reminder: Weekly snippets due today at 5pm.'
+            _send_to_chat(msg, "/")
 
 
 class SendViewEmail(BaseHandler):
     """Send an email to everyone to look at the week's snippets."""
 
-    def _send_mail(self, email, has_snippets):
-        template_values = {'has_snippets': has_snippets}
-        _maybe_send_snippets_mail(email, 'Weekly snippets are ready!',
-                                  'view_email.txt', template_values)
+    def get(self):
+        today = _TODAY_FN()
+        email_to_has_snippet = _get_email_to_current_snippet_map(today)
+        recipients = [(user_email, {'has_snippets': has_snippet})
+                      for (user_email, has_snippet)
+                      in sorted(email_to_has_snippet.iteritems())]
+        week = util.existingsnippet_monday(today)
+        if _send_mail_run(self.request.path, week, recipients,
+                          'Weekly snippets are ready!', 'view_email.txt'):
+            msg = 'Weekly snippets are ready!'
+            _send_to_chat(msg, "/weekly")
+            _post_digest_to_chat(week)
+
+
+class UpdateDigest(BaseHandler):
+    """Update a week's digest for a snippet that was just saved.
+
+    util.update_snippet() queues these; see digest.update_for_snippet().
+    This page should be restricted to admin users via app.yaml.
+    """
+
+    def post(self):
+        week = datetime.datetime.strptime(self.request.get('week'),
+                                          '%Y-%m-%d').date()
+        digest.update_for_snippet(self.request.get('email'), week)
+
+
+class RunMigration(BaseHandler):
+    """Run one batch of a data migration, and queue up the next batch.
+
+    The migration to run is given by the 'name' parameter; see
+    migrations.py.  This page should be restricted to admin users
+    via app.yaml.
+    """
 
     def get(self):
-        email_to_has_snippet = _get_email_to_current_snippet_map(_TODAY_FN())
-        for (user_email, has_snippet) in email_to_has_snippet.iteritems():
-            self._send_mail(user_email, has_snippet)
-            logging.debug('sent "view" email to %s' % user_email)
+        name = self.request.get('name')
+        if name not in migrations.MIGRATIONS:
+            raise ValueError('Unknown migration "%s"' % name)
+
+        cursor = self.request.get('cursor') or None
+        (num_processed, cursor) = migrations.MIGRATIONS[name](cursor)
+        if cursor:
+            taskqueue.add(url='/admin/migrate', method='GET',
+                          params={'name': name, 'cursor': cursor})
+            status = 'continuing in the background'
+        else:
+            models.Migration(key_name=name).put()
+            status = 'done'
 
-        msg = 'Weekly snippets are ready!'
-        _send_to_chat(msg, "/weekly")
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('Migration %s: processed %d entities; %s.\n'
+                            % (name, num_processed, status))
 
 
 application = webapp2.WSGIApplication([
     ('/', UserPage),
+    ('/older_snippets', OlderSnippets),
     ('/weekly', SummaryPage),
     ('/update_snippet', UpdateSnippet),
     ('/settings', Settings),
@@ -789,6 +1173,14 @@ application = webapp2.WSGIApplication([
     ('/admin/send_friday_reminder_chat', SendFridayReminderChat),
     ('/admin/send_reminder_email', SendReminderEmail),
     ('/admin/send_view_email', SendViewEmail),
+    ('/admin/send_mail_batch', SendMailBatch),
+    ('/admin/update_digest', UpdateDigest),
+    ('/admin/migrate', RunMigration),
     ('/slack', slacklib.SlashCommand),
+    ('/admin/slack_command', slacklib.DeferredSlashCommand),
+    ('/admin/post_slack_digest', slacklib.PostSlackDigest),
+    ('/admin/sync_slack_users', slacklib.SyncSlackUsers),
+    ('/admin/slack_email_cache', slacklib.SlackEmailCacheStats),
+    ('/admin/slash_command_stats', slacklib.SlashCommandStats),
     ],
     debug=True)
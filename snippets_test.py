@@ -11,11 +11,13 @@ c.f. http://webtest.pythonpaste.org/en/latest/index.html
 __author__ = 'Craig Silverstein <csilvers@khanacademy.org>'
 
 
+import base64
 import datetime
+import json
 import os
 import re
 import sys
-import time
+import urlparse
 try:   # Work under either python2.5 or python2.7
     import unittest2 as unittest
 except ImportError:
@@ -28,14 +30,23 @@ sys.path.extend(os.environ['PATH'].split(':'))
 import dev_appserver
 dev_appserver.fix_sys_path()
 
+from google.appengine.api import memcache
+from google.appengine.api import queueinfo
+from google.appengine.api import taskqueue
 from google.appengine.datastore import datastore_stub_util
 from google.appengine.ext import db
 from google.appengine.ext import testbed
 import webtest   # may need to do 'pip install webtest'
 
+import digest
+import directory
+import mailer
+import markdown_html
+import migrations
 import models
 import slacklib
 import snippets
+import util
 
 
 _TEST_TODAY = datetime.datetime(2012, 2, 23)
@@ -49,9 +60,16 @@ class SnippetsTestBase(unittest.TestCase):
         policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
             probability=1)
         self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
         self.testbed.init_user_stub()
+        self.testbed.init_taskqueue_stub(
+            root_path=os.path.dirname(os.path.abspath(__file__)))
+        self.taskqueue_stub = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
         self.request_fetcher = webtest.TestApp(snippets.application)
         snippets._TODAY_FN = lambda: _TEST_TODAY
+        # The datastore is new for each test, so forget what's migrated.
+        models.Migration._known_finished.clear()
 
         # Make sure we never accidentally send messages to chat.
         self.old_send_to_slack_channel = slacklib.send_to_slack_channel
@@ -75,9 +93,51 @@ class SnippetsTestBase(unittest.TestCase):
         settings.hostname = 'https://example.com'
         settings.put()
 
+    def set_eventually_consistent(self):
+        """Make queries never see writes that haven't been read by key."""
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=0)
+        self.testbed.get_stub(testbed.DATASTORE_SERVICE_NAME
+                              ).SetConsistencyPolicy(policy)
+
     def set_is_admin(self):
         self.testbed.setup_env(user_is_admin='1', overwrite=True)
 
+    def run_tasks(self):
+        """Run all queued tasks, and the tasks they queue, until done."""
+        while True:
+            tasks = [(queue['name'], task)
+                     for queue in self.taskqueue_stub.GetQueues()
+                     for task in self.taskqueue_stub.GetTasks(queue['name'])]
+            if not tasks:
+                return
+            for (queue_name, task) in tasks:
+                self.taskqueue_stub.DeleteTask(queue_name, task['name'])
+                if task['method'] == 'GET':
+                    self.request_fetcher.get(task['url'])
+                else:
+                    self.request_fetcher.post(task['url'],
+                                              base64.b64decode(task['body']))
+
+    def get_user_page_with_history(self, url='/'):
+        """Return a user page's body, with all older snippets appended.
+
+        This simulates clicking on 'load older snippets' until there
+        is nothing more to load.
+        """
+        body = self.request_fetcher.get(url).body
+        m = re.search(r'data-u="([^"]*)"\s+data-week="([^"]*)"'
+                      r'\s+data-edit="([^"]*)"', body)
+        if not m:
+            return body
+        (username, week, edit) = m.groups()
+        while week:
+            response = self.request_fetcher.get(
+                '/older_snippets', {'u': username, 'week': week, 'edit': edit})
+            body += response.json['html'].encode('utf-8')
+            week = response.json['next_week']
+        return body
+
     def assertNumSnippets(self, body, expected_count):
         """Assert the page 'body' has exactly expected_count snippets in it."""
         # We annotate the div at the beginning of each snippet with
@@ -190,6 +250,490 @@ class PostTestCase(SnippetsTestBase):
         self.assertInSnippet('>my snippet<', response.body, 2)
 
 
+class SnippetKeyTestCase(UserTestBase):
+    """Test that snippets are stored under their email+week key."""
+
+    def testSnippetIsKeyedByEmailAndWeek(self):
+        url = '/update_snippet?week=02-20-2012&snippet=my+snippet'
+        self.request_fetcher.get(url)
+        snippet = models.Snippet.get_by_key_name('user@example.com|2012-02-20')
+        self.assertEqual('my snippet', snippet.text)
+
+    def testUpdatingSnippetKeepsOneEntity(self):
+        url = '/update_snippet?week=02-20-2012&snippet=my+snippet'
+        self.request_fetcher.get(url)
+        url = '/update_snippet?week=02-20-2012&snippet=new+snippet'
+        self.request_fetcher.get(url)
+        all_snippets = models.Snippet.all().fetch(10)
+        self.assertEqual(1, len(all_snippets))
+        self.assertEqual('new snippet', all_snippets[0].text)
+
+    def testUpdatingOldStyleSnippetRekeysIt(self):
+        db.put(models.Snippet(email='user@example.com',
+                              week=datetime.date(2012, 2, 20),
+                              text='old-style snippet'))
+        url = '/update_snippet?week=02-20-2012&snippet=new+snippet'
+        self.request_fetcher.get(url)
+        all_snippets = models.Snippet.all().fetch(10)
+        self.assertEqual(1, len(all_snippets))
+        self.assertEqual('user@example.com|2012-02-20',
+                         all_snippets[0].key().name())
+        self.assertEqual('new snippet', all_snippets[0].text)
+
+    def testWritesRememberTheMigrationIsFinished(self):
+        models.Migration(key_name='snippet_keys').put()
+        url = '/update_snippet?week=02-13-2012&snippet=my+snippet'
+        self.request_fetcher.get(url)
+        # The write above saw the migration was finished; later writes
+        # shouldn't look again, and so won't see this is gone.
+        models.Migration.get_by_key_name('snippet_keys').delete()
+        memcache.flush_all()
+        db.put(models.Snippet(email='user@example.com',
+                              week=datetime.date(2012, 2, 20),
+                              text='old-style snippet'))
+        url = '/update_snippet?week=02-20-2012&snippet=new+snippet'
+        self.request_fetcher.get(url)
+        self.assertEqual(3, models.Snippet.all().count())
+
+    def testMigration(self):
+        self.set_is_admin()
+        for day in (6, 13, 20):
+            db.put(models.Snippet(email='user@example.com',
+                                  week=datetime.date(2012, 2, day),
+                                  text='snippet %d' % day))
+        old_batch_size = migrations._BATCH_SIZE
+        migrations._BATCH_SIZE = 2
+        try:
+            self.request_fetcher.get('/admin/migrate?name=snippet_keys')
+            self.run_tasks()
+        finally:
+            migrations._BATCH_SIZE = old_batch_size
+
+        all_snippets = models.Snippet.all().fetch(10)
+        self.assertEqual(['user@example.com|2012-02-06',
+                          'user@example.com|2012-02-13',
+                          'user@example.com|2012-02-20'],
+                         sorted(s.key().name() for s in all_snippets))
+        self.assertTrue(models.Migration.is_finished('snippet_keys'))
+
+        self.request_fetcher.get('/update_settings')   # register the user
+        response = self.request_fetcher.get('/')
+        self.assertInSnippet('>snippet 20<', response.body, 0)
+
+    def testUnknownMigration(self):
+        self.set_is_admin()
+        self.request_fetcher.get('/admin/migrate?name=unknown', status=500)
+
+
+class UserKeyTestCase(UserTestBase):
+    """Test that users are stored under their email key."""
+
+    def testUserIsKeyedByEmail(self):
+        self.request_fetcher.get('/update_settings?category=dummy')
+        user = models.User.get_by_key_name('user@example.com')
+        self.assertEqual('dummy', user.category)
+
+    def testOldStyleUserIsRekeyedOnLookup(self):
+        db.put(models.User(email='user@example.com', category='old',
+                           created=_TEST_TODAY))
+        response = self.request_fetcher.get('/')
+        self.assertNotIn('<title>New user</title>', response.body)
+        all_users = models.User.all().fetch(10)
+        self.assertEqual(1, len(all_users))
+        self.assertEqual('user@example.com', all_users[0].key().name())
+        self.assertEqual('old', all_users[0].category)
+
+    def testGetUsers(self):
+        self.request_fetcher.get('/update_settings?category=dummy')
+        db.put(models.User(email='old@example.com'))
+        users = util.get_users(['old@example.com', 'nobody@example.com',
+                                'USER@example.com'])
+        self.assertEqual('old@example.com', users[0].email)
+        self.assertEqual(None, users[1])
+        self.assertEqual('user@example.com', users[2].email)
+
+    def testMigration(self):
+        self.set_is_admin()
+        db.put([models.User(email='user%d@example.com' % i)
+                for i in xrange(3)])
+        self.request_fetcher.get('/admin/migrate?name=user_keys')
+        self.run_tasks()
+
+        all_users = models.User.all().fetch(10)
+        self.assertEqual(['user0@example.com', 'user1@example.com',
+                          'user2@example.com'],
+                         sorted(u.key().name() for u in all_users))
+        self.assertTrue(models.Migration.is_finished('user_keys'))
+
+    def testFinishedMigrationIsRemembered(self):
+        self.assertFalse(models.Migration.is_finished('user_keys'))
+        models.Migration(key_name='user_keys').put()
+        self.assertTrue(models.Migration.is_finished('user_keys'))
+        # Now neither the datastore nor memcache is consulted.
+        models.Migration.get_by_key_name('user_keys').delete()
+        memcache.flush_all()
+        self.assertTrue(models.Migration.is_finished('user_keys'))
+
+
+class UserSnippetStatsTestCase(UserTestBase):
+    """Test the snippet stats we denormalize onto the User."""
+
+    def _stats(self):
+        user = models.User.get_by_key_name('user@example.com')
+        return (user.num_snippet_weeks, user.last_snippet_week)
+
+    def testNewUser(self):
+        self.request_fetcher.get('/update_settings')
+        self.assertEqual((0, None), self._stats())
+
+    def testStatsAreUpdated(self):
+        url = '/update_snippet?week=02-20-2012&snippet=my+snippet'
+        self.request_fetcher.get(url)
+        self.assertEqual((1, datetime.date(2012, 2, 20)), self._stats())
+
+        url = '/update_snippet?week=02-06-2012&snippet=older+snippet'
+        self.request_fetcher.get(url)
+        self.assertEqual((2, datetime.date(2012, 2, 20)), self._stats())
+
+    def testUpdatingSnippetDoesNotCountTwice(self):
+        url = '/update_snippet?week=02-20-2012&snippet=my+snippet'
+        self.request_fetcher.get(url)
+        url = '/update_snippet?week=02-20-2012&snippet=new+snippet'
+        self.request_fetcher.get(url)
+        self.assertEqual((1, datetime.date(2012, 2, 20)), self._stats())
+
+    def testBackfillMigration(self):
+        self.set_is_admin()
+        self.request_fetcher.get('/update_settings')
+        for day in (6, 13, 20):
+            db.put(models.Snippet(
+                key_name=models.Snippet.make_key_name('user@example.com',
+                                                      datetime.date(2012, 2,
+                                                                    day)),
+                email='user@example.com',
+                week=datetime.date(2012, 2, day),
+                text='snippet %d' % day))
+        self.assertEqual((0, None), self._stats())
+
+        self.request_fetcher.get('/admin/migrate?name=user_snippet_stats')
+        self.run_tasks()
+        self.assertEqual((3, datetime.date(2012, 2, 20)), self._stats())
+
+    def testBackfillMigrationRacingASnippetSave(self):
+        self.set_is_admin()
+        self.request_fetcher.get('/update_settings')
+        db.put(models.Snippet(
+            key_name=models.Snippet.make_key_name('user@example.com',
+                                                  datetime.date(2012, 2, 6)),
+            email='user@example.com',
+            week=datetime.date(2012, 2, 6),
+            text='old snippet'))
+
+        # Save a new snippet after the migration counts the snippets,
+        # but before it writes the stats.
+        old_most_recent_snippet_for_user = util.most_recent_snippet_for_user
+        saves = []
+
+        def most_recent_snippet_for_user(email):
+            retval = old_most_recent_snippet_for_user(email)
+            if not saves:
+                saves.append(util.update_snippet(
+                    email, datetime.date(2012, 2, 20),
+                    lambda _: models.Snippet(
+                        key_name=models.Snippet.make_key_name(
+                            email, datetime.date(2012, 2, 20)),
+                        email=email, week=datetime.date(2012, 2, 20),
+                        text='new snippet')))
+            return retval
+
+        util.most_recent_snippet_for_user = most_recent_snippet_for_user
+        try:
+            self.request_fetcher.get('/admin/migrate?name=user_snippet_stats')
+            self.run_tasks()
+        finally:
+            util.most_recent_snippet_for_user = (
+                old_most_recent_snippet_for_user)
+        self.assertEqual((2, datetime.date(2012, 2, 20)), self._stats())
+
+
+class WeeklyDigestTestCase(UserTestBase):
+    """Test the per-week digest that backs /weekly."""
+
+    def _digest(self, week=datetime.date(2012, 2, 20)):
+        return models.WeeklyDigest.get_by_key_name(week.isoformat())
+
+    def testDigestIsBuiltOnFirstView(self):
+        self.request_fetcher.get('/update_snippet?week=02-20-2012&snippet=hi')
+        self.assertEqual(None, self._digest())
+        self.request_fetcher.get('/weekly?week=02-20-2012')
+        self.assertEqual(1, self._digest().revision)
+
+    def testSnippetUpdatesDigestInPlace(self):
+        self.request_fetcher.get('/update_settings')
+        self.request_fetcher.get('/weekly?week=02-20-2012')
+        token = self._digest().user_directory_token
+
+        self.request_fetcher.get('/update_snippet?week=02-20-2012&snippet=hi')
+        # The digest is updated in a task, not by the save itself.
+        self.assertEqual(1, self._digest().revision)
+        self.run_tasks()
+        self.assertEqual(2, self._digest().revision)
+        self.assertEqual(token, self._digest().user_directory_token)
+
+        # Editing the text of an existing snippet doesn't touch the digest.
+        self.request_fetcher.get('/update_snippet?week=02-20-2012&snippet=ho')
+        self.run_tasks()
+        self.assertEqual(2, self._digest().revision)
+
+        response = self.request_fetcher.get('/weekly?week=02-20-2012')
+        self.assertNumSnippets(response.body, 1)
+        self.assertInSnippet('ho', response.body, 0)
+        self.assertEqual(2, self._digest().revision)
+
+    def testSnippetFromUnknownAuthorUpdatesDigest(self):
+        self.request_fetcher.get('/update_settings')
+        self.request_fetcher.get('/weekly?week=02-20-2012')
+        week = datetime.date(2012, 2, 20)
+        util.put_snippet(models.Snippet(
+            key_name=models.Snippet.make_key_name('nobody@example.com', week),
+            email='nobody@example.com', week=week, text='hi'))
+        self.run_tasks()
+        self.assertEqual(
+            [('(Unknown)', ['user@example.com']),
+             ('(unknown)', ['nobody@example.com'])],
+            [(category, [e['email'] for e in entries])
+             for (category, entries) in digest.categories(self._digest())])
+
+    def testFirstBuildIsConsistent(self):
+        self.set_eventually_consistent()
+        self.request_fetcher.get('/update_settings')
+        self.request_fetcher.get('/update_snippet?week=02-20-2012&snippet=hi')
+        response = self.request_fetcher.get('/weekly?week=02-20-2012')
+        self.assertNumSnippets(response.body, 1)
+        self.assertInSnippet('hi', response.body, 0)
+
+    def testSnippetSavedDuringFirstBuildIsKept(self):
+        self.set_eventually_consistent()
+        self.request_fetcher.get('/update_settings')
+        week = datetime.date(2012, 2, 20)
+        new_digest = digest._build(week)
+        # A snippet from someone the directory doesn't know about is
+        # saved after we read the snippets, but before we save.
+        util.put_snippet(models.Snippet(
+            key_name=models.Snippet.make_key_name('nobody@example.com', week),
+            email='nobody@example.com', week=week, text='hi'))
+        self.run_tasks()
+        digest._save(week, new_digest, None)
+
+        self.assertEqual(
+            [('(Unknown)', [('user@example.com', False)]),
+             ('(unknown)', [('nobody@example.com', True)])],
+            [(category, [(e['email'], e['has_snippet']) for e in entries])
+             for (category, entries) in digest.categories(digest.get(week))])
+
+    def testPrivacyChangeUpdatesDigest(self):
+        self.request_fetcher.get('/update_snippet?week=02-20-2012&snippet=hi')
+        self.request_fetcher.get('/weekly?week=02-20-2012')
+        self.request_fetcher.get(
+            '/update_snippet?week=02-20-2012&snippet=hi&private=True')
+        self.run_tasks()
+        self.assertEqual(
+            [True],
+            [e['private'] for (_, entries) in digest.categories(self._digest())
+             for e in entries])
+
+    def testUserChangeRebuildsDigest(self):
+        self.request_fetcher.get('/update_snippet?week=02-20-2012&snippet=hi')
+        self.request_fetcher.get('/weekly?week=02-20-2012')
+        self.request_fetcher.get('/update_settings?category=new+category')
+        response = self.request_fetcher.get('/weekly?week=02-20-2012')
+        self.assertIn('New Category', response.body)
+        self.assertEqual(2, self._digest().revision)
+
+    def testUnrelatedUserChangeDoesNotWriteDigest(self):
+        self.request_fetcher.get('/update_snippet?week=02-20-2012&snippet=hi')
+        self.request_fetcher.get('/weekly?week=02-20-2012')
+        token = self._digest().user_directory_token
+        directory.bump()
+        response = self.request_fetcher.get('/weekly?week=02-20-2012')
+        self.assertNumSnippets(response.body, 1)
+        self.assertEqual(1, self._digest().revision)
+        self.assertEqual(token, self._digest().user_directory_token)
+
+    def testDigestIsNotWrittenWithoutMemcache(self):
+        self.request_fetcher.get('/update_snippet?week=02-20-2012&snippet=hi')
+        old_generation = directory.generation
+        directory.generation = lambda: None
+        try:
+            response = self.request_fetcher.get('/weekly?week=02-20-2012')
+            self.assertNumSnippets(response.body, 1)
+            self.assertEqual(None, self._digest())
+        finally:
+            directory.generation = old_generation
+
+    def testFailedSaveStillServesDigest(self):
+        self.request_fetcher.get('/update_snippet?week=02-20-2012&snippet=hi')
+
+        def failing_save(week, new_digest, old_digest):
+            raise db.TransactionFailedError()
+
+        old_save = digest._save
+        digest._save = failing_save
+        try:
+            response = self.request_fetcher.get('/weekly?week=02-20-2012')
+            self.assertNumSnippets(response.body, 1)
+        finally:
+            digest._save = old_save
+
+    def testRebuildMigration(self):
+        self.set_is_admin()
+        for day in (6, 13, 20):
+            week = datetime.date(2012, 2, day)
+            db.put(models.Snippet(
+                key_name=models.Snippet.make_key_name('user@example.com',
+                                                      week),
+                email='user@example.com', week=week, text='snippet'))
+        self.request_fetcher.get('/admin/migrate?name=weekly_digests')
+        self.run_tasks()
+        for day in (6, 13, 20):
+            week_digest = self._digest(datetime.date(2012, 2, day))
+            self.assertEqual(1, week_digest.revision)
+            self.assertEqual(
+                [(models.NULL_CATEGORY, [True])],
+                [(category, [e['has_snippet'] for e in entries])
+                 for (category, entries) in digest.categories(week_digest)])
+
+
+class WeeklyCacheTestCase(UserTestBase):
+    """Test that /weekly caches what it renders, and knows when not to."""
+
+    def setUp(self):
+        super(WeeklyCacheTestCase, self).setUp()
+        self.request_fetcher.get('/update_settings?category=eng')
+        self.request_fetcher.get(
+            '/update_snippet?week=02-20-2012&snippet=public+stuff')
+        self.login('private@example.com')
+        self.request_fetcher.get('/update_settings?category=eng')
+        self.request_fetcher.get(
+            '/update_snippet?week=02-20-2012&snippet=secret+stuff'
+            '&private=True')
+        self.login('user@example.com')
+
+    def _view_weekly(self):
+        """Return the body of /weekly, and how many categories we rendered."""
+        rendered = []
+        old_render_template = snippets.jinja2.Jinja2.__dict__[
+            'render_template']
+
+        def render_template(jinja2_self, template_path, **template_values):
+            if template_path == 'weekly_category.html':
+                rendered.append(template_values['category'])
+            return old_render_template(jinja2_self, template_path,
+                                       **template_values)
+
+        snippets.jinja2.Jinja2.render_template = render_template
+        try:
+            response = self.request_fetcher.get('/weekly?week=02-20-2012')
+        finally:
+            snippets.jinja2.Jinja2.render_template = old_render_template
+        return (response.body, len(rendered))
+
+    def testRenderedOncePerDomain(self):
+        (body, num_rendered) = self._view_weekly()
+        self.assertEqual(1, num_rendered)
+        self.assertIn('secret stuff', body)
+
+        self.login('someone@example.com')
+        (body, num_rendered) = self._view_weekly()
+        self.assertEqual(0, num_rendered)
+        self.assertIn('secret stuff', body)
+
+        # Other domains can't see the private snippet, so they get
+        # their own rendering.
+        self.login('someone@some_other_domain.com')
+        (body, num_rendered) = self._view_weekly()
+        self.assertEqual(1, num_rendered)
+        self.assertIn('public stuff', body)
+        self.assertNotIn('secret stuff', body)
+
+    def testSnippetSaveIsSeen(self):
+        self._view_weekly()
+        self.request_fetcher.get(
+            '/update_snippet?week=02-20-2012&snippet=edited+stuff')
+        (body, num_rendered) = self._view_weekly()
+        self.assertEqual(1, num_rendered)
+        self.assertIn('edited stuff', body)
+
+    def testUserChangeIsSeen(self):
+        self._view_weekly()
+        self.request_fetcher.get('/update_settings?category=eng'
+                                 '&display_name=Tester+McTest')
+        (body, num_rendered) = self._view_weekly()
+        self.assertEqual(1, num_rendered)
+        self.assertIn('Tester McTest', body)
+
+    def testWithoutMemcache(self):
+        old_snippets_generation = digest.snippets_generation
+        digest.snippets_generation = lambda week: None
+        try:
+            self.assertEqual(1, self._view_weekly()[1])
+            self.assertEqual(1, self._view_weekly()[1])
+        finally:
+            digest.snippets_generation = old_snippets_generation
+
+
+class UserDirectoryTestCase(UserTestBase):
+    """Test the cached snapshot of all users."""
+
+    def testSnapshot(self):
+        self.request_fetcher.get('/update_settings?category=a+team')
+        entries = directory.get().entries
+        self.assertEqual(['user@example.com'], [e.email for e in entries])
+        self.assertEqual('A Team', entries[0].category)
+
+    def testSnapshotIsCached(self):
+        self.request_fetcher.get('/update_settings')
+        directory.get()
+        db.put(models.User(key_name='sneaky@example.com',
+                           email='sneaky@example.com'))
+        self.assertEqual(['user@example.com'],
+                         [e.email for e in directory.get().entries])
+        directory.bump()
+        self.assertEqual(['sneaky@example.com', 'user@example.com'],
+                         [e.email for e in directory.get().entries])
+
+    def testSnippetWritesDontBumpGeneration(self):
+        self.request_fetcher.get('/update_settings')
+        generation = directory.generation()
+        self.request_fetcher.get('/update_snippet?week=02-20-2012&snippet=hi')
+        self.assertEqual(generation, directory.generation())
+
+    def testSnapshotSeesRecentWrites(self):
+        self.set_eventually_consistent()
+        self.request_fetcher.get('/update_settings?category=a+team')
+        self.assertEqual([('user@example.com', 'A Team')],
+                         [(e.email, e.category)
+                          for e in directory.get().entries])
+        self.request_fetcher.get('/update_settings?category=b+team')
+        self.assertEqual([('user@example.com', 'B Team')],
+                         [(e.email, e.category)
+                          for e in directory.get().entries])
+        util.delete_user(util.get_user('user@example.com'))
+        self.assertEqual([], directory.get().entries)
+
+    def testUserWritesBumpGeneration(self):
+        self.request_fetcher.get('/update_settings')
+        generation = directory.generation()
+        self.request_fetcher.get('/update_settings?category=new')
+        self.assertTrue(directory.generation() > generation)
+
+    def testEvictedGenerationStartsHigher(self):
+        generation = directory.generation()
+        directory.bump()
+        memcache.flush_all()
+        self.assertTrue(directory.generation() > generation + 1)
+
+
 class LoginRequiredTestCase(SnippetsTestBase):
     def assert_requires_login(self, response):
         """Assert that a response causes us to redirect to the login page."""
@@ -438,6 +982,25 @@ class AppSettingsTestCase(UserTestBase):
         self.assertEqual(['a.com', 'b.com', 'c.com', 'd.com'],
                          app_settings.domains)
 
+    def testSettingsAreCached(self):
+        memcache.flush_all()
+        self.assertEqual('https://example.com',
+                         models.AppSettings.get().hostname)
+        # Change the settings behind the cache's back.
+        app_settings = models.AppSettings.get_by_key_name('global_settings')
+        app_settings.hostname = 'https://uncached.example.com'
+        db.put(app_settings)
+        self.assertEqual('https://example.com',
+                         models.AppSettings.get().hostname)
+
+    def testUpdatingSettingsClearsCache(self):
+        memcache.flush_all()
+        models.AppSettings.get()    # populates the cache
+        self.request_fetcher.get('/admin/update_settings?domains=a.com')
+        self.assertEqual(['a.com'], models.AppSettings.get().domains)
+        self.request_fetcher.get('/admin/update_settings?domains=b.com')
+        self.assertEqual(['b.com'], models.AppSettings.get().domains)
+
 
 class UserSettingsTestCase(UserTestBase):
     """Test setting and using user settings."""
@@ -477,34 +1040,34 @@ class UserSettingsTestCase(UserTestBase):
     def testSettingsForFilledInSnippets(self):
         url = '/update_snippet?week=02-21-2011&snippet=old+snippet'
         self.request_fetcher.get(url)
-        response = self.request_fetcher.get('/')
-        self.assertNumSnippets(response.body, 53)
-        self.assertInputIsNotChecked('private', response.body, 9)
-        self.assertInputIsNotChecked('is_markdown', response.body, 9)
-        self.assertInSnippet('old snippet', response.body, 52)
-        self.assertInputIsNotChecked('private', response.body, 52)
-        self.assertInputIsNotChecked('is_markdown', response.body, 52)
+        body = self.get_user_page_with_history()
+        self.assertNumSnippets(body, 53)
+        self.assertInputIsNotChecked('private', body, 9)
+        self.assertInputIsNotChecked('is_markdown', body, 9)
+        self.assertInSnippet('old snippet', body, 52)
+        self.assertInputIsNotChecked('private', body, 52)
+        self.assertInputIsNotChecked('is_markdown', body, 52)
 
         self.request_fetcher.get(
             '/update_settings?u=user@example.com&markdown=yes')
-        response = self.request_fetcher.get('/')
-        self.assertNumSnippets(response.body, 53)
-        self.assertInputIsNotChecked('private', response.body, 9)
-        self.assertInputIsChecked('is_markdown', response.body, 9)
+        body = self.get_user_page_with_history()
+        self.assertNumSnippets(body, 53)
+        self.assertInputIsNotChecked('private', body, 9)
+        self.assertInputIsChecked('is_markdown', body, 9)
         # But the existing snippet is unaffected.
-        self.assertInSnippet('old snippet', response.body, 52)
-        self.assertInputIsNotChecked('private', response.body, 52)
-        self.assertInputIsNotChecked('is_markdown', response.body, 52)
+        self.assertInSnippet('old snippet', body, 52)
+        self.assertInputIsNotChecked('private', body, 52)
+        self.assertInputIsNotChecked('is_markdown', body, 52)
 
         self.request_fetcher.get(
             '/update_settings?u=user@example.com&private=yes')
-        response = self.request_fetcher.get('/')
-        self.assertNumSnippets(response.body, 53)
-        self.assertInputIsChecked('private', response.body, 9)
-        self.assertInputIsNotChecked('is_markdown', response.body, 9)
-        self.assertInSnippet('old snippet', response.body, 52)
-        self.assertInputIsNotChecked('private', response.body, 52)
-        self.assertInputIsNotChecked('is_markdown', response.body, 52)
+        body = self.get_user_page_with_history()
+        self.assertNumSnippets(body, 53)
+        self.assertInputIsChecked('private', body, 9)
+        self.assertInputIsNotChecked('is_markdown', body, 9)
+        self.assertInSnippet('old snippet', body, 52)
+        self.assertInputIsNotChecked('private', body, 52)
+        self.assertInputIsNotChecked('is_markdown', body, 52)
 
     def testCategoryUnset(self):
         self.request_fetcher.get('/update_settings?u=user@example.com')
@@ -537,16 +1100,16 @@ class UserSettingsTestCase(UserTestBase):
     def testCategoryCheckForFilledInSnippets(self):
         url = '/update_snippet?week=02-21-2011&snippet=old+snippet'
         self.request_fetcher.get(url)
-        response = self.request_fetcher.get('/')
-        self.assertNumSnippets(response.body, 53)
+        body = self.get_user_page_with_history()
+        self.assertNumSnippets(body, 53)
         self.assertInSnippet(
             '<strong>WARNING:</strong> Snippet will go in the "(unknown)"',
-            response.body, 9
+            body, 9
         )
-        self.assertInSnippet('old snippet', response.body, 52)
+        self.assertInSnippet('old snippet', body, 52)
         self.assertInSnippet(
             '<strong>WARNING:</strong> Snippet will go in the "(unknown)"',
-            response.body, 52
+            body, 52
         )
 
     def testHiddenUser(self):
@@ -956,9 +1519,9 @@ class NosnippetGapFillingTestCase(UserTestBase):
     def testOneSnippetInDistantPast(self):
         url = '/update_snippet?week=02-21-2011&snippet=old+snippet'
         self.request_fetcher.get(url)
-        response = self.request_fetcher.get('/')
-        self.assertNumSnippets(response.body, 53)
-        self.assertInSnippet('old snippet', response.body, 52)
+        body = self.get_user_page_with_history()
+        self.assertNumSnippets(body, 53)
+        self.assertInSnippet('old snippet', body, 52)
 
         response = self.request_fetcher.get('/weekly')
         self.assertNumSnippets(response.body, 1)
@@ -968,10 +1531,10 @@ class NosnippetGapFillingTestCase(UserTestBase):
         self.request_fetcher.get(url)
         url = '/update_snippet?week=02-21-2011&snippet=old+snippet'
         self.request_fetcher.get(url)
-        response = self.request_fetcher.get('/')
-        self.assertNumSnippets(response.body, 53)
-        self.assertInSnippet('oldish snippet', response.body, 26)
-        self.assertInSnippet('old snippet', response.body, 52)
+        body = self.get_user_page_with_history()
+        self.assertNumSnippets(body, 53)
+        self.assertInSnippet('oldish snippet', body, 26)
+        self.assertInSnippet('old snippet', body, 52)
 
         response = self.request_fetcher.get('/weekly')
         self.assertNumSnippets(response.body, 1)
@@ -991,15 +1554,81 @@ class NosnippetGapFillingTestCase(UserTestBase):
         self.request_fetcher.get(url)
         url = '/update_snippet?week=02-18-2013&snippet=future+snippet'
         self.request_fetcher.get(url)
-        response = self.request_fetcher.get('/')
-        self.assertNumSnippets(response.body, 105)
-        self.assertInSnippet('future snippet', response.body, 0)
-        self.assertInSnippet('old snippet', response.body, 104)
+        body = self.get_user_page_with_history()
+        self.assertNumSnippets(body, 105)
+        self.assertInSnippet('future snippet', body, 0)
+        self.assertInSnippet('old snippet', body, 104)
 
         response = self.request_fetcher.get('/weekly')
         self.assertNumSnippets(response.body, 1)
 
 
+class UserPageHistoryTestCase(UserTestBase):
+    """Test we show recent weeks on the user page, and older ones on demand."""
+
+    def testOnlyRecentWeeksShown(self):
+        url = '/update_snippet?week=02-21-2011&snippet=old+snippet'
+        self.request_fetcher.get(url)
+        response = self.request_fetcher.get('/')
+        self.assertNumSnippets(response.body, snippets._USER_PAGE_WEEKS)
+        self.assertNotIn('old snippet', response.body)
+        self.assertIn('data-week="11-28-2011"', response.body)
+
+    def testOlderSnippets(self):
+        url = '/update_snippet?week=02-21-2011&snippet=old+snippet'
+        self.request_fetcher.get(url)
+        response = self.request_fetcher.get(
+            '/older_snippets?week=03-21-2011')
+        self.assertNumSnippets(response.json['html'], 5)
+        self.assertInSnippet('old snippet', response.json['html'], 4)
+        self.assertEqual(None, response.json['next_week'])
+
+        response = self.request_fetcher.get(
+            '/older_snippets?week=06-13-2011')
+        self.assertNumSnippets(response.json['html'], 12)
+        self.assertEqual('03-21-2011', response.json['next_week'])
+
+    def testOlderSnippetsRespectsEditMode(self):
+        url = '/update_snippet?week=02-21-2011&snippet=old+snippet'
+        self.request_fetcher.get(url)
+        response = self.request_fetcher.get(
+            '/older_snippets?week=03-21-2011&edit=0')
+        self.assertNotIn('Make snippet private', response.json['html'])
+
+    def testNoLoadOlderButtonForNewUsers(self):
+        url = '/update_snippet?week=02-20-2012&snippet=my+snippet'
+        self.request_fetcher.get(url)
+        response = self.request_fetcher.get('/')
+        self.assertNumSnippets(response.body, 2)
+        self.assertNotIn('Load older snippets', response.body)
+
+    def testOlderSnippetsRequiresLogin(self):
+        self.testbed.setup_env(user_email='', overwrite=True)
+        self.request_fetcher.get('/older_snippets?week=03-21-2011',
+                                 status=403)
+
+    def testOlderSnippetsForUnknownUser(self):
+        self.request_fetcher.get(
+            '/older_snippets?week=03-21-2011&u=nobody@example.com',
+            status=404)
+
+    def testOlderSnippetsWithBadWeek(self):
+        self.request_fetcher.get('/older_snippets', status=400)
+        self.request_fetcher.get('/older_snippets?week=yesterday',
+                                 status=400)
+
+    def testNoLoadOlderButtonForUnviewablePrivateSnippets(self):
+        url = ('/update_snippet?week=02-21-2011&snippet=old+snippet'
+               '&private=True')
+        self.request_fetcher.get(url)
+        response = self.request_fetcher.get('/')
+        self.assertIn('Load older snippets', response.body)
+
+        self.login('someone@some_other_domain.com')
+        response = self.request_fetcher.get('/?u=user@example.com')
+        self.assertNotIn('Load older snippets', response.body)
+
+
 class PrivateSnippetTestCase(UserTestBase):
     """Tests that we properly restrict viewing of private snippets."""
 
@@ -1116,10 +1745,11 @@ class PrivateSnippetTestCase(UserTestBase):
 class MarkdownSnippetTestCase(UserTestBase):
     """Tests that we properly render snippets using markdown (or not).
 
-    Sadly, the actual markdown is done in javascript, so the best we
-    can test here is that the content is marked with the appropriate
-    class.
+    We render markdown to html when a snippet is saved, and fall back
+    to rendering it in javascript for snippets saved before we did.
     """
+    UNRENDERED = 'class="snippet-text-markdown snippet-text-unrendered"'
+
     def setUp(self):
         super(MarkdownSnippetTestCase, self).setUp()
 
@@ -1132,11 +1762,40 @@ class MarkdownSnippetTestCase(UserTestBase):
 
     def testMarkdownRendering(self):
         response = self.request_fetcher.get('/weekly?week=02-13-2012')
-        self.assertInSnippet('class="snippet-text-markdown', response.body, 0)
+        self.assertInSnippet(['class="snippet-text-markdown">',
+                              '<li>item 1</li>', '<li>item 2</li>'],
+                             response.body, 0)
+        self.assertNotInSnippet(self.UNRENDERED, response.body, 0)
 
     def testTextRendering(self):
         response = self.request_fetcher.get('/weekly?week=02-20-2012')
         self.assertInSnippet('class="snippet-text', response.body, 0)
+        self.assertNotInSnippet('<li>', response.body, 0)
+
+    def testMarkdownIsSanitized(self):
+        url = ('/update_snippet?week=02-27-2012&is_markdown=True&snippet='
+               '*hi*+%3Cscript%3Ealert(1)%3C/script%3E')
+        self.request_fetcher.get(url)
+        response = self.request_fetcher.get('/weekly?week=02-27-2012')
+        self.assertInSnippet('<em>hi</em> &lt;script&gt;alert(1)',
+                             response.body, 0)
+        self.assertNotInSnippet('<script>alert', response.body, 0)
+
+    def testOldSnippetsAreRenderedByMigration(self):
+        self.set_is_admin()
+        week = datetime.date(2012, 2, 27)
+        db.put(models.Snippet(
+            key_name=models.Snippet.make_key_name('user@example.com', week),
+            email='user@example.com', week=week, is_markdown=True,
+            text='* old item'))
+        response = self.request_fetcher.get('/weekly?week=02-27-2012')
+        self.assertInSnippet(self.UNRENDERED, response.body, 0)
+
+        self.request_fetcher.get('/admin/migrate?name=snippet_html')
+        self.run_tasks()
+        response = self.request_fetcher.get('/weekly?week=02-27-2012')
+        self.assertInSnippet('<li>old item</li>', response.body, 0)
+        self.assertNotInSnippet(self.UNRENDERED, response.body, 0)
 
 
 class ManageUsersTestCase(UserTestBase):
@@ -1267,11 +1926,6 @@ class SendingEmailTestCase(UserTestBase):
         super(SendingEmailTestCase, self).setUp()
         self.testbed.init_mail_stub()
         self.mail_stub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
-        # The email-senders sleep 2 seconds between sends for quota
-        # reasons.  We don't want that for most tests, so we suppress
-        # it.  The quota test will redefine time.sleep itself.
-        self.sleep_fn = time.sleep
-        time.sleep = lambda sec: sec
 
         # We send out mail on Sunday nights and Monday mornings, so
         # we'll set 'today' to be Sunday right around midnight.
@@ -1295,10 +1949,6 @@ class SendingEmailTestCase(UserTestBase):
 
         self.login('user@example.com')        # back to the normal user
 
-    def tearDown(self):
-        UserTestBase.tearDown(self)
-        time.sleep = self.sleep_fn
-
     def assertEmailSentTo(self, email):
         r = self.mail_stub.get_sent_messages(to=email)
         self.assertEqual(1, len(r), r)
@@ -1325,6 +1975,7 @@ class SendingEmailTestCase(UserTestBase):
         app_settings = models.AppSettings.get()
         app_settings.delete()
         self.request_fetcher.get('/admin/send_reminder_email')
+        self.run_tasks()
         self.assertEmailNotSentTo('does_not_have_snippet@example.com')
 
     def testDefaultEmailFrom(self):
@@ -1334,6 +1985,7 @@ class SendingEmailTestCase(UserTestBase):
 
     def testSendReminderEmail(self):
         self.request_fetcher.get('/admin/send_reminder_email')
+        self.run_tasks()
         self.assertEmailSentTo('does_not_have_snippet@example.com')
         self.assertEmailSentTo('has_no_snippets@example.com')
         self.assertEmailNotSentTo('has_snippet@example.com')
@@ -1345,8 +1997,18 @@ class SendingEmailTestCase(UserTestBase):
         self.assertEmailContains('has_no_snippets@example.com',
                                  'https://example.com')
 
+    def testSendReminderEmailWithOldStyleSnippet(self):
+        db.put(models.Snippet(email='has_no_snippets@example.com',
+                              week=datetime.date(2012, 2, 13),
+                              text='old-style snippet'))
+        self.request_fetcher.get('/admin/send_reminder_email')
+        self.run_tasks()
+        self.assertEmailSentTo('does_not_have_snippet@example.com')
+        self.assertEmailNotSentTo('has_no_snippets@example.com')
+
     def testSendViewEmail(self):
         self.request_fetcher.get('/admin/send_view_email')
+        self.run_tasks()
         self.assertEmailSentTo('has_snippet@example.com')
         self.assertEmailSentTo('does_not_have_snippet@example.com')
         self.assertEmailSentTo('has_many_snippets@example.com')
@@ -1363,6 +2025,137 @@ class SendingEmailTestCase(UserTestBase):
         self.assertEmailContains('does_not_have_snippet@example.com',
                                  'https://example.com')
 
+    def testEmailBodiesAreRenderedOncePerVariant(self):
+        rendered = []
+        old_render_template = snippets.jinja2.Jinja2.__dict__[
+            'render_template']
+
+        def render_template(jinja2_self, template_path, **template_values):
+            rendered.append((template_path, template_values))
+            return old_render_template(jinja2_self, template_path,
+                                       **template_values)
+
+        snippets.jinja2.Jinja2.render_template = render_template
+        try:
+            self.request_fetcher.get('/admin/send_view_email')
+        finally:
+            snippets.jinja2.Jinja2.render_template = old_render_template
+        # One body for people who have snippets, one for those who don't.
+        self.assertEqual(2, len(rendered), rendered)
+
+        self.run_tasks()
+        self.assertEmailSentTo('has_snippet@example.com')
+        self.assertEmailSentTo('has_no_snippets@example.com')
+        self.assertEmailContains('has_no_snippets@example.com',
+                                 'not too late')
+
+    def testMailGoesThroughTransport(self):
+        transport = mailer.CaptureTransport()
+        old_transport = mailer.set_transport(transport)
+        try:
+            self.request_fetcher.get('/admin/send_reminder_email')
+            self.run_tasks()
+        finally:
+            mailer.set_transport(old_transport)
+        self.assertEmailNotSentTo('has_no_snippets@example.com')
+        self.assertEqual(['does_not_have_snippet@example.com',
+                          'has_no_snippets@example.com'],
+                         sorted(m.to for m in transport.sent))
+        self.assertEqual('Weekly snippets due today at 5pm',
+                         transport.sent[0].subject)
+        self.assertIn('https://example.com', transport.sent[0].body)
+
+    def testRerunningCronDoesNotSendTwice(self):
+        app_settings = models.AppSettings.get()
+        app_settings.slack_channel = '#slack_chann3l'
+        app_settings.put()
+
+        self.request_fetcher.get('/admin/send_reminder_email')
+        self.request_fetcher.get('/admin/send_reminder_email')
+        self.run_tasks()
+        self.assertEmailSentTo('does_not_have_snippet@example.com')
+        self.assertEmailSentTo('has_no_snippets@example.com')
+        self.assertEqual(1, len(self.slack_sends))
+
+        # The view email is a different run, though.
+        self.request_fetcher.get('/admin/send_view_email')
+        self.run_tasks()
+        self.assertEmailSentTo('has_snippet@example.com')
+        self.assertEqual(2, len(self.slack_sends))
+
+    def testCronResumesWhereItStopped(self):
+        # Pretend an earlier run died after queueing the first email.
+        models.MailRun(key_name=models.MailRun.make_key_name(
+                           '/admin/send_reminder_email',
+                           datetime.date(2012, 2, 13)),
+                       cursor='does_not_have_snippet@example.com',
+                       num_queued=1).put()
+        self.request_fetcher.get('/admin/send_reminder_email')
+        self.run_tasks()
+        self.assertEmailNotSentTo('does_not_have_snippet@example.com')
+        self.assertEmailSentTo('has_no_snippets@example.com')
+
+        mail_run = models.MailRun.get_by_key_name(
+            models.MailRun.make_key_name('/admin/send_reminder_email',
+                                         datetime.date(2012, 2, 13)))
+        self.assertEqual('has_no_snippets@example.com', mail_run.cursor)
+        self.assertEqual(2, mail_run.num_queued)
+        self.assertTrue(mail_run.finished)
+
+    def testCronContinuesInATask(self):
+        users = [models.User(email='snippets%02d@example.com' % i)
+                 for i in xrange(50)]
+        db.put(users)
+
+        old_chunks_per_request = snippets._MAIL_RUN_CHUNKS_PER_REQUEST
+        snippets._MAIL_RUN_CHUNKS_PER_REQUEST = 1
+        try:
+            self.request_fetcher.get('/admin/send_view_email')
+            self.assertEqual(1, len(self.taskqueue_stub.GetTasks('default')))
+            self.run_tasks()
+        finally:
+            snippets._MAIL_RUN_CHUNKS_PER_REQUEST = old_chunks_per_request
+
+        for user in users:
+            self.assertEmailSentTo(user.email)
+        self.assertEmailSentTo('has_snippet@example.com')
+        mail_run = models.MailRun.get_by_key_name(
+            models.MailRun.make_key_name('/admin/send_view_email',
+                                         datetime.date(2012, 2, 13)))
+        self.assertEqual(len(users) + 4, mail_run.num_queued)
+        self.assertTrue(mail_run.finished)
+
+    def testRetriedCronContinuesRun(self):
+        users = [models.User(email='snippets%02d@example.com' % i)
+                 for i in xrange(50)]
+        db.put(users)
+
+        def failing_add(*args, **kwargs):
+            raise taskqueue.TransientError()
+
+        old_chunks_per_request = snippets._MAIL_RUN_CHUNKS_PER_REQUEST
+        old_add = snippets.taskqueue.add
+        snippets._MAIL_RUN_CHUNKS_PER_REQUEST = 1
+        try:
+            # The cron dies after queueing its first chunk, before it
+            # can queue the task to continue; cron retries it.
+            snippets.taskqueue.add = failing_add
+            self.request_fetcher.get('/admin/send_view_email', status=500)
+            snippets.taskqueue.add = old_add
+            self.request_fetcher.get('/admin/send_view_email')
+            self.run_tasks()
+        finally:
+            snippets.taskqueue.add = old_add
+            snippets._MAIL_RUN_CHUNKS_PER_REQUEST = old_chunks_per_request
+
+        for user in users:
+            self.assertEmailSentTo(user.email)
+        mail_run = models.MailRun.get_by_key_name(
+            models.MailRun.make_key_name('/admin/send_view_email',
+                                         datetime.date(2012, 2, 13)))
+        self.assertEqual(len(users) + 4, mail_run.num_queued)
+        self.assertTrue(mail_run.finished)
+
     def testViewReminderMailsSettingAndSendReminderEmail(self):
         """Tests the user config-setting for getting emails."""
         self.login('does_not_have_snippet@example.com')
@@ -1373,6 +2166,7 @@ class SendingEmailTestCase(UserTestBase):
         self.request_fetcher.get('/update_settings?reminder_email=yes')
 
         self.request_fetcher.get('/admin/send_reminder_email')
+        self.run_tasks()
         self.assertEmailNotSentTo('does_not_have_snippet@example.com')
         self.assertEmailSentTo('has_no_snippets@example.com')
 
@@ -1383,6 +2177,7 @@ class SendingEmailTestCase(UserTestBase):
         self.request_fetcher.get('/update_settings?reminder_email=yes')
 
         self.request_fetcher.get('/admin/send_view_email')
+        self.run_tasks()
         self.assertEmailSentTo('has_snippet@example.com')
         self.assertEmailNotSentTo('does_not_have_snippet@example.com')
         self.assertEmailSentTo('has_many_snippets@example.com')
@@ -1390,24 +2185,6 @@ class SendingEmailTestCase(UserTestBase):
 
     def testEmailQuotas(self):
         """Test that we don't send more than 32 emails a minute."""
-        self.total_sleep_seconds = 0
-        self.sleep_seconds_this_minute = 0
-        self.calls_this_minute = 0
-        self.max_calls_per_minute = 0
-
-        def count_calls_per_minute(sleep_seconds):
-            self.calls_this_minute += 1
-            self.sleep_seconds_this_minute += sleep_seconds
-            self.total_sleep_seconds += sleep_seconds
-            # Update every time through so we count the last minute too.
-            self.max_calls_per_minute = max(self.max_calls_per_minute,
-                                            self.calls_this_minute)
-            if self.sleep_seconds_this_minute > 60:  # on to the next minute
-                self.calls_this_minute = 0
-                self.sleep_seconds_this_minute %= 60
-
-        time.sleep = lambda sec: count_calls_per_minute(sec)
-
         # We'll do 500 users.  Rather than go through the request
         # API, we modify the db directly; it's much faster.
         users = [models.User(email='snippets%d@example.com' % i)
@@ -1415,13 +2192,41 @@ class SendingEmailTestCase(UserTestBase):
         db.put(users)
 
         self.request_fetcher.get('/admin/send_view_email')
+        batches = [
+            json.loads(urlparse.parse_qs(
+                base64.b64decode(task['body']))['recipients'][0])
+            for task in self.taskqueue_stub.GetTasks('mail')]
+        # Everyone gets mail: the 500 users, plus the 4 from setUp().
+        self.assertEqual(len(users) + 4, sum(len(b) for b in batches))
+        self.assertTrue(max(len(b) for b in batches) <=
+                        snippets._MAIL_BATCH_SIZE)
+
+        # The mail queue's rate limits how many batches we send.
+        with open(os.path.join(os.path.dirname(__file__),
+                               'queue.yaml')) as f:
+            queues = queueinfo.LoadSingleQueue(f).queue
+        mail_queue = [q for q in queues if q.name == 'mail'][0]
+        tasks_per_minute = queueinfo.ParseRate(mail_queue.rate) * 60
+        # In the first minute, we can also use up the bucket.
+        max_calls_per_minute = ((tasks_per_minute + mail_queue.bucket_size)
+                                * snippets._MAIL_BATCH_SIZE)
         # https://developers.google.com/appengine/docs/quotas#Mail
-        self.assertTrue(self.max_calls_per_minute <= 32,
-                        '%d <= %d' % (self.max_calls_per_minute, 32))
+        self.assertTrue(max_calls_per_minute <= 32,
+                        '%d <= %d' % (max_calls_per_minute, 32))
         # Make sure we're not too slow either: say 1/2.5 seconds on average.
-        self.assertTrue(self.total_sleep_seconds <= len(users) * 2.5,
-                        '%d <= %d' % (self.total_sleep_seconds,
-                                      len(users) * 2.5))
+        self.assertTrue(tasks_per_minute * snippets._MAIL_BATCH_SIZE >=
+                        60 / 2.5,
+                        '%d >= %d' % (tasks_per_minute *
+                                      snippets._MAIL_BATCH_SIZE, 60 / 2.5))
+
+    def testRetriedTaskDoesNotResendOthersEmail(self):
+        # A mail task that fails part way is retried from the start,
+        # so it had better have only the one email in it.
+        self.request_fetcher.get('/admin/send_view_email')
+        for task in self.taskqueue_stub.GetTasks('mail'):
+            recipients = json.loads(urlparse.parse_qs(
+                base64.b64decode(task['body']))['recipients'][0])
+            self.assertEqual(1, len(recipients))
 
 
 class SendingChatTestCase(UserTestBase):
@@ -1452,23 +2257,176 @@ class SendingChatTestCase(UserTestBase):
         self.request_fetcher.get('/admin/send_friday_reminder_chat')
         self.assertEqual([], self.slack_sends)
 
+    def test_post_digest(self):
+        app_settings = models.AppSettings.get()
+        app_settings.slack_post_digest = True
+        app_settings.put()
+        self.login('public@example.com')
+        self.request_fetcher.get('/update_settings?category=eng')
+        self.request_fetcher.get(
+            '/update_snippet?week=02-13-2012&snippet=shipped+it')
+        self.login('private@example.com')
+        self.request_fetcher.get('/update_settings?category=eng')
+        self.request_fetcher.get(
+            '/update_snippet?week=02-13-2012&snippet=secret&private=True')
+
+        self.request_fetcher.get('/admin/send_view_email')
+        tasks = self.taskqueue_stub.GetTasks('slack')
+        self.assertEqual(1, len(tasks))
+        params = urlparse.parse_qs(base64.b64decode(tasks[0]['body']))
+        self.assertEqual(['#slack_chann3l'], params['channel'])
+        messages = json.loads(params['messages'][0])
+        self.assertIn('*eng*: 1 snippet for the week of February 13',
+                      messages[0])
+        self.assertIn('https://example.com/weekly?week=02-13-2012',
+                      messages[0])
+        self.assertEqual(['*public@example.com*\nshipped it'], messages[1:])
+
+    def test_no_digest_by_default(self):
+        self.request_fetcher.get('/admin/send_view_email')
+        self.assertEqual([], self.taskqueue_stub.GetTasks('slack'))
+
+
+class MarkdownHtmlTestCase(unittest.TestCase):
+    def testList(self):
+        self.assertEqual('<ul>\n<li>went for a walk</li>\n'
+                         '<li>sniffed <em>some</em> things</li>\n</ul>',
+                         markdown_html.render('- went for a walk\n'
+                                              '* sniffed _some_ things'))
+
+    def testNestedList(self):
+        self.assertEqual('<ul>\n<li>parent\n<ul>\n<li>child</li>\n</ul></li>'
+                         '\n<li>sibling</li>\n</ul>',
+                         markdown_html.render('- parent\n  - child\n'
+                                              '- sibling'))
+
+    def testParagraphsAndCode(self):
+        self.assertEqual('<p>Did <strong>stuff</strong> with '
+                         '<code>a &lt; b</code></p>\n'
+                         '<pre><code>x = 1 &amp; 2</code></pre>',
+                         markdown_html.render('Did **stuff** with `a < b`'
+                                              '\n\n```\nx = 1 & 2\n```'))
+
+    def testLinks(self):
+        self.assertEqual('<p><a href="http://a.com/?q=1&amp;r=2">a</a> '
+                         'and <a href="https://b.com/x_y_z">'
+                         'https://b.com/x_y_z</a>.</p>',
+                         markdown_html.render('[a](http://a.com/?q=1&r=2) '
+                                              'and https://b.com/x_y_z.'))
+
+    def testMarkupInLinkText(self):
+        self.assertEqual('<p><a href="http://x.com"><code>code</code></a>'
+                         ' and <code>more</code></p>',
+                         markdown_html.render('[`code`](http://x.com) '
+                                              'and `more`'))
+        self.assertEqual('<p><a href="http://ci">'
+                         '<img src="http://b/img.png" alt="badge"></a></p>',
+                         markdown_html.render(
+                             '[![badge](http://b/img.png)](http://ci)'))
+        # Link text can't hold a link, so urls in it stay plain text.
+        self.assertEqual('<p><a href="http://c">see http://a.com and '
+                         '<code>x</code></a></p>',
+                         markdown_html.render(
+                             '[see http://a.com and `x`](http://c)'))
+        self.assertEqual('<ul>\n<li><a href="http://x"><code>foo</code></a>'
+                         ' done</li>\n</ul>',
+                         markdown_html.render('- [`foo`](http://x) done'))
+
+    def testSanitizes(self):
+        self.assertEqual('<p>&lt;img src=x onerror=alert(1)&gt; '
+                         '[x](javascript:alert(1))</p>',
+                         markdown_html.render('<img src=x onerror=alert(1)> '
+                                              '[x](javascript:alert(1))'))
+
+    def testSnakeCaseIsNotEmphasis(self):
+        self.assertEqual('<p>call my_var_name</p>',
+                         markdown_html.render('call my_var_name'))
+
 
 class TitleCaseTestCase(unittest.TestCase):
     def testSimple(self):
         self.assertEqual('A Word to the Wise',
-                         snippets._title_case('a word to the wise'))
+                         directory._title_case('a word to the wise'))
 
     def testWeirdCasing(self):
         self.assertEqual('A Word to the Wise',
-                         snippets._title_case('a wOrd to The WIse'))
+                         directory._title_case('a wOrd to The WIse'))
 
     def testTrimLeadingSpaces(self):
         self.assertEqual('A Word to the Wise',
-                         snippets._title_case('  a word to the wise'))
+                         directory._title_case('  a word to the wise'))
 
     def testTrimTrailingSpaces(self):
         self.assertEqual('A Word to the Wise',
-                         snippets._title_case('a word to the wise  '))
+                         directory._title_case('a word to the wise  '))
+
+
+class IterFilledSnippetsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.user = models.User(email='user@example.com',
+                                created=datetime.datetime(2012, 1, 25),
+                                private_snippets=True)
+        self.snippets = [
+            models.Snippet(email='user@example.com',
+                           week=datetime.date(2012, 1, 23), text='s1'),
+            models.Snippet(email='user@example.com',
+                           week=datetime.date(2012, 2, 6), text='s2'),
+        ]
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def fill(self, snippets, **kwargs):
+        return list(util.iter_filled_snippets(
+            snippets, self.user, 'user@example.com', _TEST_TODAY, **kwargs))
+
+    def testOldestFirst(self):
+        filled = self.fill(self.snippets)
+        self.assertEqual([datetime.date(2012, 1, 16) +
+                          datetime.timedelta(7 * i)
+                          for i in xrange(6)],
+                         [s.week for s in filled])
+        self.assertEqual([None, 's1', None, 's2', None, None],
+                         [s.text for s in filled])
+
+    def testNewestFirst(self):
+        filled = self.fill(reversed(self.snippets), newest_first=True)
+        expected = list(reversed(self.fill(self.snippets)))
+        self.assertEqual([(s.week, s.text) for s in expected],
+                         [(s.week, s.text) for s in filled])
+
+    def testPlaceholdersUseUserDefaults(self):
+        filled = self.fill(self.snippets)
+        self.assertIsInstance(filled[0], util.EmptySnippet)
+        self.assertTrue(filled[0].private)
+        snippet = filled[0].to_snippet()
+        self.assertEqual('user@example.com|2012-01-16', snippet.key().name())
+        self.assertTrue(snippet.private)
+
+    def testDoesNotModifyInput(self):
+        self.fill(self.snippets)
+        self.assertEqual(2, len(self.snippets))
+
+    def testWindow(self):
+        filled = self.fill(self.snippets,
+                           first_week=datetime.date(2012, 1, 30),
+                           last_week=datetime.date(2012, 2, 6))
+        # We never drop existing snippets, even if they're before the window.
+        self.assertEqual(['s1', None, 's2'], [s.text for s in filled])
+
+    def testNoSnippets(self):
+        filled = self.fill([], newest_first=True)
+        self.assertEqual(datetime.date(2012, 2, 20), filled[0].week)
+        self.assertEqual(datetime.date(2012, 1, 16), filled[-1].week)
+
+    def testUnknownCreationTime(self):
+        self.user.created = None
+        filled = self.fill([], newest_first=True)
+        self.assertEqual([datetime.date(2012, 2, 20)],
+                         [s.week for s in filled])
 
 
 class DisplayNameTestCase(UserTestBase):
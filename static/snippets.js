@@ -116,10 +116,48 @@ $(function() {
             this.save.bind(this));
     };
 
-    // Create a Snippet for each week shown.
-    var snippets = $(".user-snippet-form").map(function() {
-        return new Snippet($(this));
-    }).get();
+    marked.setOptions({sanitize: true});
+
+    // All the Snippets we've created, so we can check for unsaved ones.
+    var snippets = [];
+
+    // Create a Snippet for each week shown in $container, and convert
+    // snippets to markdown for other users (that is, users who are not
+    // you, who you can't edit), if the server hasn't already.
+    function initSnippets($container) {
+        $container.find(".user-snippet-form").each(function() {
+            snippets.push(new Snippet($(this)));
+        });
+        $container.find(".snippet-text-unrendered").each(function(i, v) {
+            v.innerHTML = window.marked(v.innerHTML);
+        });
+    }
+
+    initSnippets($("#snippet-list"));
+
+    // Fetch the next page of older snippets, and add them to the list.
+    $(".load-older-button").on("click", function(e) {
+        e.preventDefault();
+        var $button = $(this);
+        $button.prop("disabled", true);
+        $.getJSON("/older_snippets", {
+            u: $button.attr("data-u"),
+            week: $button.attr("data-week"),
+            edit: $button.attr("data-edit"),
+        }).then(function(data) {
+            var $older = $("<div>").html(data.html).appendTo("#snippet-list");
+            initSnippets($older);
+            if (data.next_week) {
+                $button.attr("data-week", data.next_week);
+                $button.prop("disabled", false);
+            } else {
+                $button.remove();
+            }
+        }, function() {
+            $button.text("Load older snippets (loading failed!)");
+            $button.prop("disabled", false);
+        });
+    });
 
     // Confirm window closings :)
     $(window).on("beforeunload", function() {
@@ -1,15 +1,92 @@
 import datetime
 
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+import digest
+import directory
+from models import Migration
 from models import Snippet
 from models import User
 
 
+def _rekey(entity, key_name):
+    """Move entity to a new key with the given key name; return the copy.
+
+    This isn't transactional: if we die between the put and the
+    delete, we're left with two copies of the entity.  That's ok,
+    since lookups by key find the new copy, and re-running the
+    migration cleans up the old one.
+    """
+    values = dict((name, getattr(entity, name))
+                  for name in entity.properties())
+    new_entity = type(entity)(key_name=key_name, **values)
+    db.put(new_entity)
+    db.delete(entity)
+    return new_entity
+
+
 # Functions for retrieving a user
+def rekey_user(user):
+    """Move a user with an old-style key to the email key; return the copy.
+
+    If there's already a user at the email key, we keep that one and
+    just delete the old-style user.
+    """
+    key_name = User.make_key_name(user.email)
+    existing = User.get_by_key_name(key_name)
+    if existing:
+        db.delete(user)
+        return existing
+    return _rekey(user, key_name)
+
+
 def get_user(email):
-    """Return the user object with the given email, or None if not found."""
+    """Return the user object with the given email, or None if not found.
+
+    Users are keyed by email, so this is a strongly consistent
+    get-by-key.  Until the 'user_keys' migration has finished, we also
+    look for a user stored the old way (with an auto-assigned id)
+    and, if we find one, move it to its email key.
+    """
+    user = User.get_by_key_name(User.make_key_name(email))
+    if user or Migration.is_finished('user_keys'):
+        return user
+
     q = User.all()
     q.filter('email = ', email)
-    return q.get()
+    user = q.get()
+    if user:
+        user = rekey_user(user)
+    return user
+
+
+def get_users(emails):
+    """Return a list of user objects for the given emails, in one batch get.
+
+    The i-th element of the returned list is the user with the i-th
+    email, or None if there is no such user.
+    """
+    users = User.get_by_key_name([User.make_key_name(e) for e in emails])
+    if None in users and not Migration.is_finished('user_keys'):
+        users = [user or get_user(email)
+                 for (user, email) in zip(users, emails)]
+    return users
+
+
+def put_user(user):
+    """Put a user whose settings have changed (or who is new).
+
+    Use this rather than a plain put, so the cached user directory
+    (and the weekly digests built from it) get updated.
+    """
+    db.put(user)
+    directory.bump(user.email)
+
+
+def delete_user(user):
+    db.delete(user)
+    directory.bump(user.email)
 
 
 def get_user_or_die(email):
@@ -19,14 +96,178 @@ def get_user_or_die(email):
     return user
 
 
-def snippets_for_user(user_email):
-    """Return all snippets for a given user, oldest snippet first."""
+# Functions for retrieving snippets
+def rekey_snippet(snippet):
+    """Move a snippet with an auto-assigned id to its email+week key.
+
+    If there's already a snippet at the email+week key, we keep that
+    one and just delete the old-style snippet.
+    """
+    key_name = Snippet.make_key_name(snippet.email, snippet.week)
+    existing = Snippet.get_by_key_name(key_name)
+    if existing:
+        db.delete(snippet)
+        return existing
+    return _rekey(snippet, key_name)
+
+
+def get_snippet(email, week):
+    """Return the snippet for the given user and week, or None if not found.
+
+    Snippets are keyed by email+week, so this is a strongly consistent
+    get-by-key.  Until the 'snippet_keys' migration has finished, we
+    also look for a snippet stored the old way (with an auto-assigned
+    id) and, if we find one, move it to its email+week key.
+    """
+    snippet = Snippet.get_by_key_name(Snippet.make_key_name(email, week))
+    if snippet or Migration.is_finished('snippet_keys'):
+        return snippet
+
+    q = Snippet.all()
+    q.filter('email = ', email)
+    q.filter('week = ', week)
+    snippet = q.get()
+    if snippet:
+        snippet = rekey_snippet(snippet)
+    return snippet
+
+
+def get_snippets(emails, week):
+    """Return a list of the given users' snippets for week, in one batch get.
+
+    The i-th element of the returned list is the snippet for the i-th
+    email, or None if that user has no snippet for the week.
+    """
+    snippets = Snippet.get_by_key_name(
+        [Snippet.make_key_name(e, week) for e in emails])
+    if None in snippets and not Migration.is_finished('snippet_keys'):
+        snippets = [snippet or get_snippet(email, week)
+                    for (snippet, email) in zip(snippets, emails)]
+    return snippets
+
+
+def emails_for_snippet_keys(keys):
+    """Return the set of emails, lowercased, for the given snippet keys.
+
+    For snippets stored under their email+week key, the email comes
+    from the key itself, so we don't have to fetch the snippet.
+    """
+    emails = set()
+    old_style_keys = []
+    for key in keys:
+        if key.name():
+            emails.add(Snippet.email_from_key_name(key.name()))
+        else:
+            old_style_keys.append(key)
+    if old_style_keys:
+        emails.update(snippet.email.lower()
+                      for snippet in db.get(old_style_keys) if snippet)
+    return emails
+
+
+# Snippet writes update their author's User, which is in a different
+# entity group, so they need a cross-group transaction.  Slack users
+# can fire off several commands that update the same snippet at
+# once, so we retry a few more times than the default before giving
+# up on a conflict.
+_XG_TRANSACTION = db.create_transaction_options(xg=True, retries=10)
+
+
+def update_snippet(email, week, update_fn):
+    """Atomically update a snippet, its author's stats, and the digest.
+
+    Inside a transaction, we call update_fn with the snippet for
+    email+week (or None, if there isn't one yet), and put the
+    snippet it returns.  If that creates a new snippet, we also
+    update the author's last_snippet_week and num_snippet_weeks.
+    If the snippet is new or its privacy changed, we queue a task
+    (as part of the transaction) to update the week's WeeklyDigest
+    to match; see digest.py.  Afterwards we bump the week's snippets
+    generation.
+    update_fn may be called more than once, if the transaction has
+    to be retried.
+
+    Returns the snippet that update_fn returned.
+    """
+    if not Migration.is_finished('snippet_keys'):
+        get_snippet(email, week)   # moves any old-style snippet to its key
+
+    snippet_key_name = Snippet.make_key_name(email, week)
+    user_key_name = User.make_key_name(email)
+
+    def txn():
+        existing = Snippet.get_by_key_name(snippet_key_name)
+        # update_fn may modify existing in place.
+        was_private = existing and bool(existing.private)
+        snippet = update_fn(existing)
+        user = User.get_by_key_name(user_key_name)
+        to_put = [snippet]
+        if existing is None and user is not None:
+            user.num_snippet_weeks = (user.num_snippet_weeks or 0) + 1
+            if not user.last_snippet_week or user.last_snippet_week < week:
+                user.last_snippet_week = week
+            to_put.append(user)
+        if existing is None or was_private != bool(snippet.private):
+            # Every snippet saved for the week would update its
+            # digest, so we leave that out of this transaction.
+            taskqueue.add(queue_name='digest', url='/admin/update_digest',
+                          params={'email': email, 'week': week.isoformat()},
+                          transactional=True)
+        db.put(to_put)
+        return snippet
+
+    snippet = db.run_in_transaction_options(_XG_TRANSACTION, txn)
+    digest.bump_snippets(week)
+    # Note the snippet stats aren't in the user directory, so we
+    # needn't bump it.
+    return snippet
+
+
+def put_snippet(snippet):
+    """Put a snippet, and atomically update its author's snippet stats.
+
+    The snippet must be stored under its email+week key.  This
+    overwrites whatever is in the db for that week; use
+    update_snippet() to do a read-modify-write.
+    """
+    return update_snippet(snippet.email, snippet.week, lambda _: snippet)
+
+
+def snippets_for_user(user_email, start_week=None, end_week=None,
+                      newest_first=False):
+    """Return snippets for a given user, oldest snippet first.
+
+    If start_week and/or end_week are given, we only return snippets
+    for weeks in that range (inclusive).  Otherwise we return all
+    snippets for the user.  If newest_first is True, we return the
+    newest snippet first instead.
+    """
     snippets_q = Snippet.all()
     snippets_q.filter('email = ', user_email)
-    snippets_q.order('week')            # this puts oldest snippet first
+    if start_week:
+        snippets_q.filter('week >= ', start_week)
+    if end_week:
+        snippets_q.filter('week <= ', end_week)
+    if newest_first:
+        snippets_q.order('-week')
+    else:
+        snippets_q.order('week')        # this puts oldest snippet first
     return snippets_q.fetch(1000)       # good for many years...
 
 
+def has_snippets_before(user_email, week, include_private=True):
+    """Return True if the user has a snippet for some week before 'week'.
+
+    If include_private is False, only public snippets count.
+    """
+    snippets_q = Snippet.all(keys_only=True)
+    snippets_q.filter('email = ', user_email)
+    if not include_private:
+        snippets_q.filter('private = ', False)
+    snippets_q.filter('week < ', week)
+    return snippets_q.get() is not None
+
+
 def most_recent_snippet_for_user(user_email):
     """Return the most recent snippet for a given user, or None."""
     snippets_q = Snippet.all()
@@ -90,75 +331,107 @@ def existingsnippet_monday(today):
 _ONE_WEEK = datetime.timedelta(7)
 
 
-def _backfill_missing_snippets(user, all_snippets,
-                               current_monday, first_allowed_monday):
-    monday_ptr = current_monday - _ONE_WEEK
-    while monday_ptr >= first_allowed_monday:
-        all_snippets.insert(0,
-                            Snippet(
-                                email=user.email,
-                                week=monday_ptr,
-                                private=user.private_snippets,
-                                is_markdown=user.uses_markdown))
-        monday_ptr -= _ONE_WEEK
+def first_snippet_monday(user):
+    """Return the first week we show (possibly empty) snippets for.
+
+    This is one week before the week the user registered, or None if
+    we don't know when the user registered.
+    """
+    if user.created is None:
+        return None
+    return newsnippet_monday(user.created) - _ONE_WEEK
+
+
+class EmptySnippet(object):
+    """A stand-in for a Snippet, for a week the user didn't write one.
+
+    These are much cheaper to create than Snippet entities, and we may
+    need one for every week of a user's history.  They have the same
+    fields as a Snippet, as far as templates are concerned.  Call
+    to_snippet() to get a Snippet that can be put() to the db.
+    """
+    __slots__ = ('email', 'week', 'private', 'is_markdown')
+    text = None
+    display_name = None
+
+    def __init__(self, email, week, private, is_markdown):
+        self.email = email
+        self.week = week
+        self.private = private
+        self.is_markdown = is_markdown
 
+    def to_snippet(self):
+        return Snippet(key_name=Snippet.make_key_name(self.email, self.week),
+                       email=self.email,
+                       week=self.week,
+                       private=self.private,
+                       is_markdown=self.is_markdown)
 
-def fill_in_missing_snippets(existing_snippets, user, user_email, today):
-    """Make sure that the snippets array has a Snippet entry for every week.
+
+def iter_filled_snippets(existing_snippets, user, user_email, today,
+                         first_week=None, last_week=None, newest_first=False):
+    """Yield a snippet for every week, filling in holes with EmptySnippets.
 
     The db may have holes in it -- weeks where the user didn't write a
-    snippet.  Augment the given snippets array so that it has no holes,
-    by adding in default snippet entries if necessary. Also backfill empty
-    snippets up until one week before user's registration week.
-    Note it does not add these entries to the db, it just adds them
-    to the array.
+    snippet.  We yield the given snippets in order, and in between
+    them (and before and after them, as needed) we yield EmptySnippets
+    for the missing weeks, using the user's defaults for privacy and
+    markdown.  We fill back to one week before the user's registration
+    week (or the oldest snippet, if that's older), and forward to the
+    current week (or the newest snippet, if that's newer).  Note it
+    does not add these entries to the db.
+
+    This is a generator, so callers who only need a few weeks only pay
+    for those weeks.
 
     Arguments:
-       existing_snippets: a list of Snippet objects for a given user.
-         The first snippet in the list is assumed to be the oldest
-         snippet from that user (at least, it's where we start filling
-         from).
+       existing_snippets: an iterable of Snippet objects for a given
+         user, in the order we should yield them: oldest first, or
+         newest first if newest_first is True.
        user: a User object for the person writing this snippet.
        user_email: the email of the person whose snippets it is.
        today: a datetime.datetime object representing the current day.
-         We fill up to then.  If today is wed or before, then we
-         fill up to the previous week.  If it's thurs or after, we
-         fill up to the current week.
-
-    Returns:
-      A new list of Snippet objects, without any holes,
-      up to one week before user's registration week.
-    """
-    end_monday = newsnippet_monday(today)
-    first_allowed_monday = newsnippet_monday(user.created) - _ONE_WEEK
-    # No snippets at all? Fill empty snippets up to one week before user's
-    # registration week.
-    if not existing_snippets:
-        all_snippets = [Snippet(email=user_email, week=end_monday,
-                                private=user.private_snippets,
-                                is_markdown=user.uses_markdown)]
-        _backfill_missing_snippets(user, all_snippets,
-                                   end_monday, first_allowed_monday)
-        return all_snippets
-
-    # Add a sentinel, one week past the last week we actually want.
-    # We'll remove it at the end.
-    existing_snippets.append(Snippet(email=user_email,
-                                     week=end_monday + _ONE_WEEK))
-
-    all_snippets = [existing_snippets[0]]   # start with the oldest snippet
-    if all_snippets[0].week - first_allowed_monday >= _ONE_WEEK:
-        _backfill_missing_snippets(user, all_snippets,
-                                   all_snippets[0].week, first_allowed_monday)
-    for snippet in existing_snippets[1:]:
-        while snippet.week - all_snippets[-1].week > _ONE_WEEK:
-            missing_week = all_snippets[-1].week + _ONE_WEEK
-            all_snippets.append(Snippet(email=user_email, week=missing_week,
-                                        private=user.private_snippets,
-                                        is_markdown=user.uses_markdown))
-        all_snippets.append(snippet)
-
-    # Get rid of the sentinel we added above.
-    del all_snippets[-1]
-
-    return all_snippets
+         We fill up to the monday for new snippets for that day.
+       first_week: if specified, fill back to this week, rather than
+         to one week before user's registration week.
+       last_week: if specified, fill up to this week rather than up
+         to the week for 'today'.
+       newest_first: if True, yield the newest week first.
+
+    Yields:
+      Snippet and EmptySnippet objects, one per week, without holes.
+    """
+    end_monday = last_week or newsnippet_monday(today)
+    first_monday = first_week or first_snippet_monday(user)
+    # We always fill in at least the end week.
+    if first_monday is None or first_monday > end_monday:
+        first_monday = end_monday
+
+    def empty_snippet(week):
+        return EmptySnippet(user_email, week,
+                            user.private_snippets, user.uses_markdown)
+
+    if newest_first:
+        week = end_monday
+        for snippet in existing_snippets:
+            week = max(week, snippet.week)
+            while week > snippet.week:
+                yield empty_snippet(week)
+                week -= _ONE_WEEK
+            yield snippet
+            week = snippet.week - _ONE_WEEK
+        while week >= first_monday:
+            yield empty_snippet(week)
+            week -= _ONE_WEEK
+    else:
+        week = first_monday
+        for snippet in existing_snippets:
+            week = min(week, snippet.week)
+            while week < snippet.week:
+                yield empty_snippet(week)
+                week += _ONE_WEEK
+            yield snippet
+            week = snippet.week + _ONE_WEEK
+        while week <= end_monday:
+            yield empty_snippet(week)
+            week += _ONE_WEEK